@@ -10,6 +10,7 @@ Django's app-registry check. Import views directly from
 """
 
 from djangostreetmap.annotations import (
+    BatchTileCache,
     GeoJsonFeature,
     GeoJsonFeatureCollection,
     GeoJsonGeometry,
@@ -17,27 +18,38 @@ from djangostreetmap.annotations import (
     MultiGeoJsonSerializer,
     TileCache,
 )
+from djangostreetmap.cache import ContentAddressedTileCache, FileTileCache, LayerVersions, TieredTileCache
 from djangostreetmap.functions import (
     AsFeature,
     AsFeatureCollection,
     AsGeoJson,
     Intersects,
+    QueryParam,
     Simplify,
 )
-from djangostreetmap.tilegenerator import MvtQuery, Tile
+from djangostreetmap.tilegenerator import HEAVY_LAYER_SESSION_SETTINGS, TILE_SESSION_SETTINGS, MultiMvtQuery, MvtQuery, Tile
 
 __all__ = [
     "AsFeature",
     "AsFeatureCollection",
     "AsGeoJson",
+    "BatchTileCache",
+    "ContentAddressedTileCache",
+    "FileTileCache",
     "GeoJsonFeature",
     "GeoJsonFeatureCollection",
     "GeoJsonGeometry",
     "GeoJsonSerializer",
+    "HEAVY_LAYER_SESSION_SETTINGS",
     "Intersects",
+    "LayerVersions",
     "MultiGeoJsonSerializer",
+    "MultiMvtQuery",
     "MvtQuery",
+    "QueryParam",
     "Simplify",
+    "TILE_SESSION_SETTINGS",
+    "TieredTileCache",
     "Tile",
     "TileCache",
 ]
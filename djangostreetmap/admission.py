@@ -0,0 +1,90 @@
+"""
+Admission control for tile queries
+
+Bounds how many tile queries a process runs at once, in total and per layer,
+so that a burst of expensive tiles cannot saturate every database backend.
+A query which cannot get a slot within its timeout raises `TileOverloaded`,
+which tile views answer with a stale tile or `503 Service Unavailable`.
+"""
+
+import asyncio
+import threading
+import time
+from collections.abc import AsyncIterator, Iterable, Iterator
+from contextlib import asynccontextmanager, contextmanager
+
+# The name of the semaphore shared by every layer
+ALL_LAYERS = "*"
+
+
+class TileOverloaded(Exception):
+    """
+    Raised when a tile query could not be admitted in time
+    """
+
+
+_semaphores: dict[tuple[str, int], threading.BoundedSemaphore] = {}
+_async_semaphores: dict[tuple[str, int], asyncio.Semaphore] = {}
+_semaphores_lock = threading.Lock()
+
+
+def get_semaphore(name: str, limit: int) -> threading.BoundedSemaphore:
+    with _semaphores_lock:
+        if (name, limit) not in _semaphores:
+            _semaphores[(name, limit)] = threading.BoundedSemaphore(limit)
+        return _semaphores[(name, limit)]
+
+
+def get_async_semaphore(name: str, limit: int) -> asyncio.Semaphore:
+    if (name, limit) not in _async_semaphores:
+        _async_semaphores[(name, limit)] = asyncio.BoundedSemaphore(limit)
+    return _async_semaphores[(name, limit)]
+
+
+@contextmanager
+def admit(limits: Iterable[tuple[str, int | None]], timeout: float) -> Iterator[None]:
+    """
+    Hold a slot of each named semaphore (a `None` limit is unbounded),
+    waiting at most `timeout` seconds in total
+    """
+    deadline = time.monotonic() + timeout
+    acquired: list[threading.BoundedSemaphore] = []
+    try:
+        for name, limit in limits:
+            if limit is None:
+                continue
+            semaphore = get_semaphore(name, limit)
+            if not semaphore.acquire(timeout=max(0.0, deadline - time.monotonic())):
+                raise TileOverloaded(f"Too many concurrent queries for '{name}'")
+            acquired.append(semaphore)
+        yield
+    finally:
+        for semaphore in reversed(acquired):
+            semaphore.release()
+
+
+@asynccontextmanager
+async def async_admit(limits: Iterable[tuple[str, int | None]], timeout: float) -> AsyncIterator[None]:
+    """
+    The `asyncio` equivalent of `admit`
+    """
+    deadline = time.monotonic() + timeout
+    acquired: list[asyncio.Semaphore] = []
+    try:
+        for name, limit in limits:
+            if limit is None:
+                continue
+            semaphore = get_async_semaphore(name, limit)
+            if not semaphore.locked():
+                # `wait_for` with no time left would time out even when a slot is free
+                await semaphore.acquire()
+            else:
+                try:
+                    await asyncio.wait_for(semaphore.acquire(), timeout=max(0.0, deadline - time.monotonic()))
+                except TimeoutError as E:
+                    raise TileOverloaded(f"Too many concurrent queries for '{name}'") from E
+            acquired.append(semaphore)
+        yield
+    finally:
+        for semaphore in reversed(acquired):
+            semaphore.release()
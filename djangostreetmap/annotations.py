@@ -1,6 +1,6 @@
 from collections.abc import Sequence
 from dataclasses import dataclass
-from typing import Protocol
+from typing import Any, Protocol
 
 from django.db import models
 
@@ -87,3 +87,31 @@ class TileCache(Protocol):
         key; otherwise use the default cache timeout.
         """
         raise NotImplementedError("subclasses of BaseCache must provide a set() method")
+
+    def delete(self, key, version=None):
+        """
+        Delete a key from the cache and return whether it succeeded, failing
+        silently.
+        """
+        raise NotImplementedError("subclasses of BaseCache must provide a delete() method")
+
+
+class BatchTileCache(TileCache, Protocol):
+    """
+    A `TileCache` which can also read and write several keys in one round trip,
+    as Django's cache backends do. Tile views use these methods when the cache
+    has them and fall back to `get` / `set` otherwise (see `cache.get_many`)
+    """
+
+    def get_many(self, keys, version=None) -> dict[str, Any]:
+        """
+        Fetch a bunch of keys from the cache. Return a dict mapping each
+        key to its value; missing keys are left out.
+        """
+        raise NotImplementedError
+
+    def set_many(self, data, timeout=300, version=None):
+        """
+        Set a bunch of values in the cache at once from a dict of key/value pairs.
+        """
+        raise NotImplementedError
@@ -0,0 +1,244 @@
+"""
+Asynchronous tile views
+
+`AsyncTileLayerView` runs each layer's `MvtQuery` concurrently on its own
+pooled psycopg 3 connection instead of one after another on Django's
+connection. This requires the optional dependencies:
+
+>>> pip install djangostreetmap[async]
+
+and an ASGI server, as the connection pool belongs to the running event loop.
+"""
+
+import asyncio
+import functools
+import logging
+from collections.abc import Sequence
+from dataclasses import asdict
+from typing import Any
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.http import HttpRequest
+
+from djangostreetmap.admission import TileOverloaded, async_admit
+from djangostreetmap.cache import get_many, set_many
+from djangostreetmap.coalesce import AsyncSingleFlight
+from djangostreetmap.driver import as_bytes, as_psycopg
+from djangostreetmap.tilegenerator import MultiMvtQuery, MvtQuery, Tile
+from djangostreetmap.views import TileLayerView
+
+from .timer import Timer
+
+try:
+    from psycopg.conninfo import make_conninfo
+    from psycopg.pq import Conninfo
+    from psycopg_pool import AsyncConnectionPool
+except ImportError as E:
+    raise ImportError("Async tile views require psycopg 3 and psycopg_pool: `pip install djangostreetmap[async]`") from E
+
+logger = logging.getLogger(__name__)
+
+# One pool per database alias and process
+_pools: dict[str, AsyncConnectionPool] = {}
+# Background refreshes of stale tiles, by cache key
+_refreshing: dict[str, asyncio.Task] = {}
+
+
+@functools.cache
+def libpq_keywords() -> frozenset[str]:
+    """
+    The connection parameters libpq accepts
+    """
+    return frozenset(option.keyword.decode() for option in Conninfo.get_defaults())
+
+
+def get_conninfo(database: str = "default") -> str:
+    """
+    Connection string for one of the Django `DATABASES`. Of its `OPTIONS`, only
+    libpq connection parameters are kept: others, such as `server_side_binding`
+    or `pool`, are for Django's backend.
+    """
+    db = settings.DATABASES[database]
+    conn_params = dict(dbname=db.get("NAME"), user=db.get("USER"), password=db.get("PASSWORD"), host=db.get("HOST"), port=db.get("PORT"))
+    options = {k: v for k, v in db.get("OPTIONS", {}).items() if k in libpq_keywords()}
+    return make_conninfo("", **{k: v for k, v in conn_params.items() if v}, **options)
+
+
+async def get_pool(database: str = "default", **pool_kwargs) -> AsyncConnectionPool:
+    """
+    Return the (opened) connection pool for a database alias,
+    creating it on first use
+    """
+    pool = _pools.get(database)
+    if pool is None:
+        pool = _pools[database] = AsyncConnectionPool(get_conninfo(database), open=False, **pool_kwargs)
+    if pool.closed:
+        await pool.open()
+    return pool
+
+
+class AsyncTileLayerView(TileLayerView):
+    """
+    ASGI variant of `TileLayerView`: every layer returned from `get_layers`
+    is fetched concurrently, each on a separate pooled connection, and the
+    tile is assembled when all of them have finished.
+
+    `get_layers` is still called synchronously, so it must not query the database.
+    With `coalesce`, identical concurrent layer queries on one event loop
+    share a single query; the cross-process cache lock is not used here.
+    """
+
+    # The Django database alias to connect to, and arguments for `AsyncConnectionPool`
+    database: str = "default"
+    pool_kwargs: dict[str, Any] = {"min_size": 2, "max_size": 10}
+    async_singleflight: AsyncSingleFlight[bytes | None] = AsyncSingleFlight()
+
+    async def _afetch_layer(self, pool: AsyncConnectionPool, query_layer: MvtQuery | MultiMvtQuery, tile: Tile, key: str | None, pending: dict[str, bytes]) -> bytes | None:
+        """
+        Execute a tile query on a pooled connection and queue the result in `pending`
+        to be written to the cache, returning None if it failed. Raises `TileOverloaded`
+        when the query is not admitted in time.
+        """
+        params = {**asdict(tile), **query_layer.query_params}
+        async with async_admit(self._admission_limits(query_layer), self.admission_timeout):
+            try:
+                async with pool.connection() as conn:
+                    settings_sql, query_sql = self._layer_sql(query_layer, conn, convert=as_psycopg)
+                    # Binary results: the tile arrives as raw bytes rather than hex text
+                    if not settings_sql:
+                        cursor = await conn.execute(query_sql, params, binary=True)
+                    else:
+                        # Parameterised queries cannot carry other statements, so the settings are sent first
+                        async with conn.transaction():
+                            await conn.execute(settings_sql)
+                            cursor = await conn.execute(query_sql, params, binary=True)
+                    tile_response = await cursor.fetchone()
+            except Exception as E:
+                logger.error(f"{E}")
+                return None
+        new_content_bytes = as_bytes(tile_response[0]) if tile_response else b""
+
+        if self.tilecache and key:
+            pending[key] = new_content_bytes
+
+        return new_content_bytes
+
+    async def _agenerate_layer(self, pool: AsyncConnectionPool, query_layer: MvtQuery | MultiMvtQuery, tile: Tile, key: str | None, pending: dict[str, bytes]) -> bytes | None:
+        with Timer(name="async tile generator", logger=logger.info):
+            if self.coalesce and key:
+                # Concurrent requests for this layer on this event loop share one query
+                return await self.async_singleflight.do(key, lambda: self._afetch_layer(pool, query_layer, tile, key, pending))
+            return await self._afetch_layer(pool, query_layer, tile, key, pending)
+
+    async def _acache_write(self, data: dict[str, bytes]) -> None:
+        if self.tilecache and data:
+            for entries, timeout in self._cache_writes(data):
+                await sync_to_async(set_many)(self.tilecache, entries, timeout)
+
+    async def _arefresh_layer(self, pool: AsyncConnectionPool, query_layer: MvtQuery | MultiMvtQuery, tile: Tile, key: str) -> None:
+        """
+        Re-render a stale layer in the background
+        """
+        try:
+            pending: dict[str, bytes] = {}
+            await self._agenerate_layer(pool, query_layer, tile, key, pending)
+            await self._acache_write(pending)
+        except Exception as E:
+            logger.error(f"Refreshing tile failed: {E}")
+        finally:
+            _refreshing.pop(key, None)
+
+    def _aschedule_refresh(self, pool: AsyncConnectionPool, query_layer: MvtQuery | MultiMvtQuery, tile: Tile, key: str) -> None:
+        if key not in _refreshing:
+            # Keep a reference to the task until it is done
+            _refreshing[key] = asyncio.get_running_loop().create_task(self._arefresh_layer(pool, query_layer, tile, key))
+
+    async def _agenerate_query_layers(
+        self, pool: AsyncConnectionPool, query_layers: Sequence[MvtQuery | MultiMvtQuery], tile: Tile, pending: dict[str, bytes], stale: set[str]
+    ) -> list[bytes | None]:
+        keys: Sequence[str | None] = [None] * len(query_layers)
+        cached: dict[str, Any] = {}
+        if self.tilecache or self.coalesce:
+            # Layer versions may be read from the cache
+            keys = await sync_to_async(lambda: [self._cache_key(query_layer, tile) for query_layer in query_layers])()
+        if self.tilecache:
+            cached = await sync_to_async(get_many)(self.tilecache, self._cache_lookup_keys(key for key in keys if key))
+
+        async def generate(query_layer: MvtQuery | MultiMvtQuery, key: str | None) -> list[bytes | None]:
+            content, fresh = self._cached_content(cached, key)
+            if content is not None and fresh:
+                logger.info("Cached tile returning")
+            elif content is not None and key and self.cache_stale_while_revalidate:
+                logger.info("Stale tile returning")
+                stale.add(key)
+                self._aschedule_refresh(pool, query_layer, tile, key)
+            else:
+                try:
+                    new_content = await self._agenerate_layer(pool, query_layer, tile, key, pending)
+                except TileOverloaded:
+                    if content is None or not key:
+                        raise
+                    new_content = None
+                if new_content is None and content is not None and key:
+                    logger.warning("Tile query failed, returning stale tile")
+                    stale.add(key)
+                else:
+                    content = new_content
+            if content is None and isinstance(query_layer, MultiMvtQuery):
+                # Fall back to one statement per layer, as `TileLayerView` does
+                return await self._agenerate_query_layers(pool, query_layer.layers, tile, pending, stale)
+            return [content]
+
+        results = await asyncio.gather(*(generate(query_layer, key) for query_layer, key in zip(query_layers, keys, strict=True)))
+        return [content for layer_contents in results for content in layer_contents]
+
+    async def _agenerate_layers(self, tile: Tile) -> tuple[list[bytes], bool]:
+        pool = await get_pool(self.database, **self.pool_kwargs)
+        pending: dict[str, bytes] = {}
+        stale: set[str] = set()
+        try:
+            contents = await self._agenerate_query_layers(pool, self.get_query_layers(tile), tile, pending, stale)
+        finally:
+            await self._acache_write(pending)
+        return [content for content in contents if content], None not in contents and not stale
+
+    async def _agenerate_tile(self, tile: Tile) -> list[bytes]:
+        key: str | None = None
+        stale_tile: bytes | None = None
+        if self.tilecache and self.cache_whole_tile:
+            key = await sync_to_async(self._cache_key)(MultiMvtQuery(layers=self.get_layers(tile)), tile)
+            cached = await sync_to_async(get_many)(self.tilecache, self._cache_lookup_keys([key]))
+            content_bytes, fresh = self._cached_content(cached, key)
+            if content_bytes is not None and fresh:
+                logger.info("Cached whole tile returning")
+                return [content_bytes] if content_bytes else []
+            stale_tile = content_bytes
+
+        try:
+            tiles, complete = await self._agenerate_layers(tile)
+        except TileOverloaded:
+            if stale_tile is None:
+                raise
+            logger.warning("Database overloaded, returning stale whole tile")
+            return [stale_tile] if stale_tile else []
+
+        if not complete and stale_tile is not None:
+            logger.warning("Tile incomplete, returning stale whole tile")
+            return [stale_tile] if stale_tile else []
+        # Never cache a whole tile with missing or stale layers
+        if key and complete:
+            tiles = [b"".join(tiles)]
+            await self._acache_write({key: tiles[0]})
+        return tiles
+
+    async def get(self, request: HttpRequest, *args, **kwargs):
+        with Timer(name="async tile get", logger=logger.info):
+            tile = Tile(**kwargs)  # Expect to receive zoom, x, and y in kwargs
+            if response := await sync_to_async(self._cached_file)(request, tile):
+                return response
+            try:
+                tiles = b"".join(await self._agenerate_tile(tile))
+            except TileOverloaded as E:
+                return self.overloaded(E)
+            return self.tile_response(request, tiles)
@@ -0,0 +1,655 @@
+"""
+Tile cache implementations satisfying the `TileCache` protocol
+"""
+
+import hashlib
+import os
+import pickle
+import re
+import shutil
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from collections.abc import Iterable, Iterator, Mapping
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any
+
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
+
+from djangostreetmap.annotations import TileCache
+from djangostreetmap.tilegenerator import Tile
+
+
+def get_many(cache: TileCache, keys: Iterable[str]) -> dict[str, Any]:
+    """
+    Read several keys in one round trip when the cache supports it
+    """
+    keys = list(keys)
+    if not keys:
+        return {}
+    if callable(getattr(cache, "get_many", None)):
+        return cache.get_many(keys)  # type: ignore
+    return {key: value for key in keys if (value := cache.get(key)) is not None}
+
+
+def set_many(cache: TileCache, data: Mapping[str, Any], timeout=DEFAULT_TIMEOUT) -> None:
+    """
+    Write several keys in one round trip when the cache supports it
+    """
+    if not data:
+        return
+    kwargs = {} if timeout is DEFAULT_TIMEOUT else {"timeout": timeout}
+    if callable(getattr(cache, "set_many", None)):
+        cache.set_many(dict(data), **kwargs)  # type: ignore
+        return
+    for key, value in data.items():
+        cache.set(key, value, **kwargs)
+
+
+def content_digest(content: bytes) -> str:
+    """
+    The identity of a tile's content: the key of content-addressed storage
+    (`ContentAddressedTileCache`), the ETag of tile responses, and the tile ID
+    of exports (see `render_tile_data`)
+    """
+    return hashlib.blake2b(content, digest_size=16).hexdigest()
+
+
+def tile_cache_key(prefix: str, layers: Iterable[tuple[str, Any]], tile: Tile, query_params: Mapping[str, Any] | None = None) -> str:
+    """
+    A structured cache key, cheap to build as no SQL is rendered:
+    `<prefix>:<layer>@<version>[+<layer>@<version>...]:<z>/<x>/<y>:<extent>:<buffer>`
+    followed by a digest of the query parameters, if there are any
+    """
+    layer_versions = "+".join(f"{name}@{version}" for name, version in layers)
+    key = f"{prefix}:{layer_versions}:{tile.zoom}/{tile.x}/{tile.y}:{tile.extent}:{tile.buffer}"
+    if query_params:
+        key += ":" + hashlib.sha256(repr(sorted(query_params.items())).encode()).hexdigest()[:16]
+    # memcached keys are limited to 250 characters, without whitespace or control characters
+    if len(key) > 200 or not key.isprintable() or " " in key:
+        key = f"{prefix}:{hashlib.sha256(key.encode()).hexdigest()}"
+    return key
+
+
+@dataclass
+class LayerVersions:
+    """
+    Data versions of tile layers, kept in a shared cache. Bumping a layer's
+    version (for instance after a data import, see the `bump_tile_version`
+    command) changes the cache keys of all of its tiles in every process.
+    Each process re-reads a version from the cache at most every `ttl` seconds.
+    """
+
+    cache: Any
+    ttl: float = 5
+    prefix: str = "tile-version"
+    _versions: dict[str, tuple[int, float]] = field(default_factory=dict, init=False, repr=False)
+
+    def _key(self, layer: str) -> str:
+        return f"{self.prefix}:{layer}"
+
+    def get(self, layer: str) -> int:
+        version, expires = self._versions.get(layer, (0, 0.0))
+        if expires > time.monotonic():
+            return version
+        version = self.cache.get(self._key(layer)) or 0
+        self._versions[layer] = (version, time.monotonic() + self.ttl)
+        return version
+
+    def bump(self, layer: str) -> int:
+        try:
+            version = self.cache.incr(self._key(layer))
+        except ValueError:
+            # Django caches raise ValueError when incrementing a missing key
+            version = 1
+            self.cache.set(self._key(layer), version, timeout=None)
+        self._versions.pop(layer, None)
+        return version
+
+
+@dataclass
+class _Entry:
+    value: bytes
+    expires: float | None  # `time.monotonic()` deadline, None never expires
+
+    @property
+    def expired(self) -> bool:
+        return self.expires is not None and self.expires <= time.monotonic()
+
+
+@dataclass
+class TieredTileCache:
+    """
+    A per-process, size bounded, least-recently-used memory cache in front
+    of another `TileCache` (typically memcached or Redis), so that the most
+    requested tiles are served without a network hop:
+
+    >>> class Roads(TileLayerView):
+    >>>     tilecache = TieredTileCache(caches["default"], max_bytes=64 * 1024 * 1024)
+
+    Writes go to both tiers. Local entries expire with the same timeout as the
+    outer tier (capped by `max_ttl`). The remaining lifetime of tiles read from
+    the outer tier is unknown, so they are kept for `promoted_ttl` (also capped
+    by `max_ttl`), and freshness markers (`<key>:fresh`, see `cache_stale_timeout`)
+    read from it are not kept at all. Only tile bytes are kept locally, anything
+    else (such as `CacheLock` tokens) always goes to the outer tier.
+    """
+
+    cache: TileCache | None = None  # The outer tier. When None, this is a memory-only cache
+    max_bytes: int = 32 * 1024 * 1024
+    max_ttl: float | None = None
+    # How long tiles read from the outer tier may outlive their copy there
+    promoted_ttl: float = 60
+    hits: int = field(default=0, init=False)
+    misses: int = field(default=0, init=False)
+    evictions: int = field(default=0, init=False)
+    _entries: OrderedDict[str, _Entry] = field(default_factory=OrderedDict, init=False, repr=False)
+    _size: int = field(default=0, init=False, repr=False)
+    _lock: threading.Lock = field(default_factory=threading.Lock, init=False, repr=False)
+
+    @property
+    def size(self) -> int:
+        """
+        The number of bytes of tiles held in memory
+        """
+        return self._size
+
+    @property
+    def stats(self) -> dict[str, int]:
+        return dict(hits=self.hits, misses=self.misses, evictions=self.evictions, entries=len(self._entries), bytes=self._size)
+
+    def _ttl(self, timeout) -> float | None:
+        if timeout is DEFAULT_TIMEOUT:
+            timeout = getattr(self.cache, "default_timeout", 300)
+        if timeout is not None and self.max_ttl is not None:
+            return min(timeout, self.max_ttl)
+        return timeout if timeout is not None else self.max_ttl
+
+    def _local_get(self, key: str) -> bytes | None:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.expired:
+                self._discard(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return entry.value
+
+    def _local_set(self, key: str, value, timeout) -> None:
+        if not isinstance(value, bytes | bytearray | memoryview):
+            return
+        value = bytes(value)
+        size = len(value)
+        if size > self.max_bytes:
+            return
+        ttl = self._ttl(timeout)
+        if ttl is not None and ttl <= 0:
+            return
+        with self._lock:
+            self._discard(key)
+            self._entries[key] = _Entry(value=value, expires=time.monotonic() + ttl if ttl is not None else None)
+            self._size += size
+            while self._size > self.max_bytes:
+                oldest = next(iter(self._entries))
+                self._discard(oldest)
+                self.evictions += 1
+
+    def _discard(self, key: str) -> None:
+        # The caller holds `self._lock`
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._size -= len(entry.value)
+
+    def _promote(self, key: str, value) -> None:
+        """
+        Keep a value read from the outer tier locally
+        """
+        # A local marker could keep a tile fresh after the outer one expired
+        if not key.endswith(":fresh"):
+            self._local_set(key, value, self.promoted_ttl)
+
+    def get(self, key, default=None, version=None):
+        value = self._local_get(key)
+        if value is not None:
+            return value
+        if self.cache is None:
+            return default
+        value = self.cache.get(key, default, version=version)
+        if value is not default:
+            self._promote(key, value)
+        return value
+
+    def get_many(self, keys, version=None) -> dict[str, Any]:
+        found: dict[str, Any] = {}
+        for key in keys:
+            value = self._local_get(key)
+            if value is not None:
+                found[key] = value
+        missing = [key for key in keys if key not in found]
+        if self.cache is not None and missing:
+            outer = get_many(self.cache, missing)
+            for key, value in outer.items():
+                self._promote(key, value)
+            found.update(outer)
+        return found
+
+    def set_many(self, data, timeout=DEFAULT_TIMEOUT, version=None):
+        for key, value in data.items():
+            self._local_set(key, value, timeout)
+        if self.cache is not None:
+            set_many(self.cache, data, timeout)
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        self._local_set(key, value, timeout)
+        if self.cache is not None:
+            if timeout is DEFAULT_TIMEOUT:
+                self.cache.set(key, value, version=version)
+            else:
+                self.cache.set(key, value, timeout=timeout, version=version)
+
+    def delete(self, key, version=None):
+        with self._lock:
+            self._discard(key)
+        if self.cache is not None and hasattr(self.cache, "delete"):
+            return self.cache.delete(key, version=version)
+
+    def clear(self) -> None:
+        """
+        Empty the in-memory tier only
+        """
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    def __getattr__(self, name: str) -> Any:
+        # Anything else, such as the atomic `add` used by `CacheLock`, goes to the outer tier
+        if name.startswith("_") or self.cache is None:
+            raise AttributeError(name)
+        return getattr(self.cache, name)
+
+
+# Tile keys (see `tile_cache_key`), with any suffix such as the `:fresh` marker
+TILE_KEY = re.compile(r"^(?P<head>.+):(?P<zoom>\d+)/(?P<x>\d+)/(?P<y>\d+)(?P<tail>(:[^:/]+)*)$")
+SAFE_NAME = re.compile(r"^[\w@+.-]+$")
+# The modification time of files which never expire
+NEVER = 2**32 - 1
+
+
+@dataclass
+class FileTileCache:
+    """
+    A `TileCache` on disk, for tile sets larger than memory:
+
+    >>> class Roads(TileLayerView):
+    >>>     tilecache = FileTileCache("/var/cache/tiles", max_bytes=50 * 1024**3)
+
+    Tiles are stored as they are, one file each, in directories by key prefix,
+    layers, zoom and x (`tile/roads@1.0/14/14891/8624_4096_64`), so the view
+    can answer hits with a `FileResponse` (see `file`). Other keys, and values
+    which are not bytes, are stored in hashed files. A file's modification time
+    is its expiry. Writes go to a temporary file renamed into place, so
+    readers, in any process, never see part of a tile. When the files exceed
+    `max_bytes`, `cull` deletes the expired and then the soonest expiring ones,
+    in a background thread so that writes do not wait for it. `max_bytes` is
+    shared by all the processes using the directory: each counts its own writes
+    and measures the directory again every `remeasure_interval` seconds.
+    """
+
+    directory: str | Path
+    max_bytes: int | None = None
+    default_timeout: float | None = 300
+    # Cull down to this fraction of `max_bytes`, so that culls are rare
+    cull_fraction: float = 0.9
+    # Seconds between scans of the directory, which count the writes of other processes
+    remeasure_interval: float = 60
+    _root: Path = field(init=False, repr=False)
+    # The running total of the files' sizes, unknown until the first scan of the directory
+    _size: int | None = field(default=None, init=False, repr=False)
+    # When the last scan started, by `time.monotonic`
+    _measured: float | None = field(default=None, init=False, repr=False)
+    _culling: bool = field(default=False, init=False, repr=False)
+    _lock: threading.Lock = field(default_factory=threading.Lock, init=False, repr=False)
+
+    def __post_init__(self):
+        self._root = Path(self.directory)
+
+    def _path(self, key: str, raw: bool = True) -> Path:
+        match = TILE_KEY.match(key)
+        if raw and match:
+            directories = [*match["head"].split(":"), match["zoom"], match["x"]]
+            name = match["y"] + match["tail"].replace(":", "_")
+            if all(SAFE_NAME.match(part) and part not in (".", "..") for part in [*directories, name]):
+                return self._root.joinpath(*directories, name)
+        digest = hashlib.sha256(key.encode()).hexdigest()
+        return self._root / "_" / digest[:2] / f"{digest}{'' if raw else '.pickle'}"
+
+    def _expiry(self, timeout) -> float:
+        if timeout is DEFAULT_TIMEOUT:
+            timeout = self.default_timeout
+        return NEVER if timeout is None else time.time() + timeout
+
+    def _read(self, path: Path) -> bytes | None:
+        try:
+            with open(path, "rb") as tile_file:
+                if os.fstat(tile_file.fileno()).st_mtime <= time.time():
+                    return None
+                return tile_file.read()
+        except FileNotFoundError:
+            return None
+
+    def file(self, key: str) -> Path | None:
+        """
+        The file of an unexpired tile, to send as it is
+        """
+        path = self._path(key)
+        try:
+            return path if path.stat().st_mtime > time.time() else None
+        except FileNotFoundError:
+            return None
+
+    def get(self, key, default=None, version=None):
+        value = self._read(self._path(key))
+        if value is not None:
+            return value
+        value = self._read(self._path(key, raw=False))
+        return pickle.loads(value) if value is not None else default
+
+    @staticmethod
+    def _file_size(path: Path) -> int:
+        try:
+            return path.stat().st_size
+        except FileNotFoundError:
+            return 0
+
+    def _unlink(self, path: Path) -> bool:
+        size = self._file_size(path)
+        try:
+            path.unlink()
+        except FileNotFoundError:
+            return False
+        self._grow(-size)
+        return True
+
+    def _write(self, key: str, value, timeout, exclusive: bool = False) -> bool:
+        raw = isinstance(value, bytes | bytearray | memoryview)
+        path = self._path(key, raw)
+        if not raw:
+            # A key holds either bytes or another value
+            self._unlink(self._path(key))
+            value = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        replaced = self._file_size(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        descriptor, temporary = tempfile.mkstemp(dir=path.parent, prefix=".")
+        try:
+            with open(descriptor, "wb") as tile_file:
+                tile_file.write(value)
+            expires = self._expiry(timeout)
+            os.utime(temporary, (expires, expires))
+            if exclusive:
+                try:
+                    # Fails if the file exists, which `os.replace` would overwrite
+                    os.link(temporary, path)
+                except FileExistsError:
+                    if self._read(path) is not None:
+                        return False
+                    os.replace(temporary, path)
+            else:
+                os.replace(temporary, path)
+        finally:
+            Path(temporary).unlink(missing_ok=True)
+        if raw:
+            self._unlink(self._path(key, raw=False))
+        self._grow(len(value) - replaced)
+        return True
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        self._write(key, value, timeout)
+
+    def set_many(self, data, timeout=DEFAULT_TIMEOUT, version=None):
+        for key, value in data.items():
+            self._write(key, value, timeout)
+        return []
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None) -> bool:
+        """
+        Set a key unless it holds an unexpired value, atomically, as `CacheLock` needs
+        """
+        return self._write(key, value, timeout, exclusive=True)
+
+    def delete(self, key, version=None) -> bool:
+        deleted = [self._unlink(path) for path in (self._path(key), self._path(key, raw=False))]
+        return any(deleted)
+
+    def clear(self) -> None:
+        shutil.rmtree(self._root, ignore_errors=True)
+        with self._lock:
+            self._size = 0
+
+    def _files(self) -> Iterator[os.DirEntry]:
+        directories = [str(self._root)]
+        while directories:
+            try:
+                entries = list(os.scandir(directories.pop()))
+            except FileNotFoundError:
+                continue
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    directories.append(entry.path)
+                elif not entry.name.startswith("."):
+                    yield entry
+
+    def _stats(self) -> Iterator[tuple[float, int, str]]:
+        """
+        The expiry, size and path of each file, skipping those deleted while
+        the directory is scanned
+        """
+        for entry in self._files():
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            yield stat.st_mtime, stat.st_size, entry.path
+
+    def _grow(self, size: int) -> None:
+        """
+        Count a write or a delete, and start a background cull when the total
+        is over `max_bytes`, unknown, or due to be measured again
+        """
+        if self.max_bytes is None:
+            return
+        with self._lock:
+            if self._size is None:
+                # This write is on disk for the first scan to find; later ones are counted on top
+                self._size = 0
+            else:
+                self._size += size
+                measured = self._measured is not None and time.monotonic() - self._measured < self.remeasure_interval
+                if self._size <= self.max_bytes and measured:
+                    return
+            if self._culling:
+                return
+            self._culling = True
+        threading.Thread(target=self._cull_in_background, name="tile-cache-cull", daemon=True).start()
+
+    def _cull_in_background(self) -> None:
+        culling = True
+        try:
+            while culling:
+                self.cull()
+                with self._lock:
+                    # Again if the writes made during the scan took the total over the limit, as
+                    # `_grow` leaves that to this thread until `_culling` is reset, atomically
+                    culling = self._culling = self.max_bytes is not None and self._size is not None and self._size > self.max_bytes
+        finally:
+            if culling:
+                with self._lock:
+                    self._culling = False
+
+    def cull(self) -> int:
+        """
+        Measure the directory and delete expired files, then, when it holds
+        more than `max_bytes`, those expiring soonest (the oldest, for tiles
+        written with the same timeout) until the cache fits in `cull_fraction`
+        of `max_bytes`. Returns the number of bytes kept.
+        """
+        with self._lock:
+            counted = self._size
+            self._measured = time.monotonic()
+        now = time.time()
+        files = sorted(self._stats(), reverse=True)
+        size = sum(file_size for _, file_size, _ in files)
+        target: float = size
+        if self.max_bytes is not None and size > self.max_bytes:
+            target = self.max_bytes * self.cull_fraction
+        while files and (size > target or files[-1][0] <= now):
+            _, file_size, path = files.pop()
+            Path(path).unlink(missing_ok=True)
+            size -= file_size
+        with self._lock:
+            # Keep counting the writes made while the files were scanned
+            self._size = size + (self._size - counted if self._size is not None and counted is not None else 0)
+        return size
+
+
+# The value of a key in a `ContentAddressedTileCache` which refers to content by digest
+REFERENCE = "content:"
+
+
+@dataclass
+class ContentAddressedTileCache:
+    """
+    A `TileCache` storing each distinct tile once, in front of another cache:
+
+    >>> class LandLayer(TileLayerView):
+    >>>     tilecache = ContentAddressedTileCache(caches["default"])
+
+    Many tiles are byte for byte the same (open sea, empty buildings, land
+    interiors). Each key here refers to a digest of its tile (`content_digest`)
+    and each digest to the bytes, so a million sea tiles cost a million short
+    references and one tile. References expire with the timeout of the tile;
+    contents, shared between keys, with `content_timeout`. A reference to evicted
+    content is a miss, and is deleted when read. Values which are not bytes, such
+    as `CacheLock` tokens, are stored as they are.
+    """
+
+    cache: TileCache
+    prefix: str = "tile-content"
+    # None keeps contents until the cache evicts them
+    content_timeout: float | None = None
+    # How many digests this process remembers having stored, to skip writing them again
+    max_known: int = 65536
+    writes: int = field(default=0, init=False)
+    deduplicated: int = field(default=0, init=False)
+    _known: OrderedDict[str, None] = field(default_factory=OrderedDict, init=False, repr=False)
+    _lock: threading.Lock = field(default_factory=threading.Lock, init=False, repr=False)
+
+    @property
+    def stats(self) -> dict[str, int]:
+        return dict(writes=self.writes, deduplicated=self.deduplicated)
+
+    def _content_key(self, digest: str) -> str:
+        return f"{self.prefix}:{digest}"
+
+    @staticmethod
+    def _referenced(value) -> str | None:
+        if isinstance(value, str) and value.startswith(REFERENCE):
+            return value[len(REFERENCE) :]
+        return None
+
+    def _dangling(self, key: str, digest: str) -> None:
+        """
+        Drop a reference to content which was evicted (or culled, see `FileTileCache.cull`)
+        """
+        with self._lock:
+            self._known.pop(digest, None)
+        self.cache.delete(key)
+
+    def digest(self, key: str) -> str | None:
+        """
+        The digest of the tile a key holds, which is its ETag
+        """
+        return self._referenced(self.cache.get(key))
+
+    def file(self, key: str) -> Path | None:
+        """
+        The file holding the tile of a key, when the cache keeps files (see `FileTileCache`)
+        """
+        cached_file = getattr(self.cache, "file", None)
+        if not callable(cached_file):
+            return None
+        digest = self.digest(key)
+        if digest is None:
+            return None
+        path = cached_file(self._content_key(digest))
+        if path is None:
+            self._dangling(key, digest)
+        return path
+
+    def get(self, key, default=None, version=None):
+        value = self.cache.get(key)
+        digest = self._referenced(value)
+        if digest is None:
+            return default if value is None else value
+        content = self.cache.get(self._content_key(digest))
+        if content is None:
+            self._dangling(key, digest)
+            return default
+        return content
+
+    def get_many(self, keys, version=None) -> dict[str, Any]:
+        values = get_many(self.cache, keys)
+        digests = {key: digest for key, value in values.items() if (digest := self._referenced(value))}
+        contents = get_many(self.cache, {self._content_key(digest) for digest in digests.values()})
+        found = {key: value for key, value in values.items() if key not in digests}
+        for key, digest in digests.items():
+            content = contents.get(self._content_key(digest))
+            if content is None:
+                self._dangling(key, digest)
+            else:
+                found[key] = content
+        return found
+
+    def set_many(self, data, timeout=DEFAULT_TIMEOUT, version=None):
+        references: dict[str, Any] = {}
+        contents: dict[str, bytes] = {}
+        for key, value in data.items():
+            if not isinstance(value, bytes | bytearray | memoryview):
+                references[key] = value
+                continue
+            digest = content_digest(value)
+            references[key] = f"{REFERENCE}{digest}"
+            with self._lock:
+                known = digest in self._known
+                if known:
+                    self._known.move_to_end(digest)
+            if known or self._content_key(digest) in contents:
+                self.deduplicated += 1
+            else:
+                contents[self._content_key(digest)] = bytes(value)
+        # Contents first, so that no reference is seen before its content
+        set_many(self.cache, contents, self.content_timeout)
+        set_many(self.cache, references, timeout)
+        self.writes += len(contents)
+        with self._lock:
+            for content_key in contents:
+                self._known[content_key[len(self.prefix) + 1 :]] = None
+            while len(self._known) > self.max_known:
+                self._known.popitem(last=False)
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        self.set_many({key: value}, timeout)
+
+    def delete(self, key, version=None):
+        # Other keys may share the content
+        return self.cache.delete(key)
+
+    def __getattr__(self, name: str) -> Any:
+        # Anything else, such as the atomic `add` used by `CacheLock`, goes to the cache
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return getattr(self.cache, name)
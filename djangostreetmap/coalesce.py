@@ -0,0 +1,136 @@
+"""
+Request coalescing ("singleflight") for tile generation
+
+When many clients request the same tile at once, only the first request
+renders it; concurrent duplicates wait for and share that result.
+`SingleFlight` does this between threads of one process, `AsyncSingleFlight`
+between coroutines of one event loop, and `CacheLock` between processes
+using the atomic `add` of a shared cache.
+"""
+
+import asyncio
+import threading
+import time
+import uuid
+from collections.abc import Awaitable, Callable
+from dataclasses import dataclass, field
+from functools import partial
+from typing import Any, Generic, TypeVar
+
+T = TypeVar("T")
+
+
+@dataclass
+class _Call(Generic[T]):
+    """
+    A call in progress, which duplicate callers wait on
+    """
+
+    done: threading.Event = field(default_factory=threading.Event)
+    result: T | None = None
+    error: BaseException | None = None
+
+
+@dataclass
+class SingleFlight(Generic[T]):
+    """
+    Run `fn` once per key at a time. Threads calling `do` with a key which is
+    already in flight block until the first call finishes, then return its
+    result (or raise its exception)
+    """
+
+    _lock: threading.Lock = field(default_factory=threading.Lock, init=False, repr=False)
+    _calls: dict[str, _Call[T]] = field(default_factory=dict, init=False, repr=False)
+
+    def do(self, key: str, fn: Callable[[], T]) -> T:
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if call is None:
+                call = self._calls[key] = _Call()
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result  # type: ignore
+
+        try:
+            call.result = fn()
+        except BaseException as E:
+            call.error = E
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
+
+
+@dataclass
+class AsyncSingleFlight(Generic[T]):
+    """
+    The `asyncio` equivalent of `SingleFlight`
+    """
+
+    _calls: dict[str, asyncio.Future[T]] = field(default_factory=dict, init=False, repr=False)
+
+    async def do(self, key: str, fn: Callable[[], Awaitable[T]]) -> T:
+        call = self._calls.get(key)
+        if call is None:
+            # The call runs in its own task, so that it outlives the caller which started it
+            call = self._calls[key] = asyncio.ensure_future(fn())
+            call.add_done_callback(lambda done: self._release(key, done))
+        # Shield the shared call so that one cancelled caller, the first included, does not cancel the others
+        return await asyncio.shield(call)
+
+    def _release(self, key: str, call: asyncio.Future[T]) -> None:
+        self._calls.pop(key, None)
+        if not call.cancelled():
+            # Mark the exception as retrieved in case every caller was cancelled
+            call.exception()
+
+
+@dataclass
+class CacheLock:
+    """
+    A best-effort lock shared between processes through a cache
+    which supports an atomic `add` (memcached, Redis, database cache...).
+    The lock expires after `timeout` seconds in case its holder dies.
+    """
+
+    cache: Any
+    key: str
+    timeout: float = 10
+    token: str = field(default_factory=lambda: uuid.uuid4().hex)
+
+    @staticmethod
+    def supported(cache: Any) -> bool:
+        return callable(getattr(cache, "add", None)) and callable(getattr(cache, "delete", None))
+
+    def acquire(self) -> bool:
+        return bool(self.cache.add(self.key, self.token, timeout=self.timeout))
+
+    def release(self) -> None:
+        # Another process may have taken over the lock after it expired
+        if self.cache.get(self.key) == self.token:
+            self.cache.delete(self.key)
+
+    def wait_for(self, key: str, poll: float = 0.05, read: Callable[[], Any | None] | None = None) -> Any | None:
+        """
+        Wait until `key` appears in the cache or the lock is released,
+        returning the cached value if there is one. `read` replaces reading
+        `key`, for instance to ignore a stale value which was there before
+        the holder started rendering.
+        """
+        if read is None:
+            read = partial(self.cache.get, key)
+        deadline = time.monotonic() + self.timeout
+        while time.monotonic() < deadline:
+            value = read()
+            if value is not None:
+                return value
+            if self.cache.get(self.key) is None:
+                return read()
+            time.sleep(poll)
+        return None
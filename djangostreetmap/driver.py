@@ -0,0 +1,107 @@
+"""
+Database driver compatibility
+
+`MvtQuery` composes SQL with psycopg2's `sql` module, while Django uses
+psycopg 3 whenever it is installed. The helpers here run tile queries on
+either driver and, with psycopg 3, transfer tiles as binary results: a
+`bytea` then arrives as raw bytes instead of hex text, half the size on the
+wire and without decoding.
+"""
+
+import threading
+from collections import OrderedDict
+from collections.abc import Callable, Hashable
+from typing import Any
+
+from django.db.backends.postgresql.psycopg_any import is_psycopg3
+from psycopg2 import sql
+
+if is_psycopg3:
+    import psycopg
+    from psycopg import pq
+    from psycopg import sql as psycopg_sql
+
+
+def as_psycopg(composable: sql.Composable) -> "psycopg_sql.Composable":
+    """
+    Convert a psycopg2 `sql.Composable`, as generated by `MvtQuery`,
+    to the equivalent psycopg 3 object
+    """
+    if isinstance(composable, sql.Composed):
+        return psycopg_sql.Composed([as_psycopg(part) for part in composable.seq])
+    if isinstance(composable, sql.SQL):
+        return psycopg_sql.SQL(composable.string)
+    if isinstance(composable, sql.Identifier):
+        return psycopg_sql.Identifier(*composable.strings)
+    if isinstance(composable, sql.Literal):
+        return psycopg_sql.Literal(composable.wrapped)
+    if isinstance(composable, sql.Placeholder):
+        # A nameless placeholder is positional: `%s`
+        return psycopg_sql.Placeholder() if composable.name is None else psycopg_sql.Placeholder(composable.name)
+    raise TypeError(f"Cannot convert {composable!r} to psycopg 3")
+
+
+def adapt_query(query: sql.Composable) -> Any:
+    """
+    A query in the form expected by the driver of Django's connection
+    """
+    return as_psycopg(query) if is_psycopg3 else query
+
+
+# SQL text of queries by key, see `render`
+RENDERED_SQL_SIZE = 1024
+_rendered_sql: OrderedDict[Hashable, str] = OrderedDict()
+_rendered_sql_lock = threading.Lock()
+
+
+def render(key: Hashable, compose: Callable[[], Any], context) -> str:
+    """
+    The SQL text of a query which `key` identifies, composed (by `compose`) and
+    rendered for the driver connection or cursor `context` only the first time. Executing
+    text skips walking and quoting the composable on every request. The
+    `RENDERED_SQL_SIZE` most recently used queries are kept.
+    """
+    with _rendered_sql_lock:
+        text = _rendered_sql.get(key)
+        if text is not None:
+            _rendered_sql.move_to_end(key)
+            return text
+    text = compose().as_string(context)
+    with _rendered_sql_lock:
+        _rendered_sql[key] = text
+        if len(_rendered_sql) > RENDERED_SQL_SIZE:
+            _rendered_sql.popitem(last=False)
+    return text
+
+
+def binary_results(cursor) -> bool:
+    """
+    Ask a cursor (or Django's wrapper around one) for binary results, returning
+    whether it accepted. Only psycopg 3 cursors with server-side parameter
+    binding (the `server_side_binding` database option) can; these also
+    cannot run several statements in one `execute`.
+    """
+    cursor = getattr(cursor, "cursor", cursor)
+    if not is_psycopg3 or isinstance(cursor, psycopg.ClientCursor):
+        return False
+    cursor.format = pq.Format.BINARY
+    return True
+
+
+def last_result(cursor) -> None:
+    """
+    Move to the result of the last statement of an `execute`: psycopg 3 starts
+    at the first one, psycopg2 only keeps the last one
+    """
+    if is_psycopg3:
+        while cursor.nextset():
+            pass
+
+
+def as_bytes(value: bytes | memoryview | None) -> bytes:
+    """
+    A `bytea` result as bytes, which psycopg 3 returns as they are; psycopg2 returns a memoryview
+    """
+    if value is None:
+        return b""
+    return value if isinstance(value, bytes) else bytes(value)
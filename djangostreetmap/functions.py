@@ -1,3 +1,5 @@
+import re
+
 from django.contrib.gis.db import models
 from django.contrib.gis.db.models.functions import GeoFunc
 from django.contrib.postgres.aggregates import JSONBAgg
@@ -83,3 +85,23 @@ class Intersects(RawSQL):
                 )""",
             params=(instance.pk,),
         )
+
+
+class QueryParam(Expression):
+    """
+    A named placeholder, `%(name)s`, in a queryset's SQL. Build a queryset layer
+    with these once and `MvtQuery.bind()` the values per request, instead of
+    compiling a new queryset on every request:
+
+    >>> layer = MvtQuery.from_queryset(RoadLine.objects.filter(osm_type=QueryParam("road_type", output_field=models.CharField())))
+    >>> layer.bind(road_type="primary")
+    """
+
+    def __init__(self, name: str, output_field=None):
+        if not re.fullmatch(r"\w+", name):
+            raise ValueError(f"Invalid parameter name '{name}'")
+        self.name = name
+        super().__init__(output_field=output_field)
+
+    def as_sql(self, compiler, connection):
+        return f"%({self.name})s", []
@@ -0,0 +1,66 @@
+"""
+Generalised tables for low zoom bands
+
+Serving a z4 tile from the table behind z16 tiles means scanning, clipping
+and encoding full-detail geometries which mostly end up as a few pixels. A
+layer's `zoom_bands` (see `ZoomBand`) route low zooms to other tables; for
+managed bands these are materialized views of the layer's table, simplified,
+filtered and optionally dissolved, which the `build_generalised_tables`
+command creates and refreshes with the statements here.
+"""
+
+from psycopg2 import sql
+
+from djangostreetmap.tilegenerator import MvtQuery, Tile, ZoomBand
+
+
+def generalised_select(query_layer: MvtQuery, band: ZoomBand) -> sql.Composed:
+    """
+    The query for a band's rows: the layer's primary key, attributes and
+    the band's `columns`, with the geometry in EPSG:3857, simplified and
+    dissolved as the band asks
+    """
+    if not isinstance(query_layer.table, str):
+        raise ValueError(f"Layer '{query_layer.layer}' has no table to generalise")
+    columns = [column for column in (*query_layer.attributes, *band.columns, query_layer.size_column) if column and column != query_layer.pk]
+    geom = query_layer.transformed_geom
+    group_by: sql.Composable = sql.SQL("")
+    if band.dissolve is not None:
+        if set(columns) - set(band.dissolve):
+            raise ValueError(f"Band '{band.table}' dissolves on {band.dissolve} but layer '{query_layer.layer}' needs {columns}")
+        columns = list(band.dissolve)
+        geom = sql.SQL("ST_UNION({})").format(geom)
+        if band.dissolve:
+            group_by = sql.SQL(" GROUP BY {}").format(sql.SQL(", ").join(sql.Identifier(column) for column in band.dissolve))
+    if band.simplify:
+        geom = sql.SQL("ST_SIMPLIFYPRESERVETOPOLOGY({}, {})").format(geom, sql.Literal(band.simplify * Tile.pixel_size_at(band.maxzoom)))
+    # Dissolved rows need a new key
+    pk = sql.SQL("ROW_NUMBER() OVER () AS {}") if band.dissolve is not None else sql.SQL("{}")
+    selected = [pk.format(sql.Identifier(query_layer.pk)), *(sql.Identifier(column) for column in columns), sql.SQL("{} AS {}").format(geom, sql.Identifier(query_layer.field))]
+    where = sql.SQL(" WHERE {}").format(sql.SQL(" AND ").join(band.filters)) if band.filters else sql.SQL("")
+    return sql.SQL("SELECT {} FROM {}{}{}").format(sql.SQL(", ").join(selected), sql.Identifier(query_layer.table), where, group_by)
+
+
+def create_generalised_table(query_layer: MvtQuery, band: ZoomBand) -> list[sql.Composed]:
+    """
+    Statements creating a band's materialized view (empty until refreshed) with
+    a unique index, which concurrent refreshes need, and a spatial index
+    """
+    table = sql.Identifier(band.table)
+    return [
+        sql.SQL("CREATE MATERIALIZED VIEW IF NOT EXISTS {} AS {} WITH NO DATA").format(table, generalised_select(query_layer, band)),
+        sql.SQL("CREATE UNIQUE INDEX IF NOT EXISTS {} ON {} ({})").format(sql.Identifier(f"{band.table[:55]}_pk"), table, sql.Identifier(query_layer.pk)),
+        sql.SQL("CREATE INDEX IF NOT EXISTS {} ON {} USING GIST ({})").format(sql.Identifier(f"{band.table[:55]}_geom"), table, sql.Identifier(query_layer.field)),
+    ]
+
+
+def drop_generalised_table(band: ZoomBand) -> sql.Composed:
+    return sql.SQL("DROP MATERIALIZED VIEW IF EXISTS {}").format(sql.Identifier(band.table))
+
+
+def refresh_generalised_table(band: ZoomBand, concurrently: bool = False) -> sql.Composed:
+    """
+    Refill a band's materialized view from the layer's table. A concurrent
+    refresh does not block tile queries, but needs the view to be populated.
+    """
+    return sql.SQL("REFRESH MATERIALIZED VIEW {}{}").format(sql.SQL("CONCURRENTLY ") if concurrently else sql.SQL(""), sql.Identifier(band.table))
@@ -0,0 +1,45 @@
+import statistics
+import time
+from dataclasses import asdict, replace
+
+from django.core.management.base import BaseCommand
+from django.db import connections
+from django.utils.module_loading import import_string
+
+from djangostreetmap.driver import adapt_query
+from djangostreetmap.tilegenerator import ATTRIBUTE_MODES, Tile
+
+"""
+Time the layers of tile views with each `MvtQuery.attribute_mode`, for example:
+
+>>> ./manage.py benchmark_attribute_modes --tile 16/59565/34499 --repeat 50
+"""
+
+
+class Command(BaseCommand):
+    help = "Compare the query time and tile size of tile view layers in each attribute mode"
+
+    def add_arguments(self, parser):
+        parser.add_argument("views", nargs="*", type=str, default=["djangostreetmap.views.BuildingPolygon", "djangostreetmap.views.Roads"], help="Dotted paths of tile views")
+        parser.add_argument("--tile", default="14/14891/8624", help="The tile to render, as zoom/x/y")
+        parser.add_argument("--repeat", type=int, default=20, help="Timed runs of each query, after one untimed run")
+        parser.add_argument("--database", default="default")
+
+    def handle(self, *args, **options):
+        zoom, x, y = (int(part) for part in options["tile"].split("/"))
+        tile = Tile(zoom=zoom, x=x, y=y)
+        with connections[options["database"]].cursor() as cursor:
+            for path in options["views"]:
+                for query_layer in import_string(path)().get_layers(tile):
+                    for mode in ATTRIBUTE_MODES:
+                        query = adapt_query(replace(query_layer, attribute_mode=mode).as_mvt())
+                        params = {**asdict(tile), **query_layer.query_params}
+                        timings = []
+                        for run in range(max(options["repeat"], 1) + 1):
+                            start = time.perf_counter()
+                            cursor.execute(query, params)
+                            tile_response = cursor.fetchone()
+                            if run:
+                                timings.append(time.perf_counter() - start)
+                        size = len(tile_response[0]) if tile_response and tile_response[0] else 0
+                        self.stdout.write(f"{path} {query_layer.layer} [{mode}]: median {statistics.median(timings) * 1000:.2f} ms, min {min(timings) * 1000:.2f} ms, {size} bytes")
@@ -0,0 +1,57 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, transaction
+from django.utils.module_loading import import_string
+
+from djangostreetmap.driver import adapt_query
+from djangostreetmap.generalisation import create_generalised_table, drop_generalised_table, refresh_generalised_table
+from djangostreetmap.management.commands.install_tile_functions import url_tile_views
+from djangostreetmap.tilegenerator import MvtQuery, Tile, ZoomBand
+
+"""
+Run this after changing the data of layers with `zoom_bands` (or from cron), and with
+`--rebuild` after changing a band's definition
+"""
+
+
+class Command(BaseCommand):
+    help = "Create and refresh the generalised tables of the zoom bands of tile layers"
+
+    def add_arguments(self, parser):
+        parser.add_argument("views", nargs="*", type=str, help="Dotted paths of tile views; by default those in the URLconf")
+        parser.add_argument("--database", default="default", help="The database alias to build the tables in")
+        parser.add_argument("--rebuild", action="store_true", help="Drop and recreate the tables, for changed band definitions")
+        parser.add_argument("--concurrently", action="store_true", help="Refresh populated tables without blocking tile queries")
+        parser.add_argument("--print", action="store_true", help="Print the SQL instead of running it")
+
+    def handle(self, *args, **options):
+        views = [import_string(path) for path in options["views"]] if options["views"] else url_tile_views()
+        if not views:
+            raise CommandError("No tile views to build tables for")
+
+        # The base layers (before routing) of every zoom, by band table
+        bands: dict[str, tuple[MvtQuery, ZoomBand]] = {}
+        for view_class in views:
+            view = view_class()
+            for zoom in range(0, 23):
+                for query_layer in view.get_layers(Tile(zoom=zoom, x=0, y=0)):
+                    for band in query_layer.zoom_bands:
+                        if band.managed:
+                            bands.setdefault(band.table, (query_layer, band))
+
+        connection = connections[options["database"]]
+        for table, (query_layer, band) in bands.items():
+            statements = create_generalised_table(query_layer, band)
+            if options["rebuild"]:
+                statements.insert(0, drop_generalised_table(band))
+            with transaction.atomic(using=options["database"]), connection.cursor() as cursor:
+                cursor.execute("SELECT ispopulated FROM pg_matviews WHERE matviewname = %s", [table])
+                populated = cursor.fetchone()
+                concurrently = options["concurrently"] and not options["rebuild"] and bool(populated and populated[0])
+                for statement in [*statements, refresh_generalised_table(band, concurrently)]:
+                    text = adapt_query(statement).as_string(cursor.cursor)
+                    if options["print"]:
+                        self.stdout.write(f"{text};")
+                    else:
+                        cursor.execute(text)
+            if not options["print"]:
+                self.stdout.write(f"{table}: refreshed")
@@ -0,0 +1,24 @@
+from django.core.cache import caches
+from django.core.management.base import BaseCommand
+
+from djangostreetmap.cache import LayerVersions
+
+"""
+Run this after importing data so that tile views using `LayerVersions`
+stop serving the cached tiles of the changed layers
+"""
+
+
+class Command(BaseCommand):
+    help = "Bump the data version of tile layers, invalidating their cached tiles"
+
+    def add_arguments(self, parser):
+        parser.add_argument("layers", nargs="+", type=str, help="The MVT layer names to invalidate, ie `transportation`")
+        parser.add_argument("--cache", default="default", help="The cache alias holding the layer versions")
+        parser.add_argument("--prefix", default="tile-version", help="The key prefix of the layer versions")
+
+    def handle(self, *args, **options):
+        versions = LayerVersions(caches[options["cache"]], prefix=options["prefix"])
+        for layer in options["layers"]:
+            version = versions.bump(layer)
+            self.stdout.write(f"{layer}: version {version}")
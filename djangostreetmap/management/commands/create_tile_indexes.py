@@ -0,0 +1,55 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, transaction
+from django.utils.module_loading import import_string
+from psycopg2 import sql
+
+from djangostreetmap.driver import adapt_query
+from djangostreetmap.management.commands.install_tile_functions import url_tile_views
+from djangostreetmap.tilegenerator import MultiMvtQuery, MvtQuery, Tile, create_envelope_index, create_size_indexes
+
+"""
+Layers with `transform=True` but no `srid` filter features on `ST_TRANSFORM(geom, 3857)`,
+and layers culling features by `min_area` / `min_length` without a `size_column` compare
+`ST_AREA` / `ST_LENGTH` of the geometry. Only expression indexes serve these.
+Prefer setting `srid`, which needs no extra index.
+"""
+
+
+class Command(BaseCommand):
+    help = "Create the expression indexes which the filters of tile layers need"
+
+    def add_arguments(self, parser):
+        parser.add_argument("views", nargs="*", type=str, help="Dotted paths of tile views; by default those in the URLconf")
+        parser.add_argument("--minzoom", type=int, default=0)
+        parser.add_argument("--maxzoom", type=int, default=22)
+        parser.add_argument("--database", default="default", help="The database alias to create the indexes in")
+        parser.add_argument("--print", action="store_true", help="Print the SQL instead of running it")
+
+    def handle(self, *args, **options):
+        views = [import_string(path) for path in options["views"]] if options["views"] else url_tile_views()
+        if not views:
+            raise CommandError("No tile views to create indexes for")
+
+        # Layers usually vary by zoom; several layers may need the same index
+        statements: dict[str, sql.Composed] = {}
+        for view_class in views:
+            view = view_class()
+            for zoom in range(options["minzoom"], options["maxzoom"] + 1):
+                for query_layer in view.get_query_layers(Tile(zoom=zoom, x=0, y=0)):
+                    for layer in query_layer.layers if isinstance(query_layer, MultiMvtQuery) else [query_layer]:
+                        for statement in self.layer_indexes(layer):
+                            statements.setdefault(repr(statement), statement)
+
+        connection = connections[options["database"]]
+        with transaction.atomic(using=options["database"]), connection.cursor() as cursor:
+            for statement in statements.values():
+                text = adapt_query(statement).as_string(cursor.cursor)
+                if not options["print"]:
+                    cursor.execute(text)
+                self.stdout.write(f"{text};")
+
+    def layer_indexes(self, query_layer: MvtQuery) -> list[sql.Composed]:
+        statements = create_size_indexes(query_layer)
+        if isinstance(query_layer.table, str) and query_layer.transform and query_layer.srid is None:
+            statements.insert(0, create_envelope_index(query_layer))
+        return statements
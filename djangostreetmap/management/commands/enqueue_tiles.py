@@ -0,0 +1,54 @@
+from itertools import islice
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils.module_loading import import_string
+
+from djangostreetmap.models import TileJob
+from djangostreetmap.seeding import seed_area, tile_blocks
+
+"""
+Queue the tiles of tile views over an area as `TileJob`s, blocks of tiles which
+`tile_worker` processes on any number of nodes render into the views' shared `tilecache`:
+
+>>> ./manage.py enqueue_tiles djangostreetmap.views.LandLayer djangostreetmap.views.Roads --bbox 124.0,-9.5,127.4,-8.1 --maxzoom 14
+>>> ./manage.py tile_worker
+"""
+
+
+class Command(BaseCommand):
+    help = "Queue jobs rendering the tiles of tile views over an area, for tile_worker"
+
+    def add_arguments(self, parser):
+        parser.add_argument("views", nargs="+", type=str, help="Dotted paths of tile views with a `tilecache`")
+        parser.add_argument("--bbox", type=str, help="west,south,east,north in longitude and latitude")
+        parser.add_argument("--geometry", type=str, help="A WKT or GeoJSON geometry, or a file containing one (longitude and latitude unless it has an SRID)")
+        parser.add_argument("--minzoom", type=int, default=0)
+        parser.add_argument("--maxzoom", type=int, default=14)
+        parser.add_argument("--block-size", type=int, default=8, help="Width and height of each job, in tiles")
+        parser.add_argument("--replace", action="store_true", help="Delete the unfinished jobs of these views first")
+
+    def handle(self, *args, **options):
+        try:
+            bbox, geometry = seed_area(options["bbox"], options["geometry"])
+        except ValueError as E:
+            raise CommandError(f"{E}; use --bbox or --geometry") from E
+        for path in options["views"]:
+            if import_string(path).tilecache is None:
+                raise CommandError(f"{path} has no tilecache to seed")
+
+        jobs = (
+            TileJob(view=path, zoom=zoom, x_min=x_min, x_max=x_max, y_min=y_min, y_max=y_max)
+            for path in options["views"]
+            for zoom in range(options["minzoom"], options["maxzoom"] + 1)
+            for x_min, x_max, y_min, y_max in tile_blocks(bbox, zoom, options["block_size"], geometry)
+        )
+        count = tiles = 0
+        with transaction.atomic():
+            if options["replace"]:
+                TileJob.objects.filter(view__in=options["views"]).exclude(status=TileJob.Status.DONE).delete()
+            while batch := list(islice(jobs, 1000)):
+                TileJob.objects.bulk_create(batch)
+                count += len(batch)
+                tiles += sum((job.x_max - job.x_min + 1) * (job.y_max - job.y_min + 1) for job in batch)
+        self.stdout.write(f"Queued {count} jobs of {tiles} tiles")
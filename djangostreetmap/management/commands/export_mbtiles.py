@@ -0,0 +1,111 @@
+import os
+import time
+from collections.abc import Iterator
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+from itertools import islice
+from pathlib import Path
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.utils.module_loading import import_string
+
+from djangostreetmap.mbtiles import MBTilesWriter, tileset_metadata
+from djangostreetmap.pmtiles import PMTilesWriter
+from djangostreetmap.seeding import render_tile_data, seed_area, setup_worker, tile_count, tile_cover
+
+"""
+Render tile views over an area into an MBTiles file, for offline packages or serving
+from static storage:
+
+>>> ./manage.py export_mbtiles timor.mbtiles djangostreetmap.views.LandLayer djangostreetmap.views.Roads --bbox 124.0,-9.5,127.4,-8.1 --maxzoom 14
+
+The layers of all views go into each tile. Identical tiles (open sea, say) are stored
+once, and empty tiles are left out. Exporting into an existing file replaces its tiles.
+Tiles are rendered from the database, not read from the views' tile caches, and a
+layer which fails stops the export.
+"""
+
+
+class Command(BaseCommand):
+    help = "Render the tiles of tile views over an area into an MBTiles file"
+    writer_class: type[MBTilesWriter | PMTilesWriter] = MBTilesWriter
+
+    def add_arguments(self, parser):
+        parser.add_argument("output", type=str, help="The file to write")
+        parser.add_argument("views", nargs="+", type=str, help="Dotted paths of tile views")
+        parser.add_argument("--bbox", type=str, help="west,south,east,north in longitude and latitude")
+        parser.add_argument("--geometry", type=str, help="A WKT or GeoJSON geometry, or a file containing one (longitude and latitude unless it has an SRID)")
+        parser.add_argument("--minzoom", type=int, default=0)
+        parser.add_argument("--maxzoom", type=int, default=14)
+        parser.add_argument("--name", type=str, help="The tileset name; by default the file name")
+        parser.add_argument("--processes", type=int, default=os.cpu_count() or 1, help="Worker processes; 1 renders in this process")
+        parser.add_argument("--chunk-size", type=int, default=64, help="Tiles per task")
+        parser.add_argument("--batch-size", type=int, default=1000, help="Tiles per transaction")
+        parser.add_argument("--progress-interval", type=float, default=10, help="Seconds between progress reports")
+
+    def handle(self, *args, **options):
+        try:
+            bbox, geometry = seed_area(options["bbox"], options["geometry"])
+        except ValueError as E:
+            raise CommandError(f"{E}; use --bbox or --geometry") from E
+        views = [import_string(path)() for path in options["views"]]
+        zooms = range(options["minzoom"], options["maxzoom"] + 1)
+        self.total = sum(tile_count(bbox, zoom, geometry) for zoom in zooms)
+        self.done = self.size = 0
+        self.tile_ids: set[str] = set()
+        self.stored = 0
+        self.batch: list[tuple[int, int, int, str, bytes]] = []
+        self.started = self.reported = time.monotonic()
+
+        output = Path(options["output"])
+        with self.writer_class(output) as writer:
+            writer.set_metadata(tileset_metadata(options["name"] or output.stem, views, bbox, options["minzoom"], options["maxzoom"]))
+            chunks = self.chunks(bbox, geometry, zooms, options["chunk_size"])
+            if options["processes"] <= 1:
+                for tiles in chunks:
+                    self.finish(writer, len(tiles), render_tile_data(options["views"], tiles), options)
+            else:
+                # Children must open their own connections, not share the parent's
+                connections.close_all()
+                with ProcessPoolExecutor(max_workers=options["processes"], initializer=setup_worker) as executor:
+                    pending: dict[Future, int] = {}
+                    for tiles in chunks:
+                        pending[executor.submit(render_tile_data, options["views"], tiles)] = len(tiles)
+                        # Keep a few chunks queued per process rather than every chunk in memory
+                        while len(pending) >= options["processes"] * 4:
+                            self.collect(writer, pending, options)
+                    while pending:
+                        self.collect(writer, pending, options)
+            writer.write(self.batch)
+
+        elapsed = time.monotonic() - self.started
+        self.stdout.write(
+            f"Exported {self.stored} tiles ({len(self.tile_ids)} distinct, {self.done - self.stored} empty) to {output} in {elapsed:.1f}s: "
+            f"{self.done / elapsed if elapsed else 0:.1f} tiles/s, {output.stat().st_size / 1e6:.1f} MB"
+        )
+
+    def chunks(self, bbox, geometry, zooms, chunk_size: int) -> Iterator[list[tuple[int, int, int]]]:
+        for zoom in zooms:
+            cover = tile_cover(bbox, zoom, geometry)
+            while tiles := list(islice(cover, chunk_size)):
+                yield tiles
+
+    def collect(self, writer: MBTilesWriter | PMTilesWriter, pending: dict[Future, int], options) -> None:
+        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            # A failed chunk would leave a hole in the export: stop
+            self.finish(writer, pending.pop(future), future.result(), options)
+
+    def finish(self, writer: MBTilesWriter | PMTilesWriter, count: int, rendered: list[tuple[int, int, int, str, bytes]], options) -> None:
+        self.done += count
+        self.stored += len(rendered)
+        self.tile_ids.update(tile[3] for tile in rendered)
+        self.size += sum(len(tile[4]) for tile in rendered)
+        self.batch.extend(rendered)
+        if len(self.batch) >= options["batch_size"]:
+            writer.write(self.batch)
+            self.batch = []
+        now = time.monotonic()
+        if now - self.reported >= options["progress_interval"]:
+            self.reported = now
+            self.stdout.write(f"{self.done}/{self.total} tiles ({self.done / max(self.total, 1):.1%}), {self.done / (now - self.started):.1f} tiles/s, {self.size / 1e6:.1f} MB")
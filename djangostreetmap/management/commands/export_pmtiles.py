@@ -0,0 +1,17 @@
+from djangostreetmap.management.commands import export_mbtiles
+from djangostreetmap.pmtiles import PMTilesWriter
+
+"""
+Render tile views over an area into a PMTiles archive, which `PMTilesView` serves
+without database queries (or a browser reads with range requests):
+
+>>> ./manage.py export_pmtiles timor.pmtiles djangostreetmap.views.LandLayer djangostreetmap.views.Roads --bbox 124.0,-9.5,127.4,-8.1 --maxzoom 14
+
+Options are those of `export_mbtiles`. The archive is written when every tile is
+rendered; until then tiles are kept in a temporary file next to it.
+"""
+
+
+class Command(export_mbtiles.Command):
+    help = "Render the tiles of tile views over an area into a PMTiles archive"
+    writer_class = PMTilesWriter
@@ -1,4 +1,5 @@
 from django.contrib.gis.utils import LayerMapping  # type: ignore
+from django.core.management import call_command
 from django.core.management.base import BaseCommand
 
 from djangostreetmap.models import SimplifiedLandPolygon
@@ -17,3 +18,4 @@ class Command(BaseCommand):
     def handle(self, *args, **options):
         lm = LayerMapping(SimplifiedLandPolygon, str(options["path"]), mapping=dict(geom="MULTIPOLYGON"), transform=False)
         lm.save(strict=True, verbose=True)
+        call_command("subdivide_land", stdout=self.stdout)
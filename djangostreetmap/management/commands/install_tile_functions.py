@@ -0,0 +1,66 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, transaction
+from django.urls import URLPattern, URLResolver, get_resolver
+from django.utils.module_loading import import_string
+
+from djangostreetmap.driver import adapt_query
+from djangostreetmap.tilefunctions import create_function, function_name
+from djangostreetmap.tilegenerator import MultiMvtQuery, MvtQuery, Tile
+from djangostreetmap.views import TileLayerView
+
+"""
+Run this after deploying changed layer definitions, before serving tiles
+from views with `server_functions = True`
+"""
+
+
+def url_tile_views(patterns=None) -> list[type[TileLayerView]]:
+    """
+    The `TileLayerView` subclasses in the URLconf
+    """
+    found: list[type[TileLayerView]] = []
+    for pattern in get_resolver().url_patterns if patterns is None else patterns:
+        if isinstance(pattern, URLResolver):
+            found.extend(view for view in url_tile_views(pattern.url_patterns) if view not in found)
+        elif isinstance(pattern, URLPattern):
+            view = getattr(pattern.callback, "view_class", None)
+            if isinstance(view, type) and issubclass(view, TileLayerView) and view not in found:
+                found.append(view)
+    return found
+
+
+class Command(BaseCommand):
+    help = "Install the layers of tile views as database functions, for views with `server_functions = True`"
+
+    def add_arguments(self, parser):
+        parser.add_argument("views", nargs="*", type=str, help="Dotted paths of tile views; by default those in the URLconf with `server_functions`")
+        parser.add_argument("--minzoom", type=int, default=0)
+        parser.add_argument("--maxzoom", type=int, default=22)
+        parser.add_argument("--database", default="default", help="The database alias to install the functions in")
+        parser.add_argument("--print", action="store_true", help="Print the SQL instead of running it")
+
+    def handle(self, *args, **options):
+        if options["views"]:
+            views = [import_string(path) for path in options["views"]]
+        else:
+            views = [view for view in url_tile_views() if view.server_functions]
+        if not views:
+            raise CommandError("No tile views to install functions for")
+
+        # Layers usually vary by zoom; the function name identifies each distinct definition
+        query_layers: dict[str, tuple[MvtQuery | MultiMvtQuery, str]] = {}
+        for view_class in views:
+            view = view_class()
+            for zoom in range(options["minzoom"], options["maxzoom"] + 1):
+                for query_layer in view.get_query_layers(Tile(zoom=zoom, x=0, y=0)):
+                    query_layers.setdefault(function_name(query_layer, view.function_prefix), (query_layer, view.function_prefix))
+
+        connection = connections[options["database"]]
+        with transaction.atomic(using=options["database"]), connection.cursor() as cursor:
+            for name, (query_layer, prefix) in query_layers.items():
+                statement = adapt_query(create_function(query_layer, prefix))
+                if options["print"]:
+                    self.stdout.write(f"{statement.as_string(cursor.cursor)};")
+                else:
+                    cursor.execute(statement)
+                    self.stdout.write(f"{name}: installed")
@@ -0,0 +1,126 @@
+import os
+import time
+from collections.abc import Iterator
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+from itertools import islice
+from pathlib import Path
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.utils.module_loading import import_string
+
+from djangostreetmap.seeding import render_tiles, seed_area, setup_worker, tile_count, tile_cover
+
+"""
+Pre-render tiles into the `tilecache` of tile views, for instance after an import:
+
+>>> ./manage.py seed_tiles djangostreetmap.views.LandLayer djangostreetmap.views.Roads --bbox 124.0,-9.5,127.4,-8.1 --maxzoom 14 --state seed.log
+
+Tiles are rendered in chunks by a pool of processes, each with its own database
+connection. With `--state`, finished chunks are recorded so that running the same
+command again resumes after the last one. Tiles already cached and fresh are skipped.
+A chunk with a tile whose layers failed is not recorded, and is rendered again next time.
+"""
+
+
+class Command(BaseCommand):
+    help = "Render the tiles of tile views over an area into their tile caches"
+
+    def add_arguments(self, parser):
+        parser.add_argument("views", nargs="+", type=str, help="Dotted paths of tile views with a `tilecache`")
+        parser.add_argument("--bbox", type=str, help="west,south,east,north in longitude and latitude")
+        parser.add_argument("--geometry", type=str, help="A WKT or GeoJSON geometry, or a file containing one (longitude and latitude unless it has an SRID)")
+        parser.add_argument("--minzoom", type=int, default=0)
+        parser.add_argument("--maxzoom", type=int, default=14)
+        parser.add_argument("--processes", type=int, default=os.cpu_count() or 1, help="Worker processes; 1 renders in this process")
+        parser.add_argument("--chunk-size", type=int, default=64, help="Tiles per task")
+        parser.add_argument("--state", type=str, help="A file recording finished chunks, to resume from")
+        parser.add_argument("--progress-interval", type=float, default=10, help="Seconds between progress reports")
+
+    def handle(self, *args, **options):
+        try:
+            bbox, geometry = seed_area(options["bbox"], options["geometry"])
+        except ValueError as E:
+            raise CommandError(f"{E}; use --bbox or --geometry") from E
+        for path in options["views"]:
+            if import_string(path).tilecache is None:
+                raise CommandError(f"{path} has no tilecache to seed")
+
+        state = Path(options["state"]) if options["state"] else None
+        finished = set(state.read_text().splitlines()) if state and state.exists() else set()
+        zooms = range(options["minzoom"], options["maxzoom"] + 1)
+        self.total = len(options["views"]) * sum(tile_count(bbox, zoom, geometry) for zoom in zooms)
+        self.rendered = self.size = self.skipped = self.failed = 0
+        self.started = self.reported = time.monotonic()
+
+        chunks = self.chunks(options["views"], bbox, geometry, zooms, options["chunk_size"], finished)
+        with open(state, "a") if state else open(os.devnull, "w") as log:
+            if options["processes"] <= 1:
+                for key, path, tiles in chunks:
+                    try:
+                        result = render_tiles(path, tiles)
+                    except Exception as E:
+                        self.fail(key, E)
+                        continue
+                    self.finish(key, log, result, options["progress_interval"])
+            else:
+                # Children must open their own connections, not share the parent's
+                connections.close_all()
+                with ProcessPoolExecutor(max_workers=options["processes"], initializer=setup_worker) as executor:
+                    pending: dict[Future, str] = {}
+                    for key, path, tiles in chunks:
+                        pending[executor.submit(render_tiles, path, tiles)] = key
+                        # Keep a few chunks queued per process rather than every chunk in memory
+                        while len(pending) >= options["processes"] * 4:
+                            self.collect(pending, log, options["progress_interval"])
+                    while pending:
+                        self.collect(pending, log, options["progress_interval"])
+
+        elapsed = time.monotonic() - self.started
+        self.stdout.write(
+            f"Seeded {self.rendered} tiles ({self.skipped} already done) in {elapsed:.1f}s: "
+            f"{self.rendered / elapsed if elapsed else 0:.1f} tiles/s, {self.size / max(self.rendered, 1):.0f} bytes per tile"
+        )
+        if self.failed:
+            raise CommandError(f"{self.failed} chunks failed; run the command again with the same --state to retry them")
+
+    def chunks(self, views, bbox, geometry, zooms, chunk_size: int, finished: set[str]) -> Iterator[tuple[str, str, list[tuple[int, int, int]]]]:
+        """
+        The chunks of tiles to render, identified by their view, first tile and length
+        """
+        for path in views:
+            for zoom in zooms:
+                cover = tile_cover(bbox, zoom, geometry)
+                while tiles := list(islice(cover, chunk_size)):
+                    key = "{} {}/{}/{} {}".format(path, *tiles[0], len(tiles))
+                    if key in finished:
+                        self.skipped += len(tiles)
+                        continue
+                    yield key, path, tiles
+
+    def collect(self, pending: dict[Future, str], log, interval: float) -> None:
+        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            key = pending.pop(future)
+            try:
+                result = future.result()
+            except Exception as E:
+                self.fail(key, E)
+                continue
+            self.finish(key, log, result, interval)
+
+    def fail(self, key: str, error: Exception) -> None:
+        self.failed += 1
+        self.stderr.write(f"{key}: {error}")
+
+    def finish(self, key: str, log, result: tuple[int, int], interval: float) -> None:
+        count, size = result
+        self.rendered += count
+        self.size += size
+        log.write(f"{key}\n")
+        log.flush()
+        now = time.monotonic()
+        if now - self.reported >= interval:
+            self.reported = now
+            done = self.rendered + self.skipped
+            self.stdout.write(f"{done}/{self.total} tiles ({done / max(self.total, 1):.1%}), {self.rendered / (now - self.started):.1f} tiles/s, {self.size / 1e6:.1f} MB")
@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from djangostreetmap.models import SubdividedLandPolygon
+
+"""
+Run this after `import_land` (which runs it with the default vertex cap),
+then `build_generalised_tables` for the low zoom bands of `LandLayer`
+"""
+
+
+class Command(BaseCommand):
+    help = "Cut the land polygons into the pieces which land tiles are served from"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--max-vertices", type=int, default=256, help="The most vertices in a piece (at least 5)")
+
+    def handle(self, *args, **options):
+        count = SubdividedLandPolygon.subdivide(options["max_vertices"])
+        self.stdout.write(f"{count} pieces of land")
@@ -0,0 +1,106 @@
+import os
+import socket
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db.models import Count, F, Q, Sum
+from django.utils import timezone
+
+from djangostreetmap.models import TileJob
+from djangostreetmap.seeding import render_tiles
+
+"""
+Render the `TileJob`s queued by `enqueue_tiles`. Start as many workers as the
+database can keep up with, on as many nodes as share the views' `tilecache`:
+
+>>> ./manage.py tile_worker --wait 30
+
+Each worker claims one job at a time for `--lease` seconds. A job whose worker died
+is claimed again once its lease expires; a job which fails, including one with a
+tile whose layer failed, goes back to the queue until it has been tried
+`--max-attempts` times. `--stats` shows the queue and the
+throughput of each worker.
+"""
+
+
+class Command(BaseCommand):
+    help = "Render queued tile jobs into the tile caches of their views"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--name", type=str, default=f"{socket.gethostname()}:{os.getpid()}", help="This worker's name in the queue")
+        parser.add_argument("--lease", type=float, default=600, help="Seconds a job is held before other workers may take it")
+        parser.add_argument("--max-attempts", type=int, default=3)
+        parser.add_argument("--wait", type=float, default=0, help="Poll for new jobs every so many seconds instead of stopping when the queue is empty")
+        parser.add_argument("--progress-interval", type=float, default=60, help="Seconds between progress reports")
+        parser.add_argument("--retry-failed", action="store_true", help="Queue the failed jobs again and stop")
+        parser.add_argument("--stats", action="store_true", help="Show the queue and per-worker throughput and stop")
+
+    def handle(self, *args, **options):
+        if options["retry_failed"]:
+            count = TileJob.objects.filter(status=TileJob.Status.FAILED).update(status=TileJob.Status.PENDING, attempts=0)
+            self.stdout.write(f"Queued {count} failed jobs again")
+            return
+        if options["stats"]:
+            self.stats()
+            return
+
+        name, lease = options["name"], timedelta(seconds=options["lease"])
+        self.jobs = self.tiles = self.size = self.failed = 0
+        self.started = self.reported = time.monotonic()
+        while True:
+            job = TileJob.claim(name, lease, options["max_attempts"])
+            if job is None:
+                if not options["wait"]:
+                    break
+                time.sleep(options["wait"])
+                continue
+            started = time.monotonic()
+            # Only while this worker holds the job: after its lease expired another worker may have it
+            claimed = TileJob.objects.filter(pk=job.pk, worker=name, status=TileJob.Status.RUNNING)
+            try:
+                count, size = render_tiles(job.view, job.tile_coordinates())
+            except Exception as E:
+                self.failed += 1
+                self.stderr.write(f"{job.view} {job.zoom}/{job.x_min}-{job.x_max}/{job.y_min}-{job.y_max}: {E}")
+                status = TileJob.Status.FAILED if job.attempts >= options["max_attempts"] else TileJob.Status.PENDING
+                claimed.update(status=status, error=str(E), lease_expires=None)
+                continue
+            claimed.update(status=TileJob.Status.DONE, tiles=count, size=size, seconds=time.monotonic() - started, error="", lease_expires=None, finished=timezone.now())
+            self.jobs += 1
+            self.tiles += count
+            self.size += size
+            if time.monotonic() - self.reported >= options["progress_interval"]:
+                self.reported = time.monotonic()
+                self.report(name)
+        self.report(name)
+
+    def report(self, name: str) -> None:
+        elapsed = time.monotonic() - self.started
+        self.stdout.write(
+            f"{name}: {self.jobs} jobs ({self.failed} failed), {self.tiles} tiles in {elapsed:.1f}s: {self.tiles / elapsed if elapsed else 0:.1f} tiles/s, {self.size / 1e6:.1f} MB"
+        )
+
+    def stats(self) -> None:
+        counts = dict(TileJob.objects.values_list("status").annotate(Count("id")))
+        expired = TileJob.objects.filter(status=TileJob.Status.RUNNING, lease_expires__lt=timezone.now()).count()
+        self.stdout.write(", ".join(f"{status.label}: {counts.get(status.value, 0)}" for status in TileJob.Status) + f" ({expired} with expired leases)")
+        workers = (
+            TileJob.objects.exclude(worker="")
+            .values("worker")
+            .annotate(
+                jobs=Count("id", filter=Q(status=TileJob.Status.DONE)),
+                tiles=Sum("tiles", default=0),
+                size=Sum("size", default=0),
+                seconds=Sum("seconds", default=0.0),
+                failures=Count("id", filter=Q(status=TileJob.Status.FAILED)),
+                running=Count("id", filter=Q(status=TileJob.Status.RUNNING, lease_expires__gte=timezone.now())),
+            )
+            .order_by(F("tiles").desc())
+        )
+        for row in workers:
+            rate = row["tiles"] / row["seconds"] if row["seconds"] else 0
+            self.stdout.write(
+                f"{row['worker']}: {row['jobs']} jobs, {row['tiles']} tiles, {row['size'] / 1e6:.1f} MB in {row['seconds']:.1f}s ({rate:.1f} tiles/s), "
+                f"{row['running']} running, {row['failures']} failed"
+            )
@@ -0,0 +1,134 @@
+"""
+MBTiles export
+
+An MBTiles file (https://github.com/mapbox/mbtiles-spec) is a SQLite database
+of gzipped vector tiles which static hosts, tile servers and mobile SDKs read
+directly. `MBTilesWriter` stores each distinct tile once (the `images` table,
+keyed by a hash of its content) and maps tile coordinates to it (the `map`
+table), behind the `tiles` view which readers query. `tileset_metadata`
+describes the layers of tile views for the `metadata` table, as the
+`export_mbtiles` command does.
+"""
+
+import json
+import sqlite3
+from collections.abc import Iterable, Sequence
+from pathlib import Path
+from typing import Any
+
+from django.apps import apps
+from django.core.exceptions import FieldDoesNotExist
+from django.db.models import Field
+
+from djangostreetmap.tilegenerator import MvtQuery, Tile
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS metadata (name TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS images (tile_id TEXT PRIMARY KEY, tile_data BLOB);
+CREATE TABLE IF NOT EXISTS map (zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, tile_id TEXT);
+CREATE UNIQUE INDEX IF NOT EXISTS map_index ON map (zoom_level, tile_column, tile_row);
+CREATE VIEW IF NOT EXISTS tiles AS
+    SELECT map.zoom_level AS zoom_level, map.tile_column AS tile_column, map.tile_row AS tile_row, images.tile_data AS tile_data
+    FROM map JOIN images ON images.tile_id = map.tile_id;
+"""
+
+# The `vector_layers` field types of Django fields; others are "String"
+FIELD_TYPES = {
+    "AutoField": "Number",
+    "BigAutoField": "Number",
+    "BigIntegerField": "Number",
+    "DecimalField": "Number",
+    "FloatField": "Number",
+    "IntegerField": "Number",
+    "PositiveBigIntegerField": "Number",
+    "PositiveIntegerField": "Number",
+    "PositiveSmallIntegerField": "Number",
+    "SmallAutoField": "Number",
+    "SmallIntegerField": "Number",
+    "BooleanField": "Boolean",
+}
+
+
+class MBTilesWriter:
+    """
+    Write tiles to an MBTiles file, creating it if needed. Tiles are
+    `(zoom, x, y, tile_id, data)` with XYZ coordinates, `data` gzipped and
+    `tile_id` identifying its content; each batch is one transaction.
+    """
+
+    def __init__(self, path: str | Path):
+        self.connection = sqlite3.connect(path)
+        # The file is only complete when the export finishes; a crash means exporting again
+        self.connection.execute("PRAGMA synchronous = OFF")
+        self.connection.executescript(SCHEMA)
+        self.images: set[str] = {row[0] for row in self.connection.execute("SELECT tile_id FROM images")}
+
+    def __enter__(self) -> "MBTilesWriter":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.connection.close()
+
+    def write(self, tiles: Iterable[tuple[int, int, int, str, bytes]]) -> None:
+        with self.connection:
+            for zoom, x, y, tile_id, data in tiles:
+                if tile_id not in self.images:
+                    self.connection.execute("INSERT OR REPLACE INTO images (tile_id, tile_data) VALUES (?, ?)", (tile_id, data))
+                    self.images.add(tile_id)
+                # MBTiles rows count from the south (TMS)
+                self.connection.execute("INSERT OR REPLACE INTO map (zoom_level, tile_column, tile_row, tile_id) VALUES (?, ?, ?, ?)", (zoom, x, 2**zoom - 1 - y, tile_id))
+
+    def set_metadata(self, metadata: dict[str, Any]) -> None:
+        with self.connection:
+            self.connection.executemany("INSERT OR REPLACE INTO metadata (name, value) VALUES (?, ?)", ((name, str(value)) for name, value in metadata.items()))
+
+
+def attribute_type(query_layer: MvtQuery, name: str) -> str:
+    """
+    The `vector_layers` type of an attribute, from the model whose table the layer reads
+    """
+    models = [model for model in apps.get_models() if model._meta.db_table == query_layer.table]
+    if name in query_layer.attributes and models:
+        try:
+            field = models[0]._meta.get_field(name)
+        except FieldDoesNotExist:
+            return "String"
+        # Not a relation or a generic foreign key, which have no column of their own
+        if isinstance(field, Field):
+            return FIELD_TYPES.get(field.get_internal_type(), "String")
+    return "String"
+
+
+def vector_layers(views: Sequence, minzoom: int, maxzoom: int) -> list[dict[str, Any]]:
+    """
+    The `vector_layers` of TileJSON for tile views: each layer with its attributes
+    and the zoom levels where the views serve it
+    """
+    layers: dict[str, dict[str, Any]] = {}
+    for view in views:
+        for zoom in range(minzoom, maxzoom + 1):
+            for query_layer in view.get_layers(Tile(zoom=zoom, x=0, y=0)):
+                layer = layers.setdefault(query_layer.layer, {"id": query_layer.layer, "fields": {}, "minzoom": zoom, "maxzoom": zoom})
+                layer["maxzoom"] = zoom
+                if view.__doc__ and "description" not in layer:
+                    layer["description"] = view.__doc__.strip().splitlines()[0]
+                for name in (*query_layer.attributes, *query_layer.calculated_attributes):
+                    layer["fields"].setdefault(name, attribute_type(query_layer, name))
+    return list(layers.values())
+
+
+def tileset_metadata(name: str, views: Sequence, bbox: tuple[float, float, float, float], minzoom: int, maxzoom: int) -> dict[str, Any]:
+    """
+    The `metadata` of an MBTiles file of vector tiles from tile views
+    """
+    west, south, east, north = bbox
+    return {
+        "name": name,
+        "format": "pbf",
+        "type": "overlay",
+        "bounds": f"{west},{south},{east},{north}",
+        "center": f"{(west + east) / 2},{(south + north) / 2},{minzoom}",
+        "minzoom": minzoom,
+        "maxzoom": maxzoom,
+        "json": json.dumps({"vector_layers": vector_layers(views, minzoom, maxzoom)}),
+    }
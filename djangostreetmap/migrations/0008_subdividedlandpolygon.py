@@ -0,0 +1,21 @@
+import django.contrib.gis.db.models.fields
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("djangostreetmap", "0007_simplifiedlandpolygon_delete_osmadminboundary_and_more"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="SubdividedLandPolygon",
+            fields=[
+                ("id", models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                ("geom", django.contrib.gis.db.models.fields.MultiPolygonField(srid=3857)),
+                ("land", models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name="parts", to="djangostreetmap.simplifiedlandpolygon")),
+            ],
+        ),
+    ]
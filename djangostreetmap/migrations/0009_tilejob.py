@@ -0,0 +1,43 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("djangostreetmap", "0008_subdividedlandpolygon"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="TileJob",
+            fields=[
+                ("id", models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                ("view", models.CharField(help_text="Dotted path of the tile view", max_length=255)),
+                ("zoom", models.PositiveSmallIntegerField()),
+                ("x_min", models.PositiveIntegerField()),
+                ("x_max", models.PositiveIntegerField()),
+                ("y_min", models.PositiveIntegerField()),
+                ("y_max", models.PositiveIntegerField()),
+                (
+                    "status",
+                    models.CharField(
+                        choices=[("pending", "Pending"), ("running", "Running"), ("done", "Done"), ("failed", "Failed")],
+                        default="pending",
+                        max_length=16,
+                    ),
+                ),
+                ("attempts", models.PositiveSmallIntegerField(default=0)),
+                ("worker", models.CharField(blank=True, help_text="The worker which last claimed the job", max_length=255)),
+                ("lease_expires", models.DateTimeField(blank=True, null=True)),
+                ("tiles", models.PositiveIntegerField(default=0, help_text="Tiles rendered")),
+                ("size", models.BigIntegerField(default=0, help_text="Bytes rendered")),
+                ("seconds", models.FloatField(default=0, help_text="Time spent rendering")),
+                ("error", models.TextField(blank=True)),
+                ("created", models.DateTimeField(auto_now_add=True)),
+                ("finished", models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                "indexes": [models.Index(fields=["status", "zoom"], name="djangostree_status_85f16b_idx")],
+            },
+        ),
+    ]
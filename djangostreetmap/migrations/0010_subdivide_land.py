@@ -0,0 +1,31 @@
+from django.db import migrations
+
+
+def subdivide_land(apps, schema_editor):
+    """
+    Fill the pieces which `LandLayer` serves from land polygons imported before
+    they existed, as `SubdividedLandPolygon.subdivide` does
+    """
+    SimplifiedLandPolygon = apps.get_model("djangostreetmap", "SimplifiedLandPolygon")
+    SubdividedLandPolygon = apps.get_model("djangostreetmap", "SubdividedLandPolygon")
+    if SubdividedLandPolygon.objects.using(schema_editor.connection.alias).exists():
+        return
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute(
+            f"""
+            INSERT INTO "{SubdividedLandPolygon._meta.db_table}" (land_id, geom)
+            SELECT id, ST_Multi(ST_CollectionExtract(ST_Subdivide(geom, 256), 3))
+            FROM "{SimplifiedLandPolygon._meta.db_table}"
+            """
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("djangostreetmap", "0009_tilejob"),
+    ]
+
+    operations = [
+        migrations.RunPython(subdivide_land, migrations.RunPython.noop),
+    ]
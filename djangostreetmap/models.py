@@ -1,5 +1,8 @@
+from datetime import timedelta
+
 from django.contrib.gis.db.models.fields import MultiPolygonField
-from django.db import models
+from django.db import connection, models, transaction
+from django.utils import timezone
 
 
 class SimplifiedLandPolygon(models.Model):
@@ -8,3 +11,95 @@ class SimplifiedLandPolygon(models.Model):
     """
 
     geom = MultiPolygonField(srid=3857)
+
+
+class SubdividedLandPolygon(models.Model):
+    """
+    `SimplifiedLandPolygon`s cut by `ST_Subdivide` into pieces of a bounded number
+    of vertices, so that a tile reads and clips only the pieces it overlaps
+    instead of a whole continent
+    """
+
+    land = models.ForeignKey(SimplifiedLandPolygon, on_delete=models.CASCADE, related_name="parts")
+    geom = MultiPolygonField(srid=3857)
+
+    @classmethod
+    def subdivide(cls, max_vertices: int = 256) -> int:
+        """
+        Replace every piece with a new subdivision of the land polygons,
+        returning the number of pieces
+        """
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM "{cls._meta.db_table}"')
+            cursor.execute(
+                f"""
+                INSERT INTO "{cls._meta.db_table}" (land_id, geom)
+                SELECT id, ST_Multi(ST_CollectionExtract(ST_Subdivide(geom, %s), 3))
+                FROM "{SimplifiedLandPolygon._meta.db_table}"
+                """,
+                [max_vertices],
+            )
+            count = cursor.rowcount
+            cursor.execute(f'ANALYZE "{cls._meta.db_table}"')
+        return count
+
+
+class TileJob(models.Model):
+    """
+    A range of tiles to render with a tile view, in the queue which `tile_worker`
+    processes on any number of nodes (see `enqueue_tiles`). Workers claim jobs
+    with `FOR UPDATE SKIP LOCKED` and hold them for a lease; jobs whose lease
+    expires, because their worker died, are claimed again.
+    """
+
+    class Status(models.TextChoices):
+        PENDING = "pending"
+        RUNNING = "running"
+        DONE = "done"
+        FAILED = "failed"
+
+    view = models.CharField(max_length=255, help_text="Dotted path of the tile view")
+    zoom = models.PositiveSmallIntegerField()
+    x_min = models.PositiveIntegerField()
+    x_max = models.PositiveIntegerField()
+    y_min = models.PositiveIntegerField()
+    y_max = models.PositiveIntegerField()
+    status = models.CharField(max_length=16, choices=Status.choices, default=Status.PENDING)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    worker = models.CharField(max_length=255, blank=True, help_text="The worker which last claimed the job")
+    lease_expires = models.DateTimeField(null=True, blank=True)
+    tiles = models.PositiveIntegerField(default=0, help_text="Tiles rendered")
+    size = models.BigIntegerField(default=0, help_text="Bytes rendered")
+    seconds = models.FloatField(default=0, help_text="Time spent rendering")
+    error = models.TextField(blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+    finished = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [models.Index(fields=["status", "zoom"])]
+
+    def tile_coordinates(self) -> list[tuple[int, int, int]]:
+        return [(self.zoom, x, y) for x in range(self.x_min, self.x_max + 1) for y in range(self.y_min, self.y_max + 1)]
+
+    @classmethod
+    def claim(cls, worker: str, lease: timedelta, max_attempts: int) -> "TileJob | None":
+        """
+        Take the next job which is pending, or whose lease has expired, for `lease`;
+        other workers skip the rows locked here instead of waiting for them.
+        Expired jobs without attempts left fail.
+        """
+        now = timezone.now()
+        cls.objects.filter(status=cls.Status.RUNNING, lease_expires__lt=now, attempts__gte=max_attempts).update(status=cls.Status.FAILED, error="Lease expired")
+        with transaction.atomic():
+            job = (
+                cls.objects.select_for_update(skip_locked=True)
+                .filter(models.Q(status=cls.Status.PENDING) | models.Q(status=cls.Status.RUNNING, lease_expires__lt=now), attempts__lt=max_attempts)
+                .order_by("zoom", "id")
+                .first()
+            )
+            if job is None:
+                return None
+            job.status, job.worker, job.lease_expires = cls.Status.RUNNING, worker, now + lease
+            job.attempts += 1
+            job.save(update_fields=["status", "worker", "lease_expires", "attempts"])
+        return job
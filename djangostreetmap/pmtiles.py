@@ -0,0 +1,360 @@
+"""
+PMTiles archives
+
+A PMTiles v3 archive (https://github.com/protomaps/PMTiles/blob/main/spec/v3/spec.md)
+is a single file of tiles addressed by their position along a Hilbert curve,
+which a server (or a browser, with HTTP range requests) reads with a couple of
+range reads per tile: a 127 byte header, a compressed root directory within the
+first 16 KiB, optional leaf directories, and the tile data.
+
+`PMTilesWriter` takes rendered tiles in any order, stores identical tiles once
+and writes them in tile ID order, merging runs of identical tiles into single
+directory entries. `PMTilesReader` serves tiles from a memory-mapped archive
+with its directories cached, as `PMTilesView` does.
+"""
+
+import gzip
+import json
+import mmap
+import os
+import struct
+import tempfile
+from bisect import bisect_right
+from collections.abc import Iterable
+from dataclasses import astuple, dataclass, replace
+from functools import cache, lru_cache
+from pathlib import Path
+from typing import Any
+
+HEADER_LENGTH = 127
+# The header and the root directory are read together, so the root must fit in the first 16 KiB
+ROOT_LENGTH = 16384 - HEADER_LENGTH
+COMPRESSION_GZIP = 2
+TILE_TYPE_MVT = 1
+
+
+def zxy_to_tileid(zoom: int, x: int, y: int) -> int:
+    """
+    The ID of a tile: the number of tiles at lower zooms plus its distance along
+    the Hilbert curve of its zoom, so that nearby tiles have nearby IDs
+    """
+    n = 1 << zoom
+    if not (0 <= x < n and 0 <= y < n):
+        raise ValueError(f"Tile {zoom}/{x}/{y} is outside zoom {zoom}")
+    distance = 0
+    s = n >> 1
+    while s > 0:
+        rx = 1 if x & s else 0
+        ry = 1 if y & s else 0
+        distance += s * s * ((3 * rx) ^ ry)
+        if ry == 0:
+            if rx == 1:
+                x, y = n - 1 - x, n - 1 - y
+            x, y = y, x
+        s >>= 1
+    return ((1 << (2 * zoom)) - 1) // 3 + distance
+
+
+@dataclass(frozen=True)
+class Entry:
+    """
+    A directory entry: `run_length` tiles from `tile_id` with the same content, at
+    `offset` in the tile data, or with `run_length` 0, a leaf directory at
+    `offset` among the leaf directories
+    """
+
+    tile_id: int
+    offset: int
+    length: int
+    run_length: int
+
+
+@dataclass(frozen=True)
+class Header:
+    root_offset: int
+    root_length: int
+    metadata_offset: int
+    metadata_length: int
+    leaf_offset: int
+    leaf_length: int
+    tile_data_offset: int
+    tile_data_length: int
+    addressed_tiles: int
+    tile_entries: int
+    tile_contents: int
+    clustered: int
+    internal_compression: int
+    tile_compression: int
+    tile_type: int
+    min_zoom: int
+    max_zoom: int
+    # Bounds and centre in degrees times 10^7
+    min_lon_e7: int
+    min_lat_e7: int
+    max_lon_e7: int
+    max_lat_e7: int
+    center_zoom: int
+    center_lon_e7: int
+    center_lat_e7: int
+
+    layout = struct.Struct("<7sB11Q6B4iB2i")
+
+    def pack(self) -> bytes:
+        return self.layout.pack(b"PMTiles", 3, *astuple(self))
+
+    @classmethod
+    def unpack(cls, data: bytes) -> "Header":
+        magic, version, *fields = cls.layout.unpack(data[:HEADER_LENGTH])
+        if magic != b"PMTiles" or version != 3:
+            raise ValueError("Not a PMTiles v3 archive")
+        return cls(*fields)
+
+
+def write_varint(buffer: bytearray, value: int) -> None:
+    while value >= 0x80:
+        buffer.append((value & 0x7F) | 0x80)
+        value >>= 7
+    buffer.append(value)
+
+
+def read_varint(data: bytes, position: int) -> tuple[int, int]:
+    value = shift = 0
+    while True:
+        byte = data[position]
+        position += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return value, position
+        shift += 7
+
+
+def serialize_directory(entries: list[Entry]) -> bytes:
+    """
+    A gzipped directory: the entry count, then each column of the entries,
+    tile IDs as deltas and offsets as 0 where a tile follows the previous one
+    """
+    buffer = bytearray()
+    write_varint(buffer, len(entries))
+    last_id = 0
+    for entry in entries:
+        write_varint(buffer, entry.tile_id - last_id)
+        last_id = entry.tile_id
+    for entry in entries:
+        write_varint(buffer, entry.run_length)
+    for entry in entries:
+        write_varint(buffer, entry.length)
+    for index, entry in enumerate(entries):
+        previous = entries[index - 1] if index else None
+        write_varint(buffer, 0 if previous and entry.offset == previous.offset + previous.length else entry.offset + 1)
+    return gzip.compress(bytes(buffer), mtime=0)
+
+
+def deserialize_directory(data: bytes) -> list[Entry]:
+    data = gzip.decompress(data)
+    count, position = read_varint(data, 0)
+    tile_ids: list[int] = []
+    run_lengths: list[int] = []
+    lengths: list[int] = []
+    tile_id = 0
+    for column in (tile_ids, run_lengths, lengths):
+        for _ in range(count):
+            value, position = read_varint(data, position)
+            if column is tile_ids:
+                tile_id += value
+                value = tile_id
+            column.append(value)
+    entries: list[Entry] = []
+    for index in range(count):
+        value, position = read_varint(data, position)
+        offset = entries[-1].offset + entries[-1].length if value == 0 and entries else value - 1
+        entries.append(Entry(tile_ids[index], offset, lengths[index], run_lengths[index]))
+    return entries
+
+
+def build_directories(entries: list[Entry]) -> tuple[bytes, bytes]:
+    """
+    The root directory and leaf directories for the tile entries: only a root if
+    it fits in `ROOT_LENGTH`, otherwise a root of leaves of as few entries as fit
+    """
+    root = serialize_directory(entries)
+    leaf_size = 4096
+    while len(root) > ROOT_LENGTH:
+        root_entries: list[Entry] = []
+        leaves = bytearray()
+        for start in range(0, len(entries), leaf_size):
+            leaf = serialize_directory(entries[start : start + leaf_size])
+            root_entries.append(Entry(entries[start].tile_id, len(leaves), len(leaf), 0))
+            leaves += leaf
+        root = serialize_directory(root_entries)
+        if len(root) <= ROOT_LENGTH:
+            return root, bytes(leaves)
+        leaf_size *= 2
+    return root, b""
+
+
+class PMTilesWriter:
+    """
+    Write tiles to a PMTiles archive when the writer closes. Tiles are
+    `(zoom, x, y, content_id, data)` as for `MBTilesWriter`, `data` gzipped and
+    `content_id` identifying its content; until then the data of distinct
+    tiles is kept in a temporary file next to the archive. The archive is
+    written to another temporary file renamed over it, so processes serving
+    the previous archive (see `open_archive`) keep reading that one.
+    """
+
+    def __init__(self, path: str | Path):
+        self.path = Path(path)
+        self.data = tempfile.TemporaryFile(dir=self.path.parent)
+        # Offset and length in `data` by content ID
+        self.contents: dict[str, tuple[int, int]] = {}
+        # Content ID by tile ID
+        self.tiles: dict[int, str] = {}
+        self.metadata: dict[str, Any] = {}
+
+    def __enter__(self) -> "PMTilesWriter":
+        return self
+
+    def __exit__(self, exc_type, *exc) -> None:
+        try:
+            if exc_type is None:
+                self.finish()
+        finally:
+            self.data.close()
+
+    def write(self, tiles: Iterable[tuple[int, int, int, str, bytes]]) -> None:
+        for zoom, x, y, content_id, data in tiles:
+            if content_id not in self.contents:
+                self.contents[content_id] = (self.data.tell(), len(data))
+                self.data.write(data)
+            self.tiles[zxy_to_tileid(zoom, x, y)] = content_id
+
+    def set_metadata(self, metadata: dict[str, Any]) -> None:
+        """
+        Take the metadata of an MBTiles file (see `tileset_metadata`): bounds,
+        centre and zooms go in the header, the rest in the JSON metadata
+        """
+        self.metadata.update(metadata)
+
+    def finish(self) -> None:
+        # Lay out the tile data in tile ID order, each content once
+        entries: list[Entry] = []
+        offsets: dict[str, int] = {}
+        tile_data_length = 0
+        for tile_id in sorted(self.tiles):
+            content_id = self.tiles[tile_id]
+            length = self.contents[content_id][1]
+            if content_id not in offsets:
+                offsets[content_id] = tile_data_length
+                tile_data_length += length
+            last = entries[-1] if entries else None
+            if last and last.offset == offsets[content_id] and tile_id == last.tile_id + last.run_length:
+                entries[-1] = replace(last, run_length=last.run_length + 1)
+            else:
+                entries.append(Entry(tile_id, offsets[content_id], length, 1))
+
+        root, leaves = build_directories(entries)
+        metadata = dict(self.metadata)
+        west, south, east, north = (float(value) for value in metadata.pop("bounds", "-180,-85.0511287798066,180,85.0511287798066").split(","))
+        minzoom, maxzoom = int(metadata.pop("minzoom", 0)), int(metadata.pop("maxzoom", 14))
+        center_lon, center_lat, center_zoom = (float(value) for value in metadata.pop("center", f"{(west + east) / 2},{(south + north) / 2},{minzoom}").split(","))
+        metadata.update(json.loads(metadata.pop("json", "{}")))
+        metadata_bytes = gzip.compress(json.dumps(metadata).encode(), mtime=0)
+
+        header = Header(
+            root_offset=HEADER_LENGTH,
+            root_length=len(root),
+            metadata_offset=HEADER_LENGTH + len(root),
+            metadata_length=len(metadata_bytes),
+            leaf_offset=HEADER_LENGTH + len(root) + len(metadata_bytes),
+            leaf_length=len(leaves),
+            tile_data_offset=HEADER_LENGTH + len(root) + len(metadata_bytes) + len(leaves),
+            tile_data_length=tile_data_length,
+            addressed_tiles=len(self.tiles),
+            tile_entries=len(entries),
+            tile_contents=len(offsets),
+            clustered=1,
+            internal_compression=COMPRESSION_GZIP,
+            tile_compression=COMPRESSION_GZIP,
+            tile_type=TILE_TYPE_MVT,
+            min_zoom=minzoom,
+            max_zoom=maxzoom,
+            min_lon_e7=round(west * 1e7),
+            min_lat_e7=round(south * 1e7),
+            max_lon_e7=round(east * 1e7),
+            max_lat_e7=round(north * 1e7),
+            center_zoom=int(center_zoom),
+            center_lon_e7=round(center_lon * 1e7),
+            center_lat_e7=round(center_lat * 1e7),
+        )
+        descriptor, temporary = tempfile.mkstemp(dir=self.path.parent, prefix=f".{self.path.name}.")
+        try:
+            with open(descriptor, "wb") as archive:
+                # Readable by the web server, as `mkstemp` makes files only their owner can read
+                os.fchmod(archive.fileno(), 0o644)
+                archive.write(header.pack())
+                archive.write(root)
+                archive.write(metadata_bytes)
+                archive.write(leaves)
+                for content_id in offsets:
+                    offset, length = self.contents[content_id]
+                    self.data.seek(offset)
+                    archive.write(self.data.read(length))
+            os.replace(temporary, self.path)
+        finally:
+            Path(temporary).unlink(missing_ok=True)
+
+
+class PMTilesReader:
+    """
+    Read tiles from a PMTiles archive through a memory map. The root directory
+    is parsed once and the last `leaf_cache_size` leaf directories are kept.
+    """
+
+    def __init__(self, path: str | Path, leaf_cache_size: int = 64):
+        with open(path, "rb") as archive:
+            self.mmap = mmap.mmap(archive.fileno(), 0, access=mmap.ACCESS_READ)
+        self.header = Header.unpack(self.mmap[:HEADER_LENGTH])
+        self.root = self.directory(self.header.root_offset, self.header.root_length)
+        self.leaf = lru_cache(maxsize=leaf_cache_size)(self._leaf)
+
+    def directory(self, offset: int, length: int) -> list[Entry]:
+        return deserialize_directory(self.mmap[offset : offset + length])
+
+    def _leaf(self, offset: int, length: int) -> list[Entry]:
+        return self.directory(self.header.leaf_offset + offset, length)
+
+    @property
+    def metadata(self) -> dict[str, Any]:
+        offset = self.header.metadata_offset
+        return json.loads(gzip.decompress(self.mmap[offset : offset + self.header.metadata_length]))
+
+    def get(self, zoom: int, x: int, y: int) -> bytes | None:
+        """
+        The compressed data of a tile, or None for tiles not in the archive
+        """
+        if not self.header.min_zoom <= zoom <= self.header.max_zoom:
+            return None
+        tile_id = zxy_to_tileid(zoom, x, y)
+        entries = self.root
+        # The spec allows at most three levels of directories
+        for _ in range(3):
+            index = bisect_right(entries, tile_id, key=lambda entry: entry.tile_id) - 1
+            if index < 0:
+                return None
+            entry = entries[index]
+            if entry.run_length == 0:
+                entries = self.leaf(entry.offset, entry.length)
+                continue
+            if tile_id >= entry.tile_id + entry.run_length:
+                return None
+            offset = self.header.tile_data_offset + entry.offset
+            return self.mmap[offset : offset + entry.length]
+        return None
+
+
+@cache
+def open_archive(path: str) -> PMTilesReader:
+    """
+    The reader of an archive, shared by the requests of this process
+    """
+    return PMTilesReader(path)
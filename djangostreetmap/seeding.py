@@ -0,0 +1,167 @@
+"""
+Pre-rendering tiles
+
+The tiles covering an area (`tile_cover`), and rendering them with the views
+which serve them, into the views' `tilecache` (`render_tiles`), as the
+`seed_tiles` command does with a pool of worker processes, or the
+`tile_worker` command does with blocks of tiles (`tile_blocks`) from the
+`TileJob` queue. `render_tile_data` renders tiles for export instead, as
+`export_mbtiles` does.
+"""
+
+import gzip
+import math
+import os
+from collections.abc import Iterable, Iterator, Sequence
+from pathlib import Path
+
+import django
+from django.apps import apps
+from django.contrib.gis.geos import GEOSGeometry, Polygon
+from django.utils.module_loading import import_string
+
+from djangostreetmap.cache import content_digest
+from djangostreetmap.tilegenerator import Tile
+
+# Half the width of the EPSG:3857 square, in metres
+HALF_WORLD = 20037508.342789244
+# Web mercator stops short of the poles
+MAX_LATITUDE = 85.0511287798066
+
+
+def lonlat_to_tile(lon: float, lat: float, zoom: int) -> tuple[int, int]:
+    """
+    The x and y of the tile containing a point at a zoom level
+    """
+    lat = max(-MAX_LATITUDE, min(MAX_LATITUDE, lat))
+    n = 2**zoom
+    x = int((lon + 180) / 360 * n)
+    y = int((1 - math.asinh(math.tan(math.radians(lat))) / math.pi) / 2 * n)
+    return min(max(x, 0), n - 1), min(max(y, 0), n - 1)
+
+
+def tile_bounds(zoom: int, x: int, y: int) -> tuple[float, float, float, float]:
+    """
+    The EPSG:3857 extent of a tile as (xmin, ymin, xmax, ymax), like `ST_TileEnvelope`
+    """
+    size = 2 * HALF_WORLD / 2**zoom
+    return (-HALF_WORLD + x * size, HALF_WORLD - (y + 1) * size, -HALF_WORLD + (x + 1) * size, HALF_WORLD - y * size)
+
+
+def tile_cover(bbox: tuple[float, float, float, float], zoom: int, geometry=None) -> Iterator[tuple[int, int, int]]:
+    """
+    The (zoom, x, y) of the tiles overlapping a longitude / latitude bbox
+    (west, south, east, north), in x then y order. With a `geometry` (a GEOS
+    geometry in EPSG:3857), only the tiles which intersect it.
+    """
+    west, south, east, north = bbox
+    xmin, ymin = lonlat_to_tile(west, north, zoom)
+    xmax, ymax = lonlat_to_tile(east, south, zoom)
+    prepared = geometry.prepared if geometry is not None else None
+    for x in range(xmin, xmax + 1):
+        for y in range(ymin, ymax + 1):
+            if prepared is None or prepared.intersects(Polygon.from_bbox(tile_bounds(zoom, x, y))):
+                yield zoom, x, y
+
+
+def tile_count(bbox: tuple[float, float, float, float], zoom: int, geometry=None) -> int:
+    """
+    The number of tiles overlapping a bbox at a zoom level, without listing them
+    unless only those intersecting a `geometry` count (see `tile_cover`)
+    """
+    if geometry is not None:
+        return sum(1 for _ in tile_cover(bbox, zoom, geometry))
+    xmin, ymin = lonlat_to_tile(bbox[0], bbox[3], zoom)
+    xmax, ymax = lonlat_to_tile(bbox[2], bbox[1], zoom)
+    return (xmax - xmin + 1) * (ymax - ymin + 1)
+
+
+def tile_blocks(bbox: tuple[float, float, float, float], zoom: int, size: int, geometry=None) -> Iterator[tuple[int, int, int, int]]:
+    """
+    Split the tiles overlapping a bbox at a zoom level into blocks of up to
+    `size` by `size` tiles, as (xmin, xmax, ymin, ymax). With a `geometry`
+    (in EPSG:3857), only the blocks which intersect it.
+    """
+    west, south, east, north = bbox
+    xmin, ymin = lonlat_to_tile(west, north, zoom)
+    xmax, ymax = lonlat_to_tile(east, south, zoom)
+    prepared = geometry.prepared if geometry is not None else None
+    for x in range(xmin, xmax + 1, size):
+        for y in range(ymin, ymax + 1, size):
+            block = (x, min(x + size - 1, xmax), y, min(y + size - 1, ymax))
+            if prepared is not None:
+                west_edge, south_edge, _, _ = tile_bounds(zoom, block[0], block[3])
+                _, _, east_edge, north_edge = tile_bounds(zoom, block[1], block[2])
+                if not prepared.intersects(Polygon.from_bbox((west_edge, south_edge, east_edge, north_edge))):
+                    continue
+            yield block
+
+
+def seed_area(bbox: str | None = None, geometry: str | None = None) -> tuple[tuple[float, float, float, float], GEOSGeometry | None]:
+    """
+    The area to seed from a "west,south,east,north" bbox or a WKT or GeoJSON
+    geometry (or a file containing one, in longitude and latitude unless it has
+    an SRID), as a bbox in longitude and latitude and the geometry in EPSG:3857
+    """
+    if geometry:
+        if os.path.exists(geometry):
+            geometry = Path(geometry).read_text()
+        shape = GEOSGeometry(geometry)
+        if not shape.srid:
+            shape.srid = 4326
+        return shape.transform(4326, clone=True).extent, shape.transform(3857, clone=True)
+    if bbox:
+        west, south, east, north = (float(value) for value in bbox.split(","))
+        return (west, south, east, north), None
+    raise ValueError("Give the area to seed as a bbox or a geometry")
+
+
+def setup_worker() -> None:
+    """
+    Initialise a worker process: processes started with "spawn" have not set up Django,
+    and each one opens its own database connection on first use
+    """
+    if not apps.ready:
+        django.setup()
+
+
+def render_tiles(view_path: str, tiles: Iterable[tuple[int, int, int]]) -> tuple[int, int]:
+    """
+    Render tiles with a tile view (by dotted path), which stores them in its
+    `tilecache`, returning the number of tiles and their total size in bytes.
+    Tiles which are already cached and fresh are not rendered again, stale ones
+    are. Raises `TileIncomplete` when a layer of a tile fails.
+    """
+    # Render stale layers now rather than in the background
+    view = import_string(view_path)(cache_stale_while_revalidate=False)
+    count = size = 0
+    for zoom, x, y in tiles:
+        content = view._generate_tile(Tile(zoom=zoom, x=x, y=y), strict=True)
+        count += 1
+        size += sum(len(part) for part in content)
+    return count, size
+
+
+def render_tile_data(view_paths: Sequence[str], tiles: Iterable[tuple[int, int, int]]) -> list[tuple[int, int, int, str, bytes]]:
+    """
+    Render tiles for export with tile views (by dotted path), the layers of all
+    views in one tile, as `(zoom, x, y, tile_id, data)`: `data` gzipped and
+    `tile_id` the tile's `content_digest`, as in a `ContentAddressedTileCache`
+    and the tile's ETag. Empty tiles are left out. Tiles are rendered from the
+    database rather than the views' `tilecache`, which may hold stale tiles, and
+    `TileIncomplete` is raised when a layer fails.
+    """
+    views = [import_string(path)(tilecache=None) for path in view_paths]
+    compressed: dict[str, bytes] = {}
+    rendered = []
+    for zoom, x, y in tiles:
+        tile = Tile(zoom=zoom, x=x, y=y)
+        content = b"".join(part for view in views for part in view._generate_tile(tile, strict=True))
+        if not content:
+            continue
+        tile_id = content_digest(content)
+        if tile_id not in compressed:
+            # Without a timestamp, identical tiles compress to identical bytes
+            compressed[tile_id] = gzip.compress(content, mtime=0)
+        rendered.append((zoom, x, y, tile_id, compressed[tile_id]))
+    return rendered
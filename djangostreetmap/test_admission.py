@@ -0,0 +1,60 @@
+"""Tests for tile query admission control in `djangostreetmap.admission`."""
+
+import asyncio
+import threading
+
+from django.test import SimpleTestCase
+
+from djangostreetmap.admission import ALL_LAYERS, TileOverloaded, admit, async_admit
+
+
+class AdmitTests(SimpleTestCase):
+    def test_rejects_when_full(self):
+        with admit([("roads", 1), (ALL_LAYERS, 5)], timeout=0):
+            with self.assertRaises(TileOverloaded):
+                with admit([("roads", 1), (ALL_LAYERS, 5)], timeout=0.01):
+                    pass
+            # Other layers still have room
+            with admit([("land", 1), (ALL_LAYERS, 5)], timeout=0):
+                pass
+
+    def test_slots_released_on_rejection(self):
+        with admit([(ALL_LAYERS, 1)], timeout=0):
+            with self.assertRaises(TileOverloaded):
+                with admit([("buildings", 1), (ALL_LAYERS, 1)], timeout=0):
+                    pass
+        # The "buildings" slot taken before the rejection was given back
+        with admit([("buildings", 1)], timeout=0):
+            pass
+
+    def test_waits_for_a_slot(self):
+        holding = threading.Event()
+
+        def hold():
+            with admit([("poi", 1)], timeout=0):
+                holding.set()
+                threading.Event().wait(0.05)
+
+        thread = threading.Thread(target=hold)
+        thread.start()
+        holding.wait()
+        with admit([("poi", 1)], timeout=5):
+            pass
+        thread.join()
+
+    def test_unbounded(self):
+        with admit([("roads", None), (ALL_LAYERS, None)], timeout=0):
+            pass
+
+
+class AsyncAdmitTests(SimpleTestCase):
+    def test_rejects_when_full(self):
+        async def main():
+            async with async_admit([("roads", 1)], timeout=0):
+                with self.assertRaises(TileOverloaded):
+                    async with async_admit([("roads", 1)], timeout=0.01):
+                        pass
+            async with async_admit([("roads", 1)], timeout=0):
+                pass
+
+        asyncio.run(main())
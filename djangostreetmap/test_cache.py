@@ -0,0 +1,325 @@
+"""Tests for the tile cache implementations in `djangostreetmap.cache`.
+
+The outer tier is a local-memory Django cache, so no external services are needed.
+"""
+
+import os
+import time
+from tempfile import TemporaryDirectory
+
+from django.core.cache.backends.locmem import LocMemCache
+from django.test import SimpleTestCase
+
+from djangostreetmap.cache import ContentAddressedTileCache, FileTileCache, LayerVersions, TieredTileCache, content_digest, get_many, set_many, tile_cache_key
+from djangostreetmap.coalesce import CacheLock
+from djangostreetmap.tilegenerator import Tile
+
+
+class DictCache:
+    """A `TileCache` with only `get` and `set`"""
+
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key, default=None, version=None):
+        return self.data.get(key, default)
+
+    def set(self, key, value, timeout=300, version=None):
+        self.data[key] = value
+
+
+class BatchAccessTests(SimpleTestCase):
+    def test_fallback_to_get_and_set(self):
+        cache = DictCache()
+        set_many(cache, {"a": b"1", "b": b"2"})
+        self.assertEqual(get_many(cache, ["a", "b", "c"]), {"a": b"1", "b": b"2"})
+
+    def test_django_cache(self):
+        cache = LocMemCache("batch", {})
+        set_many(cache, {"a": b"1", "b": b"2"})
+        self.assertEqual(get_many(cache, ["a", "b", "c"]), {"a": b"1", "b": b"2"})
+
+    def test_tiered_cache_reads_missing_keys_from_outer_tier(self):
+        outer = DictCache()
+        outer.set("b", b"2")
+        cache = TieredTileCache(outer)
+        cache.set("a", b"1")
+        self.assertEqual(cache.get_many(["a", "b", "c"]), {"a": b"1", "b": b"2"})
+        self.assertEqual(cache.get_many(["b"]), {"b": b"2"})
+        self.assertEqual(cache.hits, 2)
+
+
+class TieredTileCacheTests(SimpleTestCase):
+    def setUp(self):
+        self.outer = LocMemCache("outer", {})
+        self.cache = TieredTileCache(self.outer, max_bytes=1024)
+
+    def test_write_through_and_local_hit(self):
+        self.cache.set("a", b"tile")
+        self.assertEqual(self.outer.get("a"), b"tile")
+        self.assertEqual(self.cache.get("a"), b"tile")
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 0))
+
+    def test_outer_hit_is_promoted(self):
+        self.outer.set("a", b"tile")
+        self.assertEqual(self.cache.get("a"), b"tile")
+        self.assertEqual(self.cache.get("a"), b"tile")
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+
+    def test_miss(self):
+        self.assertIsNone(self.cache.get("a"))
+        self.assertEqual(self.cache.misses, 1)
+
+    def test_evicts_least_recently_used(self):
+        for key in "abcd":
+            self.cache.set(key, bytes(250))
+        self.cache.get("a")  # Refresh "a" so that "b" is the oldest
+        self.cache.set("e", bytes(250))
+        self.assertEqual(self.cache.size, 1000)
+        self.assertEqual(list(self.cache._entries), ["c", "d", "a", "e"])
+        self.assertEqual(self.cache.evictions, 1)
+
+    def test_too_large_for_memory(self):
+        self.cache.set("a", bytes(2048))
+        self.assertEqual(self.cache.size, 0)
+        self.assertEqual(self.cache.get("a"), bytes(2048))
+
+    def test_expires_with_outer_timeout(self):
+        self.cache.set("a", b"tile", timeout=0.05)
+        time.sleep(0.1)
+        self.assertIsNone(self.cache._local_get("a"))
+
+    def test_promoted_tiles_expire_with_promoted_ttl(self):
+        cache = TieredTileCache(self.outer, promoted_ttl=0.05)
+        self.outer.set("a", b"tile", timeout=3600)
+        self.assertEqual(cache.get("a"), b"tile")
+        self.assertEqual(cache._local_get("a"), b"tile")
+        time.sleep(0.1)
+        self.assertIsNone(cache._local_get("a"))
+
+    def test_promoted_ttl_capped_by_max_ttl(self):
+        cache = TieredTileCache(self.outer, promoted_ttl=3600, max_ttl=0.05)
+        self.outer.set("a", b"tile")
+        cache.get_many(["a"])
+        time.sleep(0.1)
+        self.assertIsNone(cache._local_get("a"))
+
+    def test_fresh_markers_are_not_promoted(self):
+        self.outer.set("a:fresh", b"1", timeout=0.05)
+        self.assertEqual(self.cache.get_many(["a:fresh"]), {"a:fresh": b"1"})
+        self.assertEqual(self.cache.get("a:fresh"), b"1")
+        self.assertIsNone(self.cache._local_get("a:fresh"))
+        time.sleep(0.1)
+        # Expired in the shared cache, so no longer fresh here either
+        self.assertIsNone(self.cache.get("a:fresh"))
+
+    def test_max_ttl(self):
+        cache = TieredTileCache(None, max_ttl=0.05)
+        cache.set("a", b"tile", timeout=None)
+        time.sleep(0.1)
+        self.assertIsNone(cache.get("a"))
+
+    def test_lock_tokens_stay_in_outer_tier(self):
+        self.assertTrue(CacheLock.supported(self.cache))
+        lock = CacheLock(self.cache, "a:lock")
+        self.assertTrue(lock.acquire())
+        self.assertEqual(self.cache.get("a:lock"), lock.token)
+        lock.release()
+        self.assertIsNone(self.cache.get("a:lock"))
+
+
+def wait_for_cull(cache: FileTileCache) -> None:
+    for _ in range(100):
+        if not cache._culling:
+            return
+        time.sleep(0.01)
+
+
+class FileTileCacheTests(SimpleTestCase):
+    def setUp(self):
+        directory = TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        self.cache = FileTileCache(directory.name, max_bytes=1000)
+
+    def test_tiles_stored_as_they_are(self):
+        key = "tile:school@1.0:8/216/134:4096:64"
+        self.cache.set(key, b"tile")
+        self.assertEqual(self.cache.get(key), b"tile")
+        path = self.cache.file(key)
+        self.assertEqual(os.path.relpath(path, self.directory), "tile/school@1.0/8/216/134_4096_64")
+        self.assertEqual(path.read_bytes(), b"tile")
+        self.assertEqual(get_many(self.cache, [key, f"{key}:fresh"]), {key: b"tile"})
+
+    def test_other_values(self):
+        self.cache.set("tile-version:roads", 3)
+        self.assertEqual(self.cache.get("tile-version:roads"), 3)
+        self.assertIsNone(self.cache.file("tile-version:roads"))
+        self.assertIsNone(self.cache.get("missing"))
+
+    def test_expiry(self):
+        self.cache.set("a", b"tile", timeout=0.05)
+        time.sleep(0.1)
+        self.assertIsNone(self.cache.get("a"))
+        self.assertIsNone(self.cache.file("a"))
+
+    def test_lock(self):
+        self.assertTrue(CacheLock.supported(self.cache))
+        lock = CacheLock(self.cache, "a:lock")
+        self.assertTrue(lock.acquire())
+        self.assertFalse(CacheLock(self.cache, "a:lock").acquire())
+        lock.release()
+        self.assertTrue(CacheLock(self.cache, "a:lock").acquire())
+
+    def test_culls_soonest_expiring(self):
+        for index in range(12):
+            self.cache.set(f"tile:roads@1.0:10/{index}/0:4096:64", bytes(100), timeout=100 + index)
+        self.assertLessEqual(self.cache.cull(), 1000)
+        self.assertIsNone(self.cache.get("tile:roads@1.0:10/0/0:4096:64"))
+        self.assertEqual(self.cache.get("tile:roads@1.0:10/11/0:4096:64"), bytes(100))
+
+    def test_running_total(self):
+        self.cache.set("a", bytes(100))
+        # The first write measures the directory in the background
+        wait_for_cull(self.cache)
+        self.assertEqual(self.cache._size, 100)
+        self.cache.set("a", bytes(300))
+        self.cache.set("b", {"not": "bytes"})
+        self.cache.delete("b")
+        self.assertEqual(self.cache._size, 300)
+        # Another process starts from what is on disk
+        other = FileTileCache(self.directory, max_bytes=1000)
+        other.set("c", bytes(50))
+        wait_for_cull(other)
+        self.assertEqual(other._size, 350)
+
+    def test_limit_shared_between_processes(self):
+        self.cache.set("a", bytes(100))
+        wait_for_cull(self.cache)
+        other = FileTileCache(self.directory, max_bytes=1000)
+        other.set("b", bytes(950))
+        wait_for_cull(other)
+        # This process only counted its own write, until it measures the directory again
+        self.cache.remeasure_interval = 0
+        self.cache.set("c", bytes(10))
+        wait_for_cull(self.cache)
+        self.assertLessEqual(sum(file_size for _, file_size, _ in self.cache._stats()), 900)
+
+    def test_files_deleted_during_a_scan_are_skipped(self):
+        for y in range(2):
+            self.cache.set(f"tile:roads@1.0:10/0/{y}:4096:64", b"tile")
+        wait_for_cull(self.cache)
+        stats = self.cache._stats()
+        _, _, scanned = next(stats)
+        for y in range(2):
+            if str(self.cache.file(f"tile:roads@1.0:10/0/{y}:4096:64")) != scanned:
+                self.cache.delete(f"tile:roads@1.0:10/0/{y}:4096:64")
+        self.assertEqual(list(stats), [])
+
+    def test_culls_in_the_background(self):
+        for index in range(12):
+            self.cache.set(f"tile:roads@1.0:10/{index}/0:4096:64", bytes(100), timeout=100 + index)
+        wait_for_cull(self.cache)
+        on_disk = sum(file_size for _, file_size, _ in self.cache._stats())
+        # Down to 900 bytes, plus the writes made after the scan which did not take it over the limit
+        self.assertLessEqual(on_disk, 1000)
+        # Writes made during the scan may be counted twice, until the next cull
+        self.assertTrue(on_disk <= self.cache._size <= 1000)
+        self.assertIsNone(self.cache.get("tile:roads@1.0:10/0/0:4096:64"))
+        self.assertEqual(self.cache.get("tile:roads@1.0:10/11/0:4096:64"), bytes(100))
+
+
+class ContentAddressedTileCacheTests(SimpleTestCase):
+    def setUp(self):
+        self.inner = LocMemCache("content-addressed", {})
+        self.cache = ContentAddressedTileCache(self.inner)
+
+    def test_identical_tiles_stored_once(self):
+        self.cache.set_many({"sea-1": b"sea", "sea-2": b"sea", "land": b"land"})
+        self.cache.set("sea-3", b"sea")
+        self.assertEqual(self.cache.stats, {"writes": 2, "deduplicated": 2})
+        self.assertEqual(self.cache.get_many(["sea-1", "sea-3", "land", "missing"]), {"sea-1": b"sea", "sea-3": b"sea", "land": b"land"})
+        self.assertEqual(self.inner.get("sea-2"), f"content:{content_digest(b'sea')}")
+        self.assertEqual(self.inner.get(f"tile-content:{content_digest(b'sea')}"), b"sea")
+        self.assertEqual(self.cache.digest("sea-2"), content_digest(b"sea"))
+
+    def test_evicted_content_is_a_miss_and_written_again(self):
+        self.cache.set("sea-1", b"sea")
+        self.inner.delete(f"tile-content:{content_digest(b'sea')}")
+        self.assertIsNone(self.cache.get("sea-1"))
+        self.cache.set("sea-1", b"sea")
+        self.assertEqual(self.cache.get("sea-1"), b"sea")
+
+    def test_references_to_culled_content_are_deleted(self):
+        with TemporaryDirectory() as directory:
+            files = FileTileCache(directory, max_bytes=10000)
+            # Contents expire first, so the cull deletes them and keeps the references
+            cache = ContentAddressedTileCache(files, content_timeout=100)
+            cache.set_many({"sea-1": bytes(200), "sea-2": bytes(200), "land": bytes(300)}, timeout=3600)
+            files.max_bytes = 400
+            files.cull()
+            files.max_bytes = None
+            self.assertEqual(files.get("sea-1"), f"content:{content_digest(bytes(200))}")
+            self.assertIsNone(cache.get("sea-1"))
+            self.assertEqual(cache.get_many(["sea-2", "land"]), {})
+            self.assertEqual([files.get(key) for key in ("sea-1", "sea-2", "land")], [None, None, None])
+            # The content is written again rather than assumed to be there
+            cache.set("sea-1", bytes(200))
+            self.assertEqual(cache.get("sea-1"), bytes(200))
+            self.assertEqual(cache.writes, 3)
+
+    def test_other_values_and_locks(self):
+        self.assertTrue(CacheLock.supported(self.cache))
+        lock = CacheLock(self.cache, "a:lock")
+        self.assertTrue(lock.acquire())
+        self.assertEqual(self.cache.get("a:lock"), lock.token)
+        lock.release()
+        self.assertIsNone(self.cache.get("a:lock"))
+
+    def test_file(self):
+        with TemporaryDirectory() as directory:
+            cache = ContentAddressedTileCache(FileTileCache(directory))
+            cache.set_many({"tile:land@1.0:1/0/0:4096:64": b"sea", "tile:land@1.0:1/1/0:4096:64": b"sea"})
+            self.assertEqual(cache.file("tile:land@1.0:1/0/0:4096:64"), cache.file("tile:land@1.0:1/1/0:4096:64"))
+            self.assertEqual(cache.file("tile:land@1.0:1/0/0:4096:64").read_bytes(), b"sea")
+            self.assertIsNone(cache.file("tile:land@1.0:1/0/1:4096:64"))
+
+
+class TileCacheKeyTests(SimpleTestCase):
+    def test_structured_key(self):
+        key = tile_cache_key("tile", [("transportation", "1.0")], Tile(zoom=14, x=14891, y=8624))
+        self.assertEqual(key, "tile:transportation@1.0:14/14891/8624:4096:64")
+
+    def test_whole_tile_key(self):
+        key = tile_cache_key("tile", [("land", "1.0"), ("school", "1.2")], Tile(zoom=3, x=1, y=2))
+        self.assertEqual(key, "tile:land@1.0+school@1.2:3/1/2:4096:64")
+
+    def test_query_params_are_part_of_the_key(self):
+        tile = Tile(zoom=3, x=1, y=2)
+        primary = tile_cache_key("tile", [("roads", "1.0")], tile, {"roads_param_0": "primary"})
+        track = tile_cache_key("tile", [("roads", "1.0")], tile, {"roads_param_0": "track"})
+        self.assertNotEqual(primary, track)
+
+    def test_unsafe_layer_names_are_hashed(self):
+        key = tile_cache_key("tile", [("my layer", "1.0")], Tile(zoom=3, x=1, y=2))
+        self.assertNotIn(" ", key)
+        self.assertEqual(len(key), len("tile:") + 64)
+
+
+class LayerVersionsTests(SimpleTestCase):
+    def test_bump(self):
+        versions = LayerVersions(LocMemCache("versions-bump", {}), ttl=60)
+        self.assertEqual(versions.get("land"), 0)
+        self.assertEqual(versions.bump("land"), 1)
+        self.assertEqual(versions.bump("land"), 2)
+        self.assertEqual(versions.get("land"), 2)
+        self.assertEqual(versions.get("school"), 0)
+
+    def test_bump_seen_by_other_processes_after_ttl(self):
+        cache = LocMemCache("versions-ttl", {})
+        reader = LayerVersions(cache, ttl=0.05)
+        self.assertEqual(reader.get("land"), 0)
+        LayerVersions(cache).bump("land")
+        self.assertEqual(reader.get("land"), 0)
+        time.sleep(0.1)
+        self.assertEqual(reader.get("land"), 1)
@@ -0,0 +1,142 @@
+"""Tests for request coalescing in `djangostreetmap.coalesce`.
+
+These don't touch the database: the in-process tests use threads / coroutines
+around a slow function, and the cross-process lock uses a local-memory cache.
+"""
+
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.cache.backends.locmem import LocMemCache
+from django.test import SimpleTestCase
+
+from djangostreetmap.coalesce import AsyncSingleFlight, CacheLock, SingleFlight
+
+
+class SingleFlightTests(SimpleTestCase):
+    def test_concurrent_calls_share_one_result(self):
+        flight: SingleFlight[int] = SingleFlight()
+        calls = []
+        started = threading.Event()
+
+        def render():
+            calls.append(1)
+            started.set()
+            time.sleep(0.2)
+            return 42
+
+        with ThreadPoolExecutor(max_workers=5) as executor:
+            first = executor.submit(flight.do, "roads/10/1/1", render)
+            started.wait()
+            duplicates = [executor.submit(flight.do, "roads/10/1/1", render) for _ in range(4)]
+            results = [first.result()] + [d.result() for d in duplicates]
+
+        self.assertEqual(results, [42] * 5)
+        self.assertEqual(len(calls), 1)
+
+    def test_exception_is_shared_and_key_released(self):
+        flight: SingleFlight[int] = SingleFlight()
+
+        def fail():
+            raise RuntimeError("database went away")
+
+        with self.assertRaises(RuntimeError):
+            flight.do("roads/10/1/1", fail)
+        self.assertEqual(flight.do("roads/10/1/1", lambda: 1), 1)
+
+
+class AsyncSingleFlightTests(SimpleTestCase):
+    def test_concurrent_calls_share_one_result(self):
+        flight: AsyncSingleFlight[int] = AsyncSingleFlight()
+        calls = []
+
+        async def render():
+            calls.append(1)
+            await asyncio.sleep(0.05)
+            return 42
+
+        async def main():
+            return await asyncio.gather(*(flight.do("roads/10/1/1", render) for _ in range(5)))
+
+        self.assertEqual(asyncio.run(main()), [42] * 5)
+        self.assertEqual(len(calls), 1)
+
+    def test_cancelled_leader_does_not_cancel_followers(self):
+        flight: AsyncSingleFlight[int] = AsyncSingleFlight()
+        calls = []
+
+        async def render():
+            calls.append(1)
+            await asyncio.sleep(0.05)
+            return 42
+
+        async def main():
+            leader = asyncio.create_task(flight.do("roads/10/1/1", render))
+            await asyncio.sleep(0)
+            follower = asyncio.create_task(flight.do("roads/10/1/1", render))
+            await asyncio.sleep(0)
+            # The leader's client disconnects
+            leader.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await leader
+            return await follower
+
+        self.assertEqual(asyncio.run(main()), 42)
+        self.assertEqual(len(calls), 1)
+
+    def test_exception_is_shared_and_key_released(self):
+        flight: AsyncSingleFlight[int] = AsyncSingleFlight()
+
+        async def render():
+            raise ValueError("broken layer")
+
+        async def main():
+            return await asyncio.gather(*(flight.do("roads/10/1/1", render) for _ in range(3)), return_exceptions=True)
+
+        self.assertTrue(all(isinstance(result, ValueError) for result in asyncio.run(main())))
+        self.assertEqual(flight._calls, {})
+
+
+class CacheLockTests(SimpleTestCase):
+    def setUp(self):
+        self.cache = LocMemCache("coalesce", {})
+
+    def test_only_one_holder(self):
+        first = CacheLock(self.cache, "tile:lock")
+        second = CacheLock(self.cache, "tile:lock")
+        self.assertTrue(first.acquire())
+        self.assertFalse(second.acquire())
+        first.release()
+        self.assertTrue(second.acquire())
+
+    def test_waiter_receives_rendered_tile(self):
+        holder = CacheLock(self.cache, "tile:lock")
+        holder.acquire()
+
+        def render():
+            time.sleep(0.1)
+            self.cache.set("tile", b"mvt")
+            holder.release()
+
+        threading.Thread(target=render).start()
+        self.assertEqual(CacheLock(self.cache, "tile:lock", timeout=5).wait_for("tile"), b"mvt")
+
+    def test_waiter_ignores_value_rejected_by_read(self):
+        self.cache.set("tile", b"stale")
+        holder = CacheLock(self.cache, "tile:lock")
+        holder.acquire()
+
+        def render():
+            time.sleep(0.1)
+            self.cache.set_many({"tile": b"mvt", "tile:fresh": b"1"})
+            holder.release()
+
+        threading.Thread(target=render).start()
+        waiter = CacheLock(self.cache, "tile:lock", timeout=5)
+        self.assertEqual(waiter.wait_for("tile", read=lambda: self.cache.get("tile") if self.cache.get("tile:fresh") else None), b"mvt")
+
+    def test_supported(self):
+        self.assertTrue(CacheLock.supported(self.cache))
+        self.assertFalse(CacheLock.supported(object()))
@@ -0,0 +1,51 @@
+"""Tests for running tile queries on psycopg2 or psycopg 3 (`djangostreetmap.driver`)."""
+
+from dataclasses import asdict
+from unittest import skipUnless
+
+from django.db import connection
+from django.test import SimpleTestCase, TestCase
+from psycopg import sql as psycopg_sql
+from psycopg2 import sql
+
+from djangostreetmap.driver import adapt_query, as_bytes, as_psycopg, binary_results, is_psycopg3
+from djangostreetmap.tilegenerator import MvtQuery, Tile
+
+port_moresby = Tile(zoom=14, x=14891, y=8624)
+
+
+class AsBytesTests(SimpleTestCase):
+    def test_bytes_are_not_copied(self):
+        content = b"\x1a\x02mvt"
+        self.assertIs(as_bytes(content), content)
+
+    def test_memoryview(self):
+        self.assertEqual(as_bytes(memoryview(b"mvt")), b"mvt")
+
+    def test_null(self):
+        self.assertEqual(as_bytes(None), b"")
+
+
+class AsPsycopgTests(SimpleTestCase):
+    def test_placeholders(self):
+        self.assertEqual(as_psycopg(sql.Placeholder("zoom")), psycopg_sql.Placeholder("zoom"))
+        self.assertEqual(as_psycopg(sql.Placeholder()), psycopg_sql.Placeholder())
+
+
+class BinaryResultTests(TestCase):
+    def test_client_side_binding_uses_text_results(self):
+        if connection.settings_dict["OPTIONS"].get("server_side_binding"):
+            self.skipTest("The connection uses server-side binding")
+        with connection.cursor() as cursor:
+            self.assertFalse(binary_results(cursor))
+
+    @skipUnless(is_psycopg3, "Binary results require psycopg 3")
+    def test_binary_tile(self):
+        import psycopg
+
+        connection.ensure_connection()
+        query = MvtQuery(table="osmflex_roadline", layer="roads", pk="osm_id")
+        with psycopg.Cursor(connection.connection) as cursor:
+            self.assertTrue(binary_results(cursor))
+            cursor.execute(adapt_query(query.as_mvt()), asdict(port_moresby))
+            self.assertIsInstance(as_bytes(cursor.fetchone()[0]), bytes)
@@ -0,0 +1,63 @@
+from dataclasses import asdict
+from io import StringIO
+
+from django.core.management import call_command
+from django.db import connection
+from django.test import SimpleTestCase, TestCase
+
+from djangostreetmap.generalisation import generalised_select
+from djangostreetmap.tilegenerator import MvtQuery, Tile, ZoomBand
+from djangostreetmap.views import LandLayer, Roads
+
+land = MvtQuery(
+    table="djangostreetmap_simplifiedlandpolygon",
+    layer="land",
+    zoom_bands=[ZoomBand(maxzoom=9, table="land_z9", simplify=1), ZoomBand(maxzoom=5, table="land_z5", dissolve=())],
+)
+
+
+class ZoomBandRoutingTests(SimpleTestCase):
+    def test_first_band_including_the_zoom(self):
+        self.assertEqual([land.for_zoom(zoom).table for zoom in (0, 5, 6, 9, 10)], ["land_z5", "land_z5", "land_z9", "land_z9", land.table])
+        self.assertIs(land.for_zoom(3), land.for_zoom(4))
+        self.assertIs(land.for_zoom(14), land)
+
+    def test_managed_bands_skipped(self):
+        unmanaged = MvtQuery(table=land.table, zoom_bands=[ZoomBand(maxzoom=5, table="land_z5"), ZoomBand(maxzoom=9, table="land_z9", managed=False)])
+        self.assertEqual([unmanaged.for_zoom(zoom, managed=False).table for zoom in (4, 9, 10)], ["land_z9", "land_z9", land.table])
+
+    def test_view_routes_layers(self):
+        self.assertEqual(LandLayer(generalised=True).get_query_layers(Tile(zoom=4, x=0, y=0))[0].table, "djangostreetmap_land_z5")
+        self.assertEqual(Roads(generalised=True).get_query_layers(Tile(zoom=7, x=0, y=0))[0].table, "djangostreetmap_roadline_z8")
+        self.assertEqual(Roads(generalised=True).get_query_layers(Tile(zoom=9, x=0, y=0))[0].table, "osmflex_roadline")
+
+    def test_generalised_tables_are_opt_in(self):
+        # They do not exist until `build_generalised_tables` has run
+        self.assertEqual(LandLayer().get_query_layers(Tile(zoom=4, x=0, y=0))[0].table, LandLayer.layers[0].table)
+        self.assertEqual(Roads().get_query_layers(Tile(zoom=7, x=0, y=0))[0].table, "osmflex_roadline")
+
+    def test_dissolve_keeps_the_attributes(self):
+        roads = MvtQuery(table="osmflex_roadline", attributes=["name", "osm_type"], pk="osm_id")
+        with self.assertRaises(ValueError):
+            generalised_select(roads, ZoomBand(maxzoom=8, table="roads_z8", dissolve=["osm_type"]))
+
+
+class BuildGeneralisedTablesTests(TestCase):
+    def test_build_and_serve(self):
+        output = StringIO()
+        call_command("build_generalised_tables", "djangostreetmap.views.LandLayer", "djangostreetmap.views.Roads", stdout=output)
+        self.assertEqual(output.getvalue().count("refreshed"), 3)
+        call_command("build_generalised_tables", "djangostreetmap.views.LandLayer", "--concurrently", stdout=output)
+
+        for view, tile in ((LandLayer(generalised=True), Tile(zoom=4, x=14, y=8)), (Roads(generalised=True), Tile(zoom=5, x=29, y=16))):
+            query_layer = view.get_query_layers(tile)[0]
+            self.assertIn(query_layer.table, ("djangostreetmap_land_z5", "djangostreetmap_roadline_z8"))
+            self.assertIsNotNone(view._fetch_layer(query_layer, asdict(tile)))
+
+    def test_print(self):
+        output = StringIO()
+        call_command("build_generalised_tables", "djangostreetmap.views.Roads", "--print", "--rebuild", stdout=output)
+        self.assertIn('DROP MATERIALIZED VIEW IF EXISTS "djangostreetmap_roadline_z8"', output.getvalue())
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT count(*) FROM pg_matviews WHERE matviewname = 'djangostreetmap_roadline_z8'")
+            self.assertEqual(cursor.fetchone()[0], 0)
@@ -0,0 +1,87 @@
+import gzip
+import json
+import sqlite3
+from io import StringIO
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+from django.contrib.gis.geos import Point
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.management import call_command
+from django.test import SimpleTestCase, TestCase
+
+from djangostreetmap.mbtiles import MBTilesWriter
+from djangostreetmap.tilegenerator import MvtQuery, Tile
+from djangostreetmap.views import TileIncomplete, TileLayerView
+from tests.models import BasicPoint
+
+
+class BasicPointLayer(TileLayerView):
+    """Test points"""
+
+    layers = [MvtQuery.from_model(BasicPoint)]
+
+
+class CachedPointLayer(BasicPointLayer):
+    tilecache = LocMemCache("cached-points", {})
+
+
+class FailingPointLayer(BasicPointLayer):
+    def _fetch_layer(self, query_layer, params):
+        return None
+
+
+class MBTilesWriterTests(SimpleTestCase):
+    def test_identical_tiles_stored_once(self):
+        with TemporaryDirectory() as directory:
+            path = Path(directory) / "tiles.mbtiles"
+            with MBTilesWriter(path) as writer:
+                writer.write([(1, 0, 0, "sea", b"sea"), (1, 1, 0, "sea", b"sea"), (1, 1, 1, "land", b"land")])
+            with sqlite3.connect(path) as connection:
+                self.assertEqual(connection.execute("SELECT COUNT(*) FROM images").fetchone()[0], 2)
+                # TMS rows: y=0 is the northernmost row, 1 at zoom 1
+                rows = connection.execute("SELECT zoom_level, tile_column, tile_row, tile_data FROM tiles ORDER BY tile_column, tile_row").fetchall()
+            self.assertEqual(rows, [(1, 0, 1, b"sea"), (1, 1, 0, b"land"), (1, 1, 1, b"sea")])
+
+
+class ExportMBTilesTests(TestCase):
+    def test_export(self):
+        BasicPoint.objects.create(name="Five Mile", geom=Point(147.2058, -9.4599))
+        with TemporaryDirectory() as directory:
+            path = Path(directory) / "points.mbtiles"
+            output = StringIO()
+            args = [str(path), "djangostreetmap.test_mbtiles.BasicPointLayer", "--bbox=146,-10,148,-9", "--maxzoom=6", "--processes=1", "--batch-size=2"]
+            call_command("export_mbtiles", *args, stdout=output)
+            self.assertIn("Exported 7 tiles (7 distinct", output.getvalue())
+            with sqlite3.connect(path) as connection:
+                metadata = dict(connection.execute("SELECT name, value FROM metadata"))
+                tile_data = connection.execute("SELECT tile_data FROM tiles WHERE zoom_level = 0").fetchone()[0]
+        self.assertEqual((metadata["name"], metadata["format"], metadata["minzoom"], metadata["maxzoom"]), ("points", "pbf", "0", "6"))
+        self.assertEqual(metadata["bounds"], "146.0,-10.0,148.0,-9.0")
+        self.assertEqual(
+            json.loads(metadata["json"])["vector_layers"], [{"id": "basicpoint", "fields": {"name": "String"}, "minzoom": 0, "maxzoom": 6, "description": "Test points"}]
+        )
+        self.assertIn(b"Five Mile", gzip.decompress(tile_data))
+
+    def test_export_bypasses_the_cache(self):
+        BasicPoint.objects.create(name="Five Mile", geom=Point(147.2058, -9.4599))
+        view, tile = CachedPointLayer(), Tile(zoom=0, x=0, y=0)
+        view.tilecache.set(view._cache_key(view.layers[0], tile), b"stale")
+        with TemporaryDirectory() as directory:
+            path = Path(directory) / "points.mbtiles"
+            call_command("export_mbtiles", str(path), "djangostreetmap.test_mbtiles.CachedPointLayer", "--bbox=146,-10,148,-9", "--maxzoom=0", "--processes=1", stdout=StringIO())
+            with sqlite3.connect(path) as connection:
+                tile_data = connection.execute("SELECT tile_data FROM tiles WHERE zoom_level = 0").fetchone()[0]
+        self.assertIn(b"Five Mile", gzip.decompress(tile_data))
+
+    def test_failed_layer_stops_the_export(self):
+        with TemporaryDirectory() as directory, self.assertRaises(TileIncomplete):
+            call_command(
+                "export_mbtiles",
+                str(Path(directory) / "points.mbtiles"),
+                "djangostreetmap.test_mbtiles.FailingPointLayer",
+                "--bbox=146,-10,148,-9",
+                "--maxzoom=0",
+                "--processes=1",
+                stdout=StringIO(),
+            )
@@ -0,0 +1,100 @@
+import gzip
+from io import StringIO
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from unittest import mock
+
+from django.contrib.gis.geos import Point
+from django.core.management import call_command
+from django.http import Http404
+from django.test import RequestFactory, SimpleTestCase, TestCase
+
+from djangostreetmap.pmtiles import PMTilesReader, PMTilesWriter, zxy_to_tileid
+from djangostreetmap.views import PMTilesView
+from tests.models import BasicPoint
+
+
+def write_archive(path: Path, maxzoom: int) -> dict[tuple[int, int, int], bytes]:
+    """
+    An archive of every tile up to `maxzoom`, most of them the same "sea" tile
+    """
+    contents = {}
+    tiles = []
+    for zoom in range(maxzoom + 1):
+        for x in range(2**zoom):
+            for y in range(2**zoom):
+                content = f"{zoom}/{x}/{y}".encode() if (x + y) % 3 == 0 else b"sea"
+                contents[(zoom, x, y)] = content
+                tiles.append((zoom, x, y, content.decode(), gzip.compress(content, mtime=0)))
+    with PMTilesWriter(path) as writer:
+        # In no particular order
+        writer.write(reversed(tiles))
+        writer.set_metadata({"name": "test", "bounds": "-180,-85,180,85", "minzoom": 0, "maxzoom": maxzoom, "json": '{"vector_layers": []}'})
+    return contents
+
+
+class PMTilesTests(SimpleTestCase):
+    def test_tile_ids(self):
+        self.assertEqual([zxy_to_tileid(*tile) for tile in [(0, 0, 0), (1, 0, 0), (1, 0, 1), (1, 1, 1), (1, 1, 0), (2, 0, 0)]], [0, 1, 2, 3, 4, 5])
+        self.assertEqual(zxy_to_tileid(12, 3423, 1763), 19078479)
+        with self.assertRaises(ValueError):
+            zxy_to_tileid(1, 2, 0)
+
+    def test_round_trip(self):
+        with TemporaryDirectory() as directory:
+            path = Path(directory) / "tiles.pmtiles"
+            contents = write_archive(path, 5)
+            reader = PMTilesReader(path)
+            self.assertEqual({tile: gzip.decompress(reader.get(*tile)) for tile in contents}, contents)
+            self.assertEqual((reader.header.addressed_tiles, reader.header.tile_contents, reader.header.leaf_length), (len(contents), 457, 0))
+            # Runs of "sea" share entries
+            self.assertLess(reader.header.tile_entries, len(contents))
+            self.assertEqual(reader.metadata, {"name": "test", "vector_layers": []})
+            self.assertIsNone(reader.get(6, 0, 0))
+
+    def test_leaf_directories(self):
+        with TemporaryDirectory() as directory, mock.patch("djangostreetmap.pmtiles.ROOT_LENGTH", 64):
+            path = Path(directory) / "tiles.pmtiles"
+            contents = write_archive(path, 6)
+            reader = PMTilesReader(path)
+            self.assertGreater(reader.header.leaf_length, 0)
+            self.assertEqual({tile: gzip.decompress(reader.get(*tile)) for tile in contents}, contents)
+
+    def test_replacing_an_archive_being_read(self):
+        with TemporaryDirectory() as directory:
+            path = Path(directory) / "tiles.pmtiles"
+            write_archive(path, 2)
+            reader = PMTilesReader(path)
+            contents = write_archive(path, 3)
+            # The archive already open is still whole
+            self.assertEqual(gzip.decompress(reader.get(2, 0, 0)), b"2/0/0")
+            self.assertIsNone(reader.get(3, 0, 0))
+            self.assertEqual(gzip.decompress(PMTilesReader(path).get(3, 0, 0)), contents[(3, 0, 0)])
+            self.assertEqual([file.name for file in Path(directory).iterdir()], ["tiles.pmtiles"])
+
+    def test_view(self):
+        with TemporaryDirectory() as directory:
+            path = Path(directory) / "tiles.pmtiles"
+            write_archive(path, 2)
+            view = PMTilesView.as_view(archive=str(path))
+            request = RequestFactory().get("/", headers={"Accept-Encoding": "gzip, br"})
+            response = view(request, zoom=2, x=1, y=2)
+            self.assertEqual((response["Content-Encoding"], gzip.decompress(response.content)), ("gzip", b"2/1/2"))
+            self.assertEqual(view(RequestFactory().get("/"), zoom=2, x=1, y=1).content, b"sea")
+            self.assertEqual(view(request, zoom=3, x=0, y=0).content, b"")
+            with self.assertRaises(Http404):
+                view(request, zoom=2, x=4, y=0)
+
+
+class ExportPMTilesTests(TestCase):
+    def test_export(self):
+        BasicPoint.objects.create(name="Five Mile", geom=Point(147.2058, -9.4599))
+        with TemporaryDirectory() as directory:
+            path = Path(directory) / "points.pmtiles"
+            output = StringIO()
+            call_command("export_pmtiles", str(path), "djangostreetmap.test_mbtiles.BasicPointLayer", "--bbox=146,-10,148,-9", "--maxzoom=6", "--processes=1", stdout=output)
+            self.assertIn("Exported 7 tiles (7 distinct", output.getvalue())
+            reader = PMTilesReader(path)
+            self.assertEqual((reader.header.min_zoom, reader.header.max_zoom, reader.header.min_lon_e7), (0, 6, 1460000000))
+            self.assertEqual(reader.metadata["vector_layers"][0]["id"], "basicpoint")
+            self.assertIn(b"Five Mile", gzip.decompress(reader.get(6, 58, 33)))
@@ -0,0 +1,139 @@
+from datetime import timedelta
+from io import StringIO
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.management import CommandError, call_command
+from django.test import SimpleTestCase, TestCase
+
+from djangostreetmap.models import TileJob
+from djangostreetmap.seeding import lonlat_to_tile, seed_area, tile_blocks, tile_bounds, tile_count, tile_cover
+from djangostreetmap.views import PoiLayer
+
+# East Timor
+timor = (124.0, -9.5, 127.4, -8.1)
+
+
+class SeededPoi(PoiLayer):
+    tilecache = LocMemCache("seeded-poi", {})
+
+
+class FailingPoi(SeededPoi):
+    def _fetch_layer(self, query_layer, params):
+        return None
+
+
+class FlakyPoi(SeededPoi):
+    """Its layer query fails the first time"""
+
+    failures = 1
+
+    def _fetch_layer(self, query_layer, params):
+        if FlakyPoi.failures:
+            FlakyPoi.failures -= 1
+            return None
+        return super()._fetch_layer(query_layer, params)
+
+
+class TileCoverTests(SimpleTestCase):
+    def test_lonlat_to_tile(self):
+        self.assertEqual(lonlat_to_tile(147.2058, -9.4599, 14), (14891, 8624))
+        self.assertEqual(lonlat_to_tile(-180, 90, 3), (0, 0))
+        self.assertEqual(lonlat_to_tile(180, -90, 3), (7, 7))
+
+    def test_tile_bounds(self):
+        self.assertEqual(tile_bounds(1, 1, 1), (0.0, -20037508.342789244, 20037508.342789244, 0.0))
+
+    def test_cover(self):
+        self.assertEqual(list(tile_cover(timor, 6)), [(6, 54, 33)])
+        self.assertEqual(len(list(tile_cover(timor, 10))), tile_count(timor, 10))
+
+    def test_blocks(self):
+        blocks = list(tile_blocks(timor, 10, 4))
+        self.assertEqual(sum((x_max - x_min + 1) * (y_max - y_min + 1) for x_min, x_max, y_min, y_max in blocks), tile_count(timor, 10))
+        self.assertTrue(all(x_max - x_min < 4 and y_max - y_min < 4 for x_min, x_max, y_min, y_max in blocks))
+
+    def test_count_in_geometry(self):
+        bbox, geometry = seed_area(geometry="POLYGON((125 -9, 126 -9, 126 -8.5, 125 -9))")
+        self.assertEqual(tile_count(bbox, 10, geometry), len(list(tile_cover(bbox, 10, geometry))))
+        self.assertLess(tile_count(bbox, 10, geometry), tile_count(bbox, 10))
+
+
+class SeedTilesTests(TestCase):
+    def setUp(self):
+        SeededPoi.tilecache.clear()
+
+    def test_seed_and_resume(self):
+        with TemporaryDirectory() as directory:
+            state = Path(directory) / "seed.log"
+            args = ["djangostreetmap.test_seeding.SeededPoi", "--bbox=124.0,-9.5,127.4,-8.1", "--maxzoom=8", "--processes=1", "--chunk-size=2", f"--state={state}"]
+            output = StringIO()
+            call_command("seed_tiles", *args, stdout=output)
+            total = sum(tile_count(timor, zoom) for zoom in range(9))
+            self.assertIn(f"Seeded {total} tiles (0 already done)", output.getvalue())
+            self.assertIsNotNone(SeededPoi.tilecache.get("tile:school@1.0:8/216/134:4096:64"))
+
+            call_command("seed_tiles", *args, stdout=output)
+            self.assertIn(f"Seeded 0 tiles ({total} already done)", output.getvalue())
+
+    def test_failed_chunks_not_recorded(self):
+        with TemporaryDirectory() as directory:
+            state = Path(directory) / "seed.log"
+            with self.assertRaisesMessage(CommandError, "2 chunks failed"):
+                call_command(
+                    "seed_tiles", "djangostreetmap.test_seeding.FailingPoi", "--bbox=124.0,-9.5,127.4,-8.1", "--maxzoom=1", "--processes=1", f"--state={state}", stderr=StringIO()
+                )
+            self.assertEqual(state.read_text(), "")
+
+    def test_needs_a_cache(self):
+        with self.assertRaises(CommandError):
+            call_command("seed_tiles", "djangostreetmap.views.PoiLayer", "--bbox=124.0,-9.5,127.4,-8.1")
+
+
+class TileQueueTests(TestCase):
+    view = "djangostreetmap.test_seeding.SeededPoi"
+
+    def setUp(self):
+        SeededPoi.tilecache.clear()
+
+    def test_enqueue_and_work(self):
+        output = StringIO()
+        call_command("enqueue_tiles", self.view, "--bbox=124.0,-9.5,127.4,-8.1", "--minzoom=8", "--maxzoom=8", "--block-size=2", stdout=output)
+        self.assertIn(f"of {tile_count(timor, 8)} tiles", output.getvalue())
+
+        call_command("tile_worker", "--name=worker-1", stdout=output)
+        self.assertFalse(TileJob.objects.exclude(status=TileJob.Status.DONE).exists())
+        self.assertIsNotNone(SeededPoi.tilecache.get("tile:school@1.0:8/216/134:4096:64"))
+
+        call_command("tile_worker", "--stats", stdout=output)
+        self.assertIn(f"worker-1: {TileJob.objects.count()} jobs, {tile_count(timor, 8)} tiles", output.getvalue())
+
+    def test_lease_expiry_and_retry(self):
+        job = TileJob.objects.create(view=self.view, zoom=8, x_min=216, x_max=216, y_min=134, y_max=134)
+        self.assertEqual(TileJob.claim("worker-1", timedelta(minutes=10), 2), job)
+        # Held by worker-1
+        self.assertIsNone(TileJob.claim("worker-2", timedelta(minutes=10), 2))
+
+        TileJob.objects.filter(pk=job.pk).update(lease_expires=job.lease_expires - timedelta(hours=1))
+        claimed = TileJob.claim("worker-2", timedelta(minutes=10), 2)
+        self.assertEqual((claimed.worker, claimed.attempts), ("worker-2", 2))
+
+        TileJob.objects.filter(pk=job.pk).update(lease_expires=claimed.lease_expires - timedelta(hours=1))
+        self.assertIsNone(TileJob.claim("worker-3", timedelta(minutes=10), 2))
+        self.assertEqual(TileJob.objects.get(pk=job.pk).status, TileJob.Status.FAILED)
+
+    def test_failed_layer_fails_the_job(self):
+        job = TileJob.objects.create(view="djangostreetmap.test_seeding.FlakyPoi", zoom=8, x_min=216, x_max=216, y_min=134, y_max=134)
+        call_command("tile_worker", "--name=worker-1", stdout=StringIO(), stderr=StringIO())
+        job.refresh_from_db()
+        # Retried after the failure
+        self.assertEqual((job.status, job.attempts, job.tiles), (TileJob.Status.DONE, 2, 1))
+
+        job = TileJob.objects.create(view="djangostreetmap.test_seeding.FailingPoi", zoom=8, x_min=216, x_max=216, y_min=134, y_max=134)
+        errors = StringIO()
+        call_command("tile_worker", "--name=worker-1", "--max-attempts=2", stdout=StringIO(), stderr=errors)
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts), (TileJob.Status.FAILED, 2))
+        self.assertIn("failed or stale layers", job.error)
+        self.assertIn("failed or stale layers", errors.getvalue())
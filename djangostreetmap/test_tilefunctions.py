@@ -0,0 +1,62 @@
+"""Tests for installing tile layers as database functions (`djangostreetmap.tilefunctions`)."""
+
+from dataclasses import asdict, replace
+from io import StringIO
+
+from django.core.management import call_command
+from django.test import SimpleTestCase, TestCase
+from psycopg2 import sql
+
+from djangostreetmap.tilefunctions import bind_placeholders, function_name
+from djangostreetmap.tilegenerator import MultiMvtQuery, MvtQuery, Tile
+from djangostreetmap.views import LandLayer, PoiLayer, TileLayerView
+
+roads = MvtQuery(table="osmflex_roadline", layer="roads", attributes=["name"], pk="osm_id")
+
+
+class Composite(TileLayerView):
+    layers = [*LandLayer.layers, *PoiLayer.layers]
+
+
+class FunctionComposite(Composite):
+    server_functions = True
+
+
+class BindPlaceholdersTests(SimpleTestCase):
+    def test_placeholders_and_escapes(self):
+        query = sql.SQL("SELECT %(zoom)s WHERE name LIKE '%%road' AND ") + sql.Literal("%(x)s")
+        bound = bind_placeholders(query, {"zoom": sql.SQL("$1")})
+        self.assertEqual(bound.seq[0], sql.Composed([sql.SQL("SELECT "), sql.SQL("$1"), sql.SQL(" WHERE name LIKE '"), sql.SQL("%"), sql.SQL("road' AND ")]))
+        # Literals are left alone
+        self.assertEqual(bound.seq[1], sql.Literal("%(x)s"))
+
+    def test_unknown_placeholder(self):
+        with self.assertRaises(KeyError):
+            bind_placeholders(sql.SQL("SELECT %(y)s"), {})
+
+
+class FunctionNameTests(SimpleTestCase):
+    def test_name_follows_the_definition(self):
+        self.assertEqual(function_name(roads), function_name(replace(roads)))
+        self.assertNotEqual(function_name(roads), function_name(replace(roads, attributes=["name", "osm_type"])))
+        self.assertNotEqual(function_name(roads), function_name(replace(roads, query_params={"roads_param_0": 1})))
+
+    def test_name_length(self):
+        layers = [replace(roads, layer=f"layer_with_a_long_name_{i}") for i in range(4)]
+        self.assertTrue(function_name(MultiMvtQuery(layers=layers)).startswith("tile_layer_with_a_long_name_0_layer_with_"))
+        self.assertLessEqual(len(function_name(MultiMvtQuery(layers=layers))), 63)
+
+
+class ServerFunctionTests(TestCase):
+    def test_functions_render_the_same_tiles(self):
+        output = StringIO()
+        call_command("install_tile_functions", "djangostreetmap.test_tilefunctions.FunctionComposite", "--maxzoom=14", stdout=output)
+        # The land layer and the points: the land layer's zoom bands are generalised tables, which this view does not use
+        self.assertEqual(output.getvalue().count("installed"), 2)
+        tile = Tile(zoom=14, x=14891, y=8624)
+        view = FunctionComposite()
+        self.assertNotIn(None, [view._fetch_layer(layer, asdict(tile)) for layer in view.layers])
+        # Two function calls, each followed by a rollback of its session settings
+        with self.assertNumQueries(4):
+            from_functions = view._generate_tile(tile)
+        self.assertEqual(b"".join(from_functions), b"".join(Composite()._generate_tile(tile)))
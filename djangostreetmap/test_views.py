@@ -7,20 +7,33 @@ through the pydantic style model.
 """
 
 import json
+from dataclasses import asdict, replace
+from tempfile import TemporaryDirectory
+from unittest.mock import patch
 
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache.backends.locmem import LocMemCache
 from django.db import connection
-from django.test import TestCase
+from django.http import FileResponse
+from django.test import RequestFactory, TestCase
 from django.urls import reverse
+from psycopg.conninfo import conninfo_to_dict
 
-from djangostreetmap.tilegenerator import Tile
-from djangostreetmap.views import BuildingPolygon, Roads
+from djangostreetmap.admission import ALL_LAYERS, admit
+from djangostreetmap.async_views import AsyncTileLayerView, _pools, get_conninfo
+from djangostreetmap.cache import ContentAddressedTileCache, FileTileCache, content_digest
+from djangostreetmap.coalesce import CacheLock
+from djangostreetmap.driver import adapt_query
+from djangostreetmap.tilegenerator import TILE_SESSION_SETTINGS, MvtQuery, Tile
+from djangostreetmap.views import BuildingPolygon, LandLayer, PoiLayer, Roads, TileLayerView, _refreshing
 from maplibre import Root
 
 
 def _render(composable) -> str:
     """Render a psycopg2 sql.Composable to a string via the live cursor."""
     with connection.cursor() as c:
-        return composable.as_string(c.cursor)
+        return adapt_query(composable).as_string(c.cursor)
 
 
 class TileEndpointTests(TestCase):
@@ -48,6 +61,270 @@ class TileEndpointTests(TestCase):
         self.assertEqual(resp.status_code, 200)
 
 
+class SingleStatementTests(TestCase):
+    class Composite(TileLayerView):
+        layers = [*LandLayer.layers, *PoiLayer.layers]
+
+    class SingleStatementComposite(Composite):
+        single_statement = True
+
+    def test_one_query_per_tile(self):
+        tile = Tile(zoom=14, x=14891, y=8624)
+        # Tests run in a transaction, so each query is followed by a rollback of its session settings
+        with self.assertNumQueries(2):
+            single = self.SingleStatementComposite()._generate_tile(tile)
+        with self.assertNumQueries(4):
+            multiple = self.Composite()._generate_tile(tile)
+        self.assertEqual(b"".join(single), b"".join(multiple))
+
+
+class WholeTileCacheTests(TestCase):
+    class CachedComposite(TileLayerView):
+        layers = [*LandLayer.layers, *PoiLayer.layers]
+        tilecache = LocMemCache("whole-tile", {})
+        cache_whole_tile = True
+
+    def test_whole_tile_hit_needs_no_queries(self):
+        self.CachedComposite.tilecache.clear()
+        tile = Tile(zoom=14, x=14891, y=8624)
+        # Two layer queries, each followed by a rollback of its session settings
+        with self.assertNumQueries(4):
+            first = self.CachedComposite()._generate_tile(tile)
+        with self.assertNumQueries(0):
+            second = self.CachedComposite()._generate_tile(tile)
+        self.assertEqual(b"".join(first), b"".join(second))
+        self.assertIsNotNone(self.CachedComposite.tilecache.get("tile:land@1.0+school@1.0:14/14891/8624:4096:64"))
+
+
+class FileCacheTests(TestCase):
+    class FileCachedLand(TileLayerView):
+        layers = LandLayer.layers
+
+    def test_hit_sends_the_file(self):
+        with TemporaryDirectory() as directory:
+            view = self.FileCachedLand.as_view(tilecache=FileTileCache(directory))
+            first = view(RequestFactory().get("/"), zoom=14, x=14891, y=8624)
+            with self.assertNumQueries(0):
+                second = view(RequestFactory().get("/"), zoom=14, x=14891, y=8624)
+            self.assertIsInstance(second, FileResponse)
+            self.assertEqual(b"".join(second.streaming_content), first.content)
+            second.close()
+
+
+class EtagTests(TestCase):
+    class TaggedLand(TileLayerView):
+        layers = LandLayer.layers
+        etag = True
+
+    def test_unchanged_tile_not_sent_again(self):
+        view = self.TaggedLand.as_view()
+        first = view(RequestFactory().get("/"), zoom=14, x=14891, y=8624)
+        self.assertEqual(first["ETag"], f'"{content_digest(first.content)}"')
+        second = view(RequestFactory().get("/", headers={"If-None-Match": first["ETag"]}), zoom=14, x=14891, y=8624)
+        self.assertEqual((second.status_code, second["ETag"]), (304, first["ETag"]))
+
+    def test_file_hit_from_content_addressed_cache(self):
+        with TemporaryDirectory() as directory:
+            view = self.TaggedLand.as_view(tilecache=ContentAddressedTileCache(FileTileCache(directory)))
+            first = view(RequestFactory().get("/"), zoom=14, x=14891, y=8624)
+            with self.assertNumQueries(0):
+                second = view(RequestFactory().get("/"), zoom=14, x=14891, y=8624)
+                not_modified = view(RequestFactory().get("/", headers={"If-None-Match": first["ETag"]}), zoom=14, x=14891, y=8624)
+            self.assertIsInstance(second, FileResponse)
+            self.assertEqual(second["ETag"], first["ETag"])
+            self.assertEqual(b"".join(second.streaming_content), first.content)
+            second.close()
+            self.assertEqual(not_modified.status_code, 304)
+
+
+class BatchedCacheTests(TestCase):
+    class CountingCache(LocMemCache):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            self.calls: list[str] = []
+
+        def get(self, *args, **kwargs):
+            self.calls.append("get")
+            return super().get(*args, **kwargs)
+
+        def get_many(self, *args, **kwargs):
+            self.calls.append("get_many")
+            return super().get_many(*args, **kwargs)
+
+        def set_many(self, *args, **kwargs):
+            self.calls.append("set_many")
+            return super().set_many(*args, **kwargs)
+
+    class CachedComposite(TileLayerView):
+        layers = [*LandLayer.layers, *PoiLayer.layers]
+
+    def test_one_cache_round_trip_each_way(self):
+        cache = self.CountingCache("batched", {})
+        view = self.CachedComposite()
+        view.tilecache = cache
+        view._generate_tile(Tile(zoom=14, x=14891, y=8624))
+        self.assertEqual(cache.calls, ["get_many", "set_many"])
+
+
+class StaleTileTests(TestCase):
+    class Executor:
+        def __init__(self):
+            self.submitted = []
+
+        def submit(self, fn, *args):
+            self.submitted.append(args)
+
+    class StaleLand(TileLayerView):
+        layers = LandLayer.layers
+        cache_stale_timeout = 3600
+
+    def setUp(self):
+        self.tile = Tile(zoom=14, x=14891, y=8624)
+        self.key = "tile:land@1.0:14/14891/8624:4096:64"
+        self.view = self.StaleLand()
+        self.view.tilecache = LocMemCache("stale", {})
+        self.view.tilecache.clear()
+        self.view.refresh_executor = self.Executor()
+        self.first = b"".join(self.view._generate_tile(self.tile))
+        # Expire the tile's freshness but keep the tile
+        self.view.tilecache.delete(f"{self.key}:fresh")
+
+    def tearDown(self):
+        _refreshing.clear()
+
+    def test_stale_while_revalidate(self):
+        with self.assertNumQueries(0):
+            content = b"".join(self.view._generate_tile(self.tile))
+        self.assertEqual(content, self.first)
+        self.assertEqual(len(self.view.refresh_executor.submitted), 1)
+        # A second request does not schedule another refresh of the same tile
+        self.view._generate_tile(self.tile)
+        self.assertEqual(len(self.view.refresh_executor.submitted), 1)
+
+    def test_serve_stale_on_error(self):
+        self.view.cache_stale_while_revalidate = False
+        self.view._fetch_layer = lambda query, params: None
+        self.assertEqual(b"".join(self.view._generate_tile(self.tile)), self.first)
+        self.assertEqual(self.view.refresh_executor.submitted, [])
+
+    def test_stale_tile_is_re_rendered_synchronously(self):
+        self.view.cache_stale_while_revalidate = False
+        # The query, and the rollback of its session settings
+        with self.assertNumQueries(2):
+            self.view._generate_tile(self.tile)
+        self.assertIsNotNone(self.view.tilecache.get(f"{self.key}:fresh"))
+
+    def test_coalesced_waiter_does_not_take_the_stale_tile(self):
+        self.view.cache_stale_while_revalidate = False
+        self.view.coalesce = True
+        self.view.coalesce_timeout = 0.2
+        # Another process is rendering the tile, and never finishes
+        self.assertTrue(CacheLock(self.view.tilecache, f"{self.key}:lock").acquire())
+        with self.assertNumQueries(2):
+            self.view._generate_tile(self.tile)
+        self.assertIsNotNone(self.view.tilecache.get(f"{self.key}:fresh"))
+
+
+class AdmissionTests(TestCase):
+    class LimitedLand(TileLayerView):
+        layers = LandLayer.layers
+        max_concurrent_queries = 1
+        admission_timeout = 0
+        statement_timeout = 5000
+
+    def setUp(self):
+        self.tile = Tile(zoom=14, x=14891, y=8624)
+        self.view = self.LimitedLand()
+
+    def test_statement_timeout_shares_the_round_trip(self):
+        with connection.cursor() as cursor:
+            settings_sql, query_sql = self.view._layer_sql(self.view.layers[0], cursor.cursor)
+        self.assertTrue(settings_sql.endswith("SET LOCAL statement_timeout = 5000; "))
+        self.assertTrue(query_sql.lstrip().startswith("WITH"))
+        # Then the rollback of the settings, as tests run in a transaction
+        with self.assertNumQueries(2) as queries:
+            self.view._generate_tile(self.tile)
+        self.assertIn("SET LOCAL statement_timeout = 5000; ", queries[0]["sql"])
+        self.assertIn("ST_AsMVT", queries[0]["sql"])
+
+    def test_overload_returns_503(self):
+        with admit([(ALL_LAYERS, 1)], timeout=0):
+            response = self.view.get(None, zoom=14, x=14891, y=8624)
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response["Retry-After"], "5")
+
+    def test_overload_returns_stale_tile(self):
+        self.view.tilecache = LocMemCache("admission", {})
+        self.view.tilecache.clear()
+        self.view.cache_stale_timeout = 3600
+        self.view.cache_stale_while_revalidate = False
+        first = b"".join(self.view._generate_tile(self.tile))
+        self.view.tilecache.delete("tile:land@1.0:14/14891/8624:4096:64:fresh")
+        with admit([(ALL_LAYERS, 1)], timeout=0), self.assertNumQueries(0):
+            response = self.view.get(None, zoom=14, x=14891, y=8624)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content, first)
+
+
+class SessionSettingsTests(TestCase):
+    def test_layer_settings_override_the_view(self):
+        view = TileLayerView()
+        layer = MvtQuery(table="osmflex_roadline", layer="roads", session_settings={"work_mem": "64MB", "jit": "on"}, statement_timeout=200)
+        self.assertEqual(view.get_session_settings(layer), {"jit": "on", "max_parallel_workers_per_gather": 0, "work_mem": "64MB", "statement_timeout": 200})
+        self.assertEqual(view.get_session_settings(MvtQuery(table="osmflex_roadline")), TILE_SESSION_SETTINGS)
+
+    def test_settings_end_with_the_tile_query(self):
+        # Tests run in a transaction, as requests do with ATOMIC_REQUESTS
+        self.assertTrue(connection.in_atomic_block)
+        view = LandLayer()
+        view.session_settings = {"work_mem": "77MB"}
+        with connection.cursor() as cursor:
+            cursor.execute("SHOW work_mem")
+            work_mem = cursor.fetchone()[0]
+            self.assertNotEqual(work_mem, "77MB")
+            self.assertIsNotNone(view._fetch_layer(view.layers[0], asdict(Tile(zoom=14, x=14891, y=8624))))
+            cursor.execute("SHOW work_mem")
+            self.assertEqual(cursor.fetchone()[0], work_mem)
+
+
+class SimplifyTests(TestCase):
+    class SimplifiedComposite(TileLayerView):
+        layers = [*LandLayer.layers, *PoiLayer.layers]
+        simplify = 2
+
+    def test_view_default_unless_the_layer_sets_one(self):
+        view = self.SimplifiedComposite()
+        tile = Tile(zoom=5, x=29, y=16)
+        land, poi = view.get_query_layers(tile)
+        self.assertEqual((land.simplify, poi.simplify), (1, 2))
+        self.assertIs(poi, view.get_query_layers(tile)[1])
+        self.assertNotIn(None, [view._fetch_layer(layer, asdict(tile)) for layer in (land, poi)])
+
+    def test_roads_simplified_at_low_zoom(self):
+        self.assertEqual(Roads().get_layers(Tile(zoom=8, x=0, y=0))[0].simplify, 1)
+        self.assertIsNone(Roads().get_layers(Tile(zoom=14, x=0, y=0))[0].simplify)
+
+
+class AsyncTileLayerViewTests(TestCase):
+    class AsyncComposite(AsyncTileLayerView):
+        layers = [*LandLayer.layers, *PoiLayer.layers]
+
+    async def test_matches_sync_view(self):
+        tile = Tile(zoom=14, x=14891, y=8624)
+        try:
+            async_tiles = await self.AsyncComposite()._agenerate_tile(tile)
+        finally:
+            # The pool belongs to this test's event loop
+            await _pools.pop("default").close()
+        sync_tiles = await sync_to_async(SingleStatementTests.Composite()._generate_tile)(tile)
+        self.assertEqual(b"".join(async_tiles), b"".join(sync_tiles))
+
+    def test_conninfo_drops_django_options(self):
+        database = {"NAME": "tiles", "HOST": "db", "OPTIONS": {"sslmode": "require", "server_side_binding": True, "pool": True, "isolation_level": 1, "assume_role": "tiles"}}
+        with patch.dict(settings.DATABASES, {"tiles": database}):
+            self.assertEqual(conninfo_to_dict(get_conninfo("tiles")), {"dbname": "tiles", "host": "db", "sslmode": "require"})
+
+
 class BuildingPolygonZoomBandTests(TestCase):
     def test_no_layers_below_zoom_14(self):
         for zoom in (0, 5, 10, 13):
@@ -79,6 +356,32 @@ class RoadsZoomBandTests(TestCase):
         self.assertIn("'residential'", rendered)
 
 
+class RenderedSqlTests(TestCase):
+    def test_layers_reused_per_zoom(self):
+        self.assertIs(Roads().get_layers(Tile(zoom=14, x=0, y=0))[0], Roads().get_layers(Tile(zoom=14, x=1, y=1))[0])
+        self.assertIs(BuildingPolygon().get_layers(Tile(zoom=15, x=0, y=0))[0], BuildingPolygon().get_layers(Tile(zoom=16, x=0, y=0))[0])
+
+    def test_sql_rendered_once(self):
+        view = Roads()
+        layer = view.get_layers(Tile(zoom=14, x=0, y=0))[0]
+        with connection.cursor() as cursor:
+            first = view._layer_sql(layer, cursor.cursor)
+            with patch.object(MvtQuery, "as_mvt", side_effect=AssertionError("composed again")):
+                second = view._layer_sql(replace(layer), cursor.cursor)
+        self.assertIs(first[1], second[1])
+
+    def test_sql_rendered_once_for_any_parameter_values(self):
+        view = TileLayerView()
+        layer = MvtQuery(table="osmflex_roadline", layer="roads", query_params={"road_type": "primary"})
+        with connection.cursor() as cursor:
+            self.assertIs(view._layer_sql(layer, cursor.cursor)[1], view._layer_sql(layer.bind(road_type="track"), cursor.cursor)[1])
+
+    def test_single_statement_layers_reused(self):
+        view = SingleStatementTests.SingleStatementComposite()
+        tile = Tile(zoom=14, x=14891, y=8624)
+        self.assertIs(view.get_query_layers(tile)[0], view.get_query_layers(tile)[0])
+
+
 class HospitalsAndAerowaysTests(TestCase):
     def test_hospitals_returns_valid_feature_collection(self):
         resp = self.client.get(reverse("djangostreetmap:hospitals"))
@@ -1,15 +1,23 @@
-from dataclasses import asdict
+import math
+from dataclasses import FrozenInstanceError, asdict, replace
 from http import HTTPStatus
+from importlib import import_module
+from io import StringIO
 
-from django.contrib.gis.geos import Point
+from django.apps import apps
+from django.contrib.gis.geos import MultiPolygon, Point, Polygon
+from django.core.management import call_command
 from django.db import connection
-from django.db.models import Q
+from django.db.models import CharField, Q
 from django.test import TestCase
 from django.urls import reverse
 from osmflex.models import RoadLine
 from psycopg2 import sql
 
-from djangostreetmap.tilegenerator import MvtQuery, Tile
+from djangostreetmap.driver import adapt_query, last_result
+from djangostreetmap.functions import QueryParam
+from djangostreetmap.models import SimplifiedLandPolygon, SubdividedLandPolygon
+from djangostreetmap.tilegenerator import HEAVY_LAYER_SESSION_SETTINGS, MultiMvtQuery, MvtQuery, Tile, create_envelope_index, create_size_indexes, positional_to_named, set_local
 from tests.models import BasicPoint
 
 # This reference is from /14/14891/8624, around 'Five Mile', Port Moresby
@@ -57,7 +65,7 @@ class RoadMvtTestCase(TestCase):
             pk="osm_id",
         )
         with connection.cursor() as cursor:
-            cursor.execute(query.as_mvt(), asdict(port_moresby))
+            cursor.execute(adapt_query(query.as_mvt()), asdict(port_moresby))
             tile_response = cursor.fetchone()
             content = tile_response[0]  # type: memoryview
         _ = bytes(content)
@@ -74,7 +82,7 @@ class RoadMvtTestCase(TestCase):
         params.update(mvtquery.query_params)
 
         with connection.cursor() as cursor:
-            cursor.execute(mvtquery.as_mvt(), params)
+            cursor.execute(adapt_query(mvtquery.as_mvt()), params)
             tile_response = cursor.fetchone()
             content = tile_response[0]  # type: memoryview
         _ = bytes(content)
@@ -83,7 +91,7 @@ class RoadMvtTestCase(TestCase):
 class FromQueryTestCase(TestCase):
     def test_from_query(self):
         with connection.cursor() as cursor:
-            cursor.execute(MvtQuery.from_model(RoadLine).as_mvt(), asdict(port_moresby))
+            cursor.execute(adapt_query(MvtQuery.from_model(RoadLine).as_mvt()), asdict(port_moresby))
             tile_response = cursor.fetchone()
             content = tile_response[0]  # type: memoryview
         _ = bytes(content)
@@ -95,12 +103,243 @@ class FromQueryTestCase(TestCase):
         params.update(mvtquery.query_params)
 
         with connection.cursor() as cursor:
-            cursor.execute(mvtquery.as_mvt(), params)
+            cursor.execute(adapt_query(mvtquery.as_mvt()), params)
             tile_response = cursor.fetchone()
             content = tile_response[0]  # type: memoryview
         _ = bytes(content)
 
 
+class QuerysetCompilationTestCase(TestCase):
+    def test_escaped_percent_is_not_a_placeholder(self):
+        named_sql, names = positional_to_named("SELECT '%%s', %s, %(road_type)s FROM t WHERE a = %s", "p")
+        self.assertEqual(named_sql, "SELECT '%%s', %(p_0)s, %(road_type)s FROM t WHERE a = %(p_1)s")
+        self.assertEqual(names, ["p_0", "p_1"])
+
+    def test_compiled_once_per_structure(self):
+        primary = MvtQuery.from_queryset(RoadLine.objects.filter(osm_type="primary"), layer="roads")
+        track = MvtQuery.from_queryset(RoadLine.objects.filter(osm_type="track"), layer="roads")
+        self.assertIs(primary.ctes[0][1], track.ctes[0][1])
+        self.assertEqual(primary.sql_definition, track.sql_definition)
+        self.assertNotEqual(primary, track)
+        self.assertEqual(track.query_params, {"roads_param_0": "track"})
+
+    def test_query_param(self):
+        roads = MvtQuery.from_queryset(RoadLine.objects.filter(osm_type=QueryParam("road_type", output_field=CharField())), layer="roads")
+        self.assertEqual(dict(roads.query_params), {})
+        primary = roads.bind(road_type="primary")
+        self.assertEqual(primary.query_params, {"road_type": "primary"})
+        self.assertEqual(primary.sql_definition, roads.sql_definition)
+
+        with connection.cursor() as cursor:
+            cursor.execute(adapt_query(primary.as_mvt()), {**asdict(port_moresby), **primary.query_params})
+            tile_response = cursor.fetchone()
+        _ = bytes(tile_response[0])
+
+
+class MultiMvtQueryTestCase(TestCase):
+    def test_multiple_querysets(self):
+        """Two queryset layers share one statement without CTE or parameter name clashes"""
+        roads = MvtQuery.from_queryset(RoadLine.objects.filter(osm_type="primary"), layer="primary")
+        tracks = MvtQuery.from_queryset(RoadLine.objects.filter(osm_type="track"), layer="track")
+        mvtquery = MultiMvtQuery(layers=[roads, tracks])
+        params = asdict(port_moresby)
+        params.update(mvtquery.query_params)
+        self.assertEqual(params["primary_param_0"], "primary")
+        self.assertEqual(params["track_param_0"], "track")
+
+        with connection.cursor() as cursor:
+            cursor.execute(adapt_query(mvtquery.as_mvt()), params)
+            tile_response = cursor.fetchone()
+            content = tile_response[0]  # type: memoryview
+        _ = bytes(content)
+
+    def test_duplicate_layer(self):
+        mvtquery = MultiMvtQuery(layers=[MvtQuery.from_model(RoadLine), MvtQuery.from_model(RoadLine)])
+        with self.assertRaises(ValueError):
+            mvtquery.as_mvt()
+
+
+class ImmutableMvtQueryTestCase(TestCase):
+    def test_hashable_and_equal_by_definition(self):
+        first = MvtQuery(table="osmflex_roadline", attributes=["name"], query_params={"ids": [1, 2]})
+        second = MvtQuery(table="osmflex_roadline", attributes=("name",), query_params={"ids": [1, 2]})
+        self.assertEqual(first, second)
+        self.assertEqual(hash(first), hash(second))
+        self.assertNotEqual(hash(first), hash(replace(first, layer="other")))
+        self.assertEqual(len({MultiMvtQuery(layers=[first]), MultiMvtQuery(layers=(second,))}), 1)
+
+    def test_immutable(self):
+        attributes = ["name"]
+        mvtquery = MvtQuery(table="osmflex_roadline", attributes=attributes)
+        attributes.append("osm_type")
+        self.assertEqual(mvtquery.attributes, ("name",))
+        with self.assertRaises(FrozenInstanceError):
+            mvtquery.layer = "other"  # type: ignore
+        with self.assertRaises(TypeError):
+            mvtquery.query_params["zoom"] = 1  # type: ignore
+
+    def test_sql_composed_once(self):
+        mvtquery = MvtQuery.from_model(RoadLine)
+        self.assertIs(mvtquery.as_mvt(), mvtquery.as_mvt())
+
+
+class AttributeModeTestCase(TestCase):
+    def test_columns(self):
+        buildings = MvtQuery(
+            table="osmflex_buildingpolygon",
+            attributes=["name", "osm_id"],
+            calculated_attributes={"render_min_height": sql.SQL("4")},
+            pk="osm_id",
+            attribute_mode="columns",
+        )
+        with connection.cursor() as cursor:
+            self.assertEqual(adapt_query(buildings.column_attributes).as_string(cursor.cursor), ', "name", "osm_id", 4 AS "render_min_height"')
+            cursor.execute(adapt_query(buildings.as_mvt()), asdict(port_moresby))
+            tile_response = cursor.fetchone()
+        _ = bytes(tile_response[0])
+
+    def test_columns_keep_listed_pk(self):
+        roads = MvtQuery(table="osmflex_roadline", attributes=["name"], pk="osm_id", attribute_mode="columns")
+        self.assertEqual(roads.feature_id, "osm_id")
+        roads = replace(roads, attributes=["name", "osm_id"])
+        self.assertEqual(roads.feature_id, "osm_id_feature_id")
+        with connection.cursor() as cursor:
+            self.assertIn('"osm_id" AS "osm_id_feature_id" , "name", "osm_id"', adapt_query(roads.as_mvtgeom).as_string(cursor.cursor))
+            self.assertIn("'osm_id_feature_id'", adapt_query(roads.mvt_select).as_string(cursor.cursor))
+            cursor.execute(adapt_query(roads.as_mvt()), asdict(port_moresby))
+            cursor.fetchone()
+
+    def test_unknown_mode(self):
+        with self.assertRaises(ValueError):
+            MvtQuery(table="osmflex_roadline", attribute_mode="hstore")
+
+    def test_benchmark(self):
+        output = StringIO()
+        call_command("benchmark_attribute_modes", "--repeat=1", stdout=output)
+        self.assertIn("buildings [columns]", output.getvalue())
+        self.assertIn("transportation [jsonb]", output.getvalue())
+
+
+class TransformedEnvelopeTestCase(TestCase):
+    def test_envelope_transformed_to_source_srid(self):
+        BasicPoint.objects.create(name="Five Mile", geom=Point(147.2058, -9.4599))
+        points = MvtQuery.from_model(BasicPoint)
+        self.assertEqual((points.transform, points.srid), (True, 4326))
+        with connection.cursor() as cursor:
+            self.assertTrue(adapt_query(points._feature_query).as_string(cursor.cursor).startswith('"geom" && ST_TRANSFORM(ST_TileEnvelope('))
+            cursor.execute(adapt_query(points.as_mvt()), asdict(port_moresby))
+            tile_response = cursor.fetchone()
+        self.assertTrue(bytes(tile_response[0]))
+
+    def test_envelope_index(self):
+        points = MvtQuery(table=BasicPoint._meta.db_table, transform=True)
+        with connection.cursor() as cursor:
+            cursor.execute(adapt_query(create_envelope_index(points)))
+        with self.assertRaises(ValueError):
+            create_envelope_index(replace(points, srid=4326))
+
+
+class SimplifyTestCase(TestCase):
+    def test_simplified_tile(self):
+        BasicPoint.objects.create(name="Five Mile", geom=Point(147.2058, -9.4599))
+        for simplify in (0, 1.5):
+            points = MvtQuery.from_model(BasicPoint, simplify=simplify)
+            with connection.cursor() as cursor:
+                cursor.execute(adapt_query(points.as_mvt()), asdict(port_moresby))
+                tile_response = cursor.fetchone()
+            self.assertTrue(bytes(tile_response[0]))
+
+
+class CullingTestCase(TestCase):
+    def test_min_area(self):
+        BasicPoint.objects.create(name="Five Mile", geom=Point(147.2058, -9.4599))
+        points = MvtQuery.from_model(BasicPoint)
+        with connection.cursor() as cursor:
+            # Points have no area to cull them by
+            for query_layer in (points, replace(points, min_area=1), replace(points, min_length=1)):
+                cursor.execute(adapt_query(query_layer.as_mvt()), asdict(port_moresby))
+                tile_response = cursor.fetchone()
+                self.assertTrue(bytes(tile_response[0]))
+
+    def test_mixed_geometries(self):
+        # In Port Moresby, in EPSG:3857, where a pixel of the tile is about 0.6 metres wide
+        mixed = sql.SQL(
+            """
+            (
+                SELECT id, CASE id
+                    WHEN 1 THEN centre
+                    WHEN 2 THEN ST_MakeLine(centre, ST_Translate(centre, 10, 0))
+                    WHEN 3 THEN ST_MakeLine(centre, ST_Translate(centre, 0.01, 0))
+                    WHEN 4 THEN ST_Buffer(centre, 10, 'quad_segs=1')
+                    WHEN 5 THEN ST_Buffer(centre, 0.01, 'quad_segs=1')
+                END AS geom
+                FROM generate_series(1, 5) AS id, ST_Transform(ST_SetSRID(ST_MakePoint(147.2058, -9.4599), 4326), 3857) AS centre
+            ) AS mixed
+            """
+        )
+        layer = MvtQuery(table=mixed, layer="mixed", transform=False, min_area=1, min_length=1)
+        with connection.cursor() as cursor:
+            cursor.execute(adapt_query(sql.SQL("SELECT id FROM {} WHERE {} ORDER BY id").format(mixed, layer._feature_query)), asdict(port_moresby))
+            # The point, the long line and the large polygon
+            self.assertEqual([row[0] for row in cursor.fetchall()], [1, 2, 4])
+
+    def test_size_column(self):
+        roads = MvtQuery(table="osmflex_roadline", min_length=2, size_column="length")
+        self.assertEqual(create_size_indexes(roads), [])
+        self.assertEqual(len(create_size_indexes(replace(roads, size_column=None, min_area=1))), 2)
+
+    def test_create_tile_indexes(self):
+        output = StringIO()
+        call_command("create_tile_indexes", "djangostreetmap.views.LandLayer", "djangostreetmap.views.Roads", "--maxzoom=14", stdout=output)
+        self.assertIn('ON "djangostreetmap_subdividedlandpolygon" ((CASE WHEN ST_Dimension("geom") = 2 THEN ST_AREA("geom") ELSE \'Infinity\' END))', output.getvalue())
+        self.assertIn('ON "osmflex_roadline" ((CASE WHEN ST_Dimension("geom") = 1 THEN ST_LENGTH("geom") ELSE \'Infinity\' END))', output.getvalue())
+
+
+class SubdividedLandTestCase(TestCase):
+    def test_subdivide_land(self):
+        ring = [(math.cos(i * math.tau / 200) * 1e5, math.sin(i * math.tau / 200) * 1e5) for i in range(200)]
+        land = SimplifiedLandPolygon.objects.create(geom=MultiPolygon(Polygon([*ring, ring[0]]), srid=3857))
+        output = StringIO()
+        call_command("subdivide_land", "--max-vertices=16", stdout=output)
+        parts = list(land.parts.all())
+        self.assertEqual(output.getvalue().strip(), f"{len(parts)} pieces of land")
+        self.assertGreater(len(parts), 1)
+        self.assertLessEqual(max(part.geom.num_points for part in parts), 16)
+        self.assertAlmostEqual(sum(part.geom.area for part in parts), land.geom.area, delta=1)
+
+        # Subdividing again replaces the pieces
+        self.assertEqual(SubdividedLandPolygon.subdivide(), 1)
+
+    def test_migration_fills_existing_databases(self):
+        subdivide_land = import_module("djangostreetmap.migrations.0010_subdivide_land").subdivide_land
+        land = SimplifiedLandPolygon.objects.create(geom=MultiPolygon(Polygon([(0, 0), (0, 1e5), (1e5, 1e5), (0, 0)]), srid=3857))
+        subdivide_land(apps, connection.schema_editor())
+        self.assertEqual(land.parts.count(), 1)
+        # Pieces which are already there are kept
+        subdivide_land(apps, connection.schema_editor())
+        self.assertEqual(SubdividedLandPolygon.objects.count(), 1)
+
+
+class SessionSettingsTestCase(TestCase):
+    def test_set_local(self):
+        with connection.cursor() as cursor:
+            rendered = adapt_query(set_local({"jit": "off", "work_mem": "64MB", "max_parallel_workers_per_gather": 4})).as_string(cursor.cursor)
+        self.assertEqual(rendered, "SET LOCAL jit = 'off'; SET LOCAL work_mem = '64MB'; SET LOCAL max_parallel_workers_per_gather = 4; ")
+
+    def test_invalid_name(self):
+        with self.assertRaises(ValueError):
+            set_local({"work_mem = '1GB'; DROP TABLE osmflex_roadline; --": "1"})
+
+    def test_settings_precede_the_tile_query(self):
+        """The tile comes from the last statement of the string"""
+        mvtquery = MvtQuery.from_model(RoadLine, session_settings=HEAVY_LAYER_SESSION_SETTINGS)
+        with connection.cursor() as cursor:
+            cursor.execute(adapt_query(set_local(mvtquery.session_settings) + mvtquery.as_mvt()), asdict(port_moresby))
+            last_result(cursor)
+            tile_response = cursor.fetchone()
+        self.assertIsNotNone(tile_response)
+
+
 class SerializerTestCase(TestCase):
     def setUp(self) -> None:
         BasicPoint.objects.create(name="Pointy point point", geom=Point(1, 1))
@@ -0,0 +1,90 @@
+"""
+Tile layers as server-side functions
+
+A layer's `MvtQuery` can be installed in the database as a function
+`(zoom, x, y, extent, buffer) -> bytea` (see the `install_tile_functions`
+command). A view with `server_functions = True` then sends a short
+`SELECT <function>(...)` instead of the full query text, and Postgres reuses
+the function's cached plan instead of parsing and planning the query again.
+
+Functions are named after their layer and a digest of their definition, so
+changing a layer (or the query parameters of a queryset layer, which are
+bound into the function) installs a new function instead of replacing one
+which running views still call.
+"""
+
+import functools
+import hashlib
+import re
+from collections.abc import Mapping
+
+from psycopg2 import sql
+
+from djangostreetmap.tilegenerator import MultiMvtQuery, MvtQuery
+
+# The arguments of tile functions, in order, named as the `Tile` placeholders they replace
+TILE_FUNCTION_ARGUMENTS = ("zoom", "x", "y", "extent", "buffer")
+
+
+def bind_placeholders(query: sql.Composable, values: Mapping[str, sql.Composable]) -> sql.Composable:
+    """
+    Replace the named `%(name)s` placeholders of a query with SQL, and `%%` with `%`,
+    so that it runs without parameters
+    """
+    if isinstance(query, sql.Composed):
+        return sql.Composed([bind_placeholders(part, values) for part in query.seq])
+    if not isinstance(query, sql.SQL):
+        return query
+    parts: list[sql.Composable] = []
+    for i, piece in enumerate(re.split(r"(%\(\w+\)s|%%)", query.string)):
+        if i % 2 == 0:
+            if piece:
+                parts.append(sql.SQL(piece))
+        elif piece == "%%":
+            parts.append(sql.SQL("%"))
+        else:
+            parts.append(values[piece[2:-2]])
+    return sql.Composed(parts)
+
+
+def function_body(query_layer: MvtQuery | MultiMvtQuery) -> sql.Composable:
+    """
+    A layer's tile query with the tile placeholders replaced by the function
+    arguments (`$1` to `$5`) and its query parameters bound as literals
+    """
+    values: dict[str, sql.Composable] = {name: sql.Literal(value) for name, value in query_layer.query_params.items()}
+    values.update({name: sql.SQL(f"${position}") for position, name in enumerate(TILE_FUNCTION_ARGUMENTS, 1)})
+    return bind_placeholders(query_layer.as_mvt(), values)
+
+
+@functools.lru_cache(maxsize=1024)
+def function_name(query_layer: MvtQuery | MultiMvtQuery, prefix: str = "tile") -> str:
+    """
+    `<prefix>_<layer>_<digest of the function body>`, within the 63 characters of a Postgres name
+    """
+    digest = hashlib.sha256(repr(function_body(query_layer)).encode()).hexdigest()[:12]
+    layer = re.sub(r"\W", "_", query_layer.layer)[:40]
+    return f"{prefix}_{layer}_{digest}"
+
+
+def create_function(query_layer: MvtQuery | MultiMvtQuery, prefix: str = "tile") -> sql.Composed:
+    """
+    The `CREATE FUNCTION` statement for a layer. PL/pgSQL keeps the plan
+    of the query for the rest of the session (SQL functions are re-planned
+    on every call before PostgreSQL 18).
+    """
+    return sql.SQL(
+        """
+        CREATE OR REPLACE FUNCTION {name}(integer, integer, integer, integer, integer) RETURNS bytea
+        LANGUAGE plpgsql STABLE PARALLEL SAFE
+        AS $tile_function$ BEGIN RETURN ({body}); END $tile_function$
+        """
+    ).format(name=sql.Identifier(function_name(query_layer, prefix)), body=function_body(query_layer))
+
+
+def call_function(query_layer: MvtQuery | MultiMvtQuery, prefix: str = "tile") -> sql.Composed:
+    """
+    The query which renders a layer through its installed function
+    """
+    arguments = sql.SQL(", ").join(sql.Placeholder(name) for name in TILE_FUNCTION_ARGUMENTS)
+    return sql.SQL("SELECT {}({})").format(sql.Identifier(function_name(query_layer, prefix)), arguments)
@@ -1,15 +1,29 @@
 import re
-from collections.abc import Iterable, Sequence
-from dataclasses import dataclass, field
-from itertools import count
+from collections.abc import Iterable, Mapping, Sequence
+from dataclasses import dataclass, field, replace
+from functools import cached_property, lru_cache
+from types import MappingProxyType
 from typing import Any
 
 from django.contrib.gis.db.models import GeometryField
+from django.core.exceptions import FieldDoesNotExist
 from psycopg2 import sql
 
 # To time mvt queries uncomment the following
 # from .timer import Timer
 
+# PostgreSQL settings for tile queries, applied with `SET LOCAL`. Tile queries are short:
+# JIT compilation regularly costs more than it saves, and so do parallel workers
+TILE_SESSION_SETTINGS: dict[str, Any] = {"jit": "off", "max_parallel_workers_per_gather": 0}
+# For heavy layers scanning many large geometries, such as low zoom land polygons
+HEAVY_LAYER_SESSION_SETTINGS: dict[str, Any] = {"jit": "off", "work_mem": "64MB", "max_parallel_workers_per_gather": 4, "parallel_setup_cost": 100}
+
+# How `MvtQuery` passes feature attributes to `ST_AsMVT`, see `MvtQuery.attribute_mode`
+ATTRIBUTE_MODES = ("jsonb", "columns")
+
+# The `ST_Dimension` of the geometries which `MvtQuery.min_area` and `min_length` cull
+SIZE_DIMENSIONS = {"ST_AREA": 2, "ST_LENGTH": 1}
+
 
 @dataclass
 class Tile:
@@ -38,12 +52,58 @@ class Tile:
         """
         return sql.SQL("ST_TileEnvelope(%(zoom)s, %(x)s, %(y)s, margin => (%(buffer)s / %(extent)s))")
 
+    @staticmethod
+    def pixel_size_at(zoom: int, extent: int = 4096) -> float:
+        """
+        The width of one of the `extent` pixels of a tile at `zoom` in EPSG:3857 units
+        """
+        return 40075016.68557849 / 2**zoom / extent
 
-@dataclass
+    @staticmethod
+    def pixel_size() -> sql.Composable:
+        """
+        The width of one of the tile's `extent` pixels in EPSG:3857 units
+        """
+        return sql.SQL("(40075016.68557849 / 2 ^ %(zoom)s / %(extent)s)")
+
+
+@dataclass(frozen=True)
+class ZoomBand:
+    """
+    Serve a layer's tiles up to `maxzoom` from another table, with geometries in
+    EPSG:3857: usually a generalised copy of the layer's table, which the
+    `build_generalised_tables` command builds (see `djangostreetmap.generalisation`)
+    unless the band is not `managed`
+    """
+
+    maxzoom: int
+    table: str
+    # Simplify geometries by this many pixels of `maxzoom` tiles
+    simplify: float | None = None
+    # Keep only the rows matching these conditions
+    filters: Sequence[sql.Composable] = ()
+    # Merge the geometries of rows with equal values of these columns (`ST_Union`)
+    dissolve: Sequence[str] | None = None
+    # Columns to keep besides the layer's attributes, such as those its `calculated_attributes` use
+    columns: Sequence[str] = ()
+    managed: bool = True
+
+    def __post_init__(self):
+        object.__setattr__(self, "filters", tuple(self.filters))
+        object.__setattr__(self, "columns", tuple(self.columns))
+        if self.dissolve is not None:
+            object.__setattr__(self, "dissolve", tuple(self.dissolve))
+
+
+@dataclass(frozen=True)
 class MvtQuery:
     """
     This is a SQL query generator based on the example
     at https://postgis.net/docs/manual-dev/ST_AsMVT.html
+
+    Instances are immutable and hashable (see `definition`), and compose
+    their SQL once: define layers once, for instance per zoom band, rather
+    than on every request, so that rendered SQL can be reused.
     """
 
     table: str | sql.Composed | sql.SQL | sql.Identifier
@@ -54,14 +114,85 @@ class MvtQuery:
     # positional placeholders. These must be converted to named placeholders and included
     # in the `query_params` dict below for the final SQL statement to be correctly
     # handled.
-    query_params: dict[str, Any] = field(default_factory=dict)  # These are args to pass to any internal queryset we use where `table` is a Django queryset
-    attributes: list[str] = field(default_factory=list)
-    calculated_attributes: dict[str, sql.Composed | sql.SQL] = field(default_factory=dict)
-    filters: Sequence[sql.Composable] = field(default_factory=list)
+    query_params: Mapping[str, Any] = field(default_factory=dict)  # These are args to pass to any internal queryset we use where `table` is a Django queryset
+    attributes: Sequence[str] = ()
+    calculated_attributes: Mapping[str, sql.Composed | sql.SQL] = field(default_factory=dict)
+    filters: Sequence[sql.Composable] = ()
+    session_settings: Mapping[str, Any] = field(default_factory=dict)  # PostgreSQL settings for this layer, over the view's
     transform: bool = False  # Set to True if source srid is not 3857, but beware performance
     field: str = "geom"
     pk: str = "id"
     layer: str = "default"
+    statement_timeout: int | None = None  # In milliseconds; None uses the view's `statement_timeout`
+    # "jsonb" packs the attributes of each feature into a jsonb object, "columns" selects them
+    # as columns of the layer's CTE, which `ST_AsMVT` encodes without unpacking any JSON
+    attribute_mode: str = "jsonb"
+    # The SRID of `field` where it is not 3857. With `transform`, the tile envelope is then
+    # transformed to it once, so that features are filtered by the column's own spatial index
+    srid: int | None = None
+    # Snap geometries to the tile's pixel grid and simplify them with this tolerance in
+    # pixels before clipping, so low zoom tiles skip sub-pixel vertices; 0 only snaps
+    simplify: float | None = None
+    # Skip polygons smaller than `min_area` square pixels and lines shorter than `min_length`
+    # pixels at the tile's zoom; other geometries are kept. `size_column` may name a column holding
+    # the area or length of the geometry in EPSG:3857 units, to compare instead of computing it for every row
+    min_area: float | None = None
+    min_length: float | None = None
+    size_column: str | None = None
+    # Other tables to serve tiles from up to some zoom, see `for_zoom`
+    zoom_bands: Sequence[ZoomBand] = ()
+
+    def __post_init__(self):
+        if self.attribute_mode not in ATTRIBUTE_MODES:
+            raise ValueError(f"Unknown attribute mode '{self.attribute_mode}', expected one of {ATTRIBUTE_MODES}")
+        # Freeze the collections passed in, so that the layer cannot change after its SQL is composed
+        for name in ("ctes", "attributes", "filters"):
+            object.__setattr__(self, name, tuple(getattr(self, name)))
+        object.__setattr__(self, "zoom_bands", tuple(sorted(self.zoom_bands, key=lambda band: band.maxzoom)))
+        if self.zoom_bands and not isinstance(self.table, str):
+            raise ValueError(f"Layer '{self.layer}' must have a table name for zoom bands")
+        for name in ("query_params", "calculated_attributes", "session_settings"):
+            object.__setattr__(self, name, MappingProxyType(dict(getattr(self, name))))
+
+    @cached_property
+    def definition(self) -> str:
+        """
+        A string identifying this layer: equal layers have equal definitions
+        """
+        return repr(self)
+
+    def __hash__(self) -> int:
+        return hash(self.definition)
+
+    @cached_property
+    def sql_definition(self) -> str:
+        """
+        A string identifying this layer's SQL: its `definition` without the
+        values of `query_params`, which are sent separately
+        """
+        return repr(replace(self, query_params={}))
+
+    def bind(self, **query_params: Any) -> "MvtQuery":
+        """
+        A copy of this layer with (some of) its query parameter values replaced,
+        such as those of `QueryParam` placeholders in a queryset layer
+        """
+        return replace(self, query_params={**self.query_params, **query_params})
+
+    def for_zoom(self, zoom: int, managed: bool = True) -> "MvtQuery":
+        """
+        The layer serving tiles at a zoom level: this one with the table of the
+        first of its `zoom_bands` which includes the zoom, or this one. Without
+        `managed`, bands built by `build_generalised_tables` are skipped.
+        """
+        for band, band_layer in zip(self.zoom_bands, self._band_layers, strict=True):
+            if zoom <= band.maxzoom and (managed or not band.managed):
+                return band_layer
+        return self
+
+    @cached_property
+    def _band_layers(self) -> tuple["MvtQuery", ...]:
+        return tuple(replace(self, table=band.table, transform=False, srid=None, zoom_bands=()) for band in self.zoom_bands)
 
     @property
     def json_attributes(self) -> sql.Composed:
@@ -90,6 +221,28 @@ class MvtQuery:
 
         return sql.SQL(", jsonb_build_object({})").format(composed_params)
 
+    @property
+    def column_attributes(self) -> sql.Composed:
+        """
+        The attributes as columns of the layer's CTE
+        """
+        columns: list[sql.Composable] = [sql.Identifier(a) for a in self.attributes]
+        columns.extend(sql.SQL("{} AS {}").format(expression, sql.Identifier(field_name)) for field_name, expression in self.calculated_attributes.items())
+        if not columns:
+            return sql.SQL("").format()
+        return sql.SQL(", {}").format(sql.SQL(", ").join(columns))
+
+    @property
+    def feature_id(self) -> str:
+        """
+        The column of the layer's CTE which `ST_AsMVT` encodes as the feature id,
+        and leaves out of the attributes. When the primary key is also a column
+        attribute, it is selected a second time under another name.
+        """
+        if self.attribute_mode == "columns" and self.pk in self.attributes:
+            return f"{self.pk}_feature_id"
+        return self.pk
+
     @property
     def transformed_geom(self) -> sql.Composable:
         """
@@ -101,6 +254,20 @@ class MvtQuery:
             template = f"ST_TRANSFORM({template}, 3857)"
         return sql.SQL(template).format(field=sql.Identifier(self.field))
 
+    @property
+    def simplified_geom(self) -> sql.Composable:
+        """
+        The geometry in 3857 snapped to the pixel grid of the tile and
+        simplified by `simplify` pixels, when set
+        https://postgis.net/docs/ST_SnapToGrid.html
+        """
+        if self.simplify is None:
+            return self.transformed_geom
+        snapped = sql.SQL("ST_SNAPTOGRID({}, {})").format(self.transformed_geom, Tile.pixel_size())
+        if not self.simplify:
+            return snapped
+        return sql.SQL("ST_SIMPLIFY({}, {} * {})").format(snapped, sql.Literal(self.simplify), Tile.pixel_size())
+
     @property
     def alias(self) -> sql.Composable:
         """
@@ -110,7 +277,32 @@ class MvtQuery:
 
     @property
     def where(self) -> sql.Composable:
-        return sql.SQL(" AND ") + sql.SQL(" AND ").join(self.filters) if self.filters else sql.SQL("")
+        filters = [*self.size_filters, *self.filters]
+        return sql.SQL(" AND ") + sql.SQL(" AND ").join(filters) if filters else sql.SQL("")
+
+    def size_expression(self, function: str) -> sql.Composable:
+        """
+        The area (`ST_AREA`) or length (`ST_LENGTH`) of features: `size_column`,
+        or the function of the geometry in EPSG:3857. Geometries of another
+        dimension, such as points in a layer culled by area, are infinitely large.
+        """
+        if self.size_column:
+            return sql.Identifier(self.size_column)
+        return sql.SQL(f"CASE WHEN ST_Dimension({{field}}) = {{dimension}} THEN {function}({{geom}}) ELSE 'Infinity' END").format(
+            field=sql.Identifier(self.field), dimension=sql.Literal(SIZE_DIMENSIONS[function]), geom=self.transformed_geom
+        )
+
+    @property
+    def size_filters(self) -> list[sql.Composable]:
+        """
+        Predicates culling features below `min_area` or `min_length` in pixels of the tile
+        """
+        filters: list[sql.Composable] = []
+        if self.min_area is not None:
+            filters.append(sql.SQL("{} >= {} * {} * {}").format(self.size_expression("ST_AREA"), sql.Literal(self.min_area), Tile.pixel_size(), Tile.pixel_size()))
+        if self.min_length is not None:
+            filters.append(sql.SQL("{} >= {} * {}").format(self.size_expression("ST_LENGTH"), sql.Literal(self.min_length), Tile.pixel_size()))
+        return filters
 
     @property
     def as_mvtgeom(self) -> sql.Composable:
@@ -121,17 +313,17 @@ class MvtQuery:
                 {e},
                 extent => %(extent)s,
                 buffer => %(buffer)s
-            ) AS geom, {pk} {json_attributes}
+            ) AS geom, {pk} {attributes}
             FROM {t}
             WHERE {where}
             """
         ).format(
-            cg=self.transformed_geom,
+            cg=self.simplified_geom,
             e=Tile.tile_envelope(),
             t=sql.Identifier(self.table) if isinstance(self.table, str) else self.table,
             # Properties of "self"
-            pk=sql.Identifier(self.pk),
-            json_attributes=self.json_attributes,
+            pk=sql.Identifier(self.pk) if self.feature_id == self.pk else sql.SQL("{} AS {}").format(sql.Identifier(self.pk), sql.Identifier(self.feature_id)),
+            attributes=self.json_attributes if self.attribute_mode == "jsonb" else self.column_attributes,
             where=self._feature_query,
         )
 
@@ -144,33 +336,78 @@ class MvtQuery:
         for MVT clipping without geometry snapping at edges.
         """
         return sql.SQL("""{g} && {m} {where}""").format(
-            g=self.transformed_geom,
-            m=Tile.tile_envelope_margin(),
+            g=self.envelope_filter_geom,
+            m=self.envelope,
             where=self.where,
         )
 
+    @property
+    def envelope_filter_geom(self) -> sql.Composable:
+        """
+        The geometry compared with the tile envelope, which a GiST index
+        must be on for the filter to use it: the column itself, unless
+        it is transformed and its SRID is not known
+        """
+        if self.transform and self.srid is None:
+            return self.transformed_geom
+        return sql.Identifier(self.field)
+
+    @property
+    def envelope(self) -> sql.Composable:
+        """
+        The tile envelope with its margin, in the SRID of `envelope_filter_geom`
+        """
+        if self.transform and self.srid is not None:
+            return sql.SQL("ST_TRANSFORM({}, {})").format(Tile.tile_envelope_margin(), sql.Literal(self.srid))
+        return Tile.tile_envelope_margin()
+
+    @property
+    def cte_names(self) -> list[sql.Composable]:
+        """
+        The names of every common table expression this layer declares,
+        including the final `mvt_<layer>` alias
+        """
+        return [name for name, _ in self.ctes] + [self.alias]
+
+    def get_ctes(self) -> list[sql.Composed]:
+        """
+        The individual common table expressions, without the leading `WITH`
+        """
+        return [sql.SQL("{} AS (select {})").format(*_cte) for _cte in (*self.ctes, ((self.alias, self.as_mvtgeom)))]
+
     def get_cte_sql(self) -> sql.Composed:
         """
         The common table expressions we use, composed to
         an appropriate format for the query
         """
+        return (sql.SQL("WITH ") + sql.SQL(",").join(self.get_ctes())).join(" ")
 
-        gen = (sql.SQL("{} AS (select {})").format(*_cte) for _cte in (*self.ctes, ((self.alias, self.as_mvtgeom))))
-        return (sql.SQL("WITH ") + sql.SQL(",").join(gen)).join(" ")
+    @property
+    def mvt_select(self) -> sql.Composed:
+        """
+        The `ST_AsMVT` aggregate over this layer's CTE
+        """
+        inner_query = sql.SQL(" SELECT ST_AsMVT( {alias}.*, {layer}, %(extent)s, 'geom', {pk}) FROM {alias}")
+        return inner_query.format(alias=self.alias, layer=sql.Literal(self.layer), pk=sql.Literal(self.feature_id))
 
     def as_mvt(self) -> sql.Composed:
+        return self._mvt
+
+    @cached_property
+    def _mvt(self) -> sql.Composed:
         outer_query = self.get_cte_sql()
-        inner_query = sql.SQL(" SELECT ST_AsMVT( {alias}.*, {layer}, %(extent)s, 'geom', {pk}) FROM {alias}")
-        parameters = dict(alias=self.alias, layer=sql.Literal(self.layer), inner_query=self.as_mvtgeom, pk=sql.Literal(self.pk))
-        return (outer_query + inner_query.format(**parameters)).join(" ")
+        return (outer_query + self.mvt_select).join(" ")
 
     @classmethod
     def from_model(cls, model, *args, **kwargs) -> "MvtQuery":
         field = kwargs.pop("field", get_geom_field(model))
         attributes = kwargs.pop("attributes", get_model_attributes(model))
         pk = kwargs.get("pk", get_model_pk_field(model))
-        transform = model._meta.get_field(field).srid != 3857
-        return cls(table=model._meta.db_table, attributes=attributes, field=field, transform=transform, pk=pk, layer=kwargs.pop("layer", model._meta.model_name), **kwargs)
+        srid = kwargs.pop("srid", model._meta.get_field(field).srid)
+        transform = srid != 3857
+        return cls(
+            table=model._meta.db_table, attributes=attributes, field=field, transform=transform, srid=srid, pk=pk, layer=kwargs.pop("layer", model._meta.model_name), **kwargs
+        )
 
     @classmethod
     def from_queryset(
@@ -181,15 +418,17 @@ class MvtQuery:
         This requires more configureation than calling from a model
         as querysets are a little harder to introspect
         """
-        # Replace some parts of the Django sql
-        # to make it work as a CTE
-        django_sql, query_params = convert_to_positional_query(queryset)
+        layer = kwargs.pop("layer", queryset.model._meta.model_name)
 
         # Our django queryset will become a common table expression AKA "with" statement
-        cte_name = sql.Identifier("django_queryset")
-        if django_sql.startswith("SELECT"):
-            django_sql = django_sql[6:]
-        django_sql = django_sql.replace("::bytea", "")
+        # The CTE and parameter names include the layer so that several querysets
+        # can share one statement (see `MultiMvtQuery`)
+        cte_name = sql.Identifier(f"django_queryset_{layer}")
+
+        # Django's SQL for the queryset, made to work as a CTE (see `queryset_cte_sql`)
+        django_sql, args = queryset.query.sql_with_params()
+        cte_sql, names = queryset_cte_sql(django_sql, prefix=f"{layer}_param")
+        query_params = dict(zip(names, args, strict=True))
 
         # When primary key is not specified, detect it from the model
         # Note that if using a queryset this means you need to include it in .values()
@@ -202,20 +441,146 @@ class MvtQuery:
         if transform is None:
             transform = False
 
+        # The SRID of a model's geometry field, so that the tile envelope can be transformed instead of the field
+        if transform and "srid" not in kwargs:
+            try:
+                kwargs["srid"] = queryset.model._meta.get_field(field).srid
+            except (FieldDoesNotExist, AttributeError):
+                pass
+
         instance = cls(
             table=cte_name,
-            ctes=((cte_name, sql.SQL(django_sql)),),
+            ctes=((cte_name, cte_sql),),
             query_params=query_params,
             attributes=attributes,
             field=field,
             transform=transform,
             pk=pk,
-            layer=kwargs.pop("layer", queryset.model._meta.model_name),
+            layer=layer,
             **kwargs,
         )
         return instance
 
 
+@dataclass(frozen=True)
+class MultiMvtQuery:
+    """
+    Several `MvtQuery` layers compiled into a single statement, so that
+    a tile with N layers costs one round trip and one planner invocation
+    instead of N.
+
+    Each layer keeps its own common table expressions and the `ST_AsMVT`
+    results are concatenated with `||` (concatenated MVT layers are a valid
+    MVT tile). This exposes the same `query_params` / `as_mvt()` interface
+    as `MvtQuery`.
+    """
+
+    layers: Sequence[MvtQuery]
+
+    def __post_init__(self):
+        object.__setattr__(self, "layers", tuple(self.layers))
+
+    @cached_property
+    def definition(self) -> str:
+        return repr(self)
+
+    def __hash__(self) -> int:
+        return hash(self.definition)
+
+    @cached_property
+    def sql_definition(self) -> str:
+        return repr(tuple(query_layer.sql_definition for query_layer in self.layers))
+
+    @property
+    def layer(self) -> str:
+        return ",".join(query_layer.layer for query_layer in self.layers)
+
+    @property
+    def statement_timeout(self) -> int | None:
+        """
+        The longest timeout of any layer which sets one
+        """
+        timeouts = [query_layer.statement_timeout for query_layer in self.layers if query_layer.statement_timeout is not None]
+        return max(timeouts) if timeouts else None
+
+    @property
+    def session_settings(self) -> dict[str, Any]:
+        """
+        The settings of every layer; where layers disagree the last one wins
+        """
+        return {name: value for query_layer in self.layers for name, value in query_layer.session_settings.items()}
+
+    @property
+    def query_params(self) -> dict[str, Any]:
+        params: dict[str, Any] = {}
+        for query_layer in self.layers:
+            for key, value in query_layer.query_params.items():
+                if key in params and params[key] != value:
+                    raise ValueError(f"Layer '{query_layer.layer}' redefines the query parameter '{key}'")
+                params[key] = value
+        return params
+
+    def get_ctes(self) -> list[sql.Composed]:
+        # CTE names are usually identifiers, but may be any composable
+        seen: set[str] = set()
+        for query_layer in self.layers:
+            for name in query_layer.cte_names:
+                if repr(name) in seen:
+                    raise ValueError(f"Layer '{query_layer.layer}' redefines the common table expression {name!r}")
+                seen.add(repr(name))
+        return [cte for query_layer in self.layers for cte in query_layer.get_ctes()]
+
+    def as_mvt(self) -> sql.Composed:
+        return self._mvt
+
+    @cached_property
+    def _mvt(self) -> sql.Composed:
+        # A layer without features returns NULL from ST_AsMVT; keep it from nulling the whole tile
+        layer_tiles = (sql.SQL("COALESCE(({}), ''::bytea)").format(query_layer.mvt_select) for query_layer in self.layers)
+        return (sql.SQL("WITH ") + sql.SQL(",").join(self.get_ctes()) + sql.SQL(" SELECT ") + sql.SQL(" || ").join(layer_tiles)).join(" ")
+
+
+def set_local(session_settings: Mapping[str, Any]) -> sql.Composed:
+    """
+    `SET LOCAL` statements for some PostgreSQL settings, each followed by a semicolon
+    """
+    statements = []
+    for name, value in session_settings.items():
+        if not re.fullmatch(r"[A-Za-z_][A-Za-z0-9_]*(\.[A-Za-z_][A-Za-z0-9_]*)?", name):
+            raise ValueError(f"Invalid setting name '{name}'")
+        statements.append(sql.SQL("SET LOCAL {} = {}; ").format(sql.SQL(name), sql.Literal(value)))
+    return sql.Composed(statements)
+
+
+def create_envelope_index(query_layer: MvtQuery) -> sql.Composed:
+    """
+    `CREATE INDEX` for the transformed geometry of a layer with `transform`
+    and no `srid`, which the column's own spatial index cannot serve
+    """
+    if not isinstance(query_layer.table, str) or not query_layer.transform or query_layer.srid is not None:
+        raise ValueError(f"Layer '{query_layer.layer}' needs no index on a transformed geometry")
+    name = f"{query_layer.table}_{query_layer.field}"[:50] + "_3857_gist"
+    return sql.SQL("CREATE INDEX IF NOT EXISTS {} ON {} USING GIST (({}))").format(sql.Identifier(name), sql.Identifier(query_layer.table), query_layer.envelope_filter_geom)
+
+
+def create_size_indexes(query_layer: MvtQuery) -> list[sql.Composed]:
+    """
+    `CREATE INDEX` for the area or length expressions which a layer without
+    `size_column` culls features by, so that the comparison can use an index
+    """
+    if not isinstance(query_layer.table, str) or query_layer.size_column:
+        return []
+    statements = []
+    for function, minimum in (("ST_AREA", query_layer.min_area), ("ST_LENGTH", query_layer.min_length)):
+        if minimum is not None:
+            # Not the names of the indexes on the plain function, which culled other geometries too
+            name = f"{query_layer.table}_{query_layer.field}"[:50] + f"_dim_{function[3:].lower()}"
+            statements.append(
+                sql.SQL("CREATE INDEX IF NOT EXISTS {} ON {} (({}))").format(sql.Identifier(name), sql.Identifier(query_layer.table), query_layer.size_expression(function))
+            )
+    return statements
+
+
 def get_geom_field(model) -> str:
     """
     Returns the first field likely to be a geometry field
@@ -244,14 +609,45 @@ def get_model_pk_field(model) -> str:
     raise KeyError(f"No primary key field could be identified for {model}")
 
 
-def convert_to_positional_query(queryset):
+# Positional `%s` placeholders and escaped `%%` percent signs in Django's SQL
+POSITIONAL_PLACEHOLDER = re.compile(r"%%|%s")
+
+
+def positional_to_named(django_sql: str, prefix: str = "param") -> tuple[str, list[str]]:
+    """
+    Rename the positional `%s` placeholders of Django's SQL to `%(<prefix>_N)s`,
+    returning the new SQL and the names in order. Percent signs within the SQL,
+    including string literals, are escaped as `%%` and left as they are: a
+    literal `'%%s'` is not a placeholder.
+    """
+    names: list[str] = []
+
+    def rename(match: re.Match) -> str:
+        if match.group() == "%%":
+            return "%%"
+        names.append(f"{prefix}_{len(names)}")
+        return f"%({names[-1]})s"
+
+    return POSITIONAL_PLACEHOLDER.sub(rename, django_sql), names
+
+
+@lru_cache(maxsize=256)
+def queryset_cte_sql(django_sql: str, prefix: str = "param") -> tuple[sql.SQL, tuple[str, ...]]:
+    """
+    Django's SQL for a queryset as the body of a CTE, with named placeholders,
+    and the names of its parameters in order. This is only worked out once for
+    queries compiling to the same SQL, whatever their parameter values.
+    """
+    named_sql, names = positional_to_named(django_sql, prefix)
+    return sql.SQL(re.sub(r"^\s*SELECT\b", "", named_sql).replace("::bytea", "")), tuple(names)
+
+
+def convert_to_positional_query(queryset, prefix: str = "param"):
     """
     From a Django queryset, convert the placeholders to named ones
     in order to enable combining with other parts of this module
     """
-    # Initialise a new counter for the named parameters
-    c = count()
     django_sql, args = queryset.query.sql_with_params()
-    positional_sql = re.sub("%s", lambda x: f"%(param_{next(c)})s", django_sql)
-    query_params = {f"param_{i}": param for i, param in enumerate(args)}
+    positional_sql, names = positional_to_named(django_sql, prefix)
+    query_params = dict(zip(names, args, strict=True))
     return positional_sql, query_params
@@ -1,29 +1,42 @@
-import hashlib
+import functools
+import gzip
 import logging
-from collections.abc import Sequence
-from dataclasses import asdict
+import threading
+from collections.abc import Callable, Iterable, Sequence
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from dataclasses import asdict, replace
 from typing import Any
 
 from django.apps import apps
 from django.contrib.gis.db.models.functions import Centroid, Transform
-from django.db import connection
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
+from django.db import connection, transaction
 from django.db.models import Model
-from django.http import HttpRequest, JsonResponse
-from django.http.response import HttpResponse
+from django.http import FileResponse, Http404, HttpRequest, JsonResponse
+from django.http.response import HttpResponse, HttpResponseBase
 from django.urls import reverse
+from django.utils.cache import get_conditional_response, patch_vary_headers
+from django.utils.http import quote_etag
 from django.views import View
 from django.views.generic.base import TemplateView
 from osmflex.models import AmenityPoint, OsmLine, OsmPoint, OsmPolygon, RoadLine
 from psycopg2 import sql
 
 from djangostreetmap import models
+from djangostreetmap.admission import ALL_LAYERS, TileOverloaded, admit
 from djangostreetmap.annotations import (
     GeoJsonSerializer,
     MultiGeoJsonSerializer,
     TileCache,
 )
+from djangostreetmap.cache import LayerVersions, content_digest, get_many, set_many, tile_cache_key
+from djangostreetmap.coalesce import CacheLock, SingleFlight
+from djangostreetmap.driver import adapt_query, as_bytes, binary_results, last_result, render
 from djangostreetmap.functions import AsFeatureCollection, Intersects
-from djangostreetmap.tilegenerator import MvtQuery, Tile
+from djangostreetmap.pmtiles import open_archive
+from djangostreetmap.tilefunctions import call_function
+from djangostreetmap.tilegenerator import TILE_SESSION_SETTINGS, MultiMvtQuery, MvtQuery, Tile, ZoomBand, set_local
 from maplibre import layer, sources
 from maplibre.basemodel import Root
 from maplibre.layer import Layer as L
@@ -32,6 +45,37 @@ from .timer import Timer
 
 logger = logging.getLogger(__name__)
 
+# Keys of the stale tiles being refreshed in the background by this process
+_refreshing: set[str] = set()
+_refreshing_lock = threading.Lock()
+
+# Taken before the `SET LOCAL` of a tile query inside a transaction of the caller's, and
+# rolled back to after it, so that the settings do not last until that transaction ends
+TILE_SAVEPOINT = "djangostreetmap_tile"
+
+
+class TileIncomplete(Exception):
+    """
+    Raised when a tile rendered with `strict` (see `TileLayerView._generate_tile`)
+    has a layer which failed or is stale
+    """
+
+
+@functools.lru_cache(maxsize=256)
+def combined_layers(layers: tuple[MvtQuery, ...]) -> MultiMvtQuery:
+    """
+    The same `MultiMvtQuery` for the same layers, so that its SQL is composed once
+    """
+    return MultiMvtQuery(layers=layers)
+
+
+@functools.lru_cache(maxsize=256)
+def simplified_layer(query_layer: MvtQuery, simplify: float) -> MvtQuery:
+    """
+    A layer with a view's default `simplify`, unless it sets its own
+    """
+    return query_layer if query_layer.simplify is not None else replace(query_layer, simplify=simplify)
+
 
 class ExampleMapView(TemplateView):
     template_name = "leaflet_tile_layers.html"
@@ -52,6 +96,55 @@ class TileLayerView(View):
 
     layers: list[MvtQuery] = []
     tilecache: TileCache | None = None
+    # Cache keys are `<cache_prefix>:<layer>@<cache_version>.<data version>:<z>/<x>/<y>:<extent>:<buffer>`.
+    # Bump `cache_version` when a layer definition changes. Data versions come from
+    # `layer_versions` (see `bump_tile_version`) and are 0 without it.
+    cache_prefix: str = "tile"
+    cache_version: int = 1
+    layer_versions: LayerVersions | None = None
+    # Also cache each assembled tile, so that a hit costs one lookup for all layers
+    cache_whole_tile: bool = False
+    # How long tiles stay fresh; None uses the default timeout of `tilecache`
+    cache_timeout: int | None = None
+    # Keep tiles this many seconds past their freshness. Stale tiles are returned at once
+    # while a background refresh runs (or, without `cache_stale_while_revalidate`, after
+    # a refresh fails), so a slow or failing database does not blank the map
+    cache_stale_timeout: int = 0
+    cache_stale_while_revalidate: bool = True
+    refresh_executor: ThreadPoolExecutor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="tile-refresh")
+    # Compile every layer of a tile into one SQL statement (one round trip per tile)
+    single_statement: bool = False
+    # Render each tile layer once when identical requests arrive together: in-process,
+    # and across processes through a lock in `tilecache` (which must support `add`)
+    coalesce: bool = False
+    coalesce_timeout: float = 10
+    singleflight: SingleFlight[bytes | None] = SingleFlight()
+    # Call each layer's function installed by `install_tile_functions` instead of sending
+    # its query, so that Postgres reuses the plan. Layers without a function fail
+    server_functions: bool = False
+    function_prefix: str = "tile"
+    # PostgreSQL settings applied with `SET LOCAL` to each tile query, updated with
+    # `MvtQuery.session_settings`. See also `HEAVY_LAYER_SESSION_SETTINGS`
+    session_settings: dict[str, Any] = TILE_SESSION_SETTINGS
+    # Cancel tile queries running longer than this many milliseconds; layers may
+    # override it with `MvtQuery.statement_timeout`. None uses the database setting
+    statement_timeout: int | None = None
+    # Admission control: run at most this many tile queries at once in this process,
+    # in total and per layer. A query waits `admission_timeout` seconds for a slot, then
+    # a stale tile or a 503 response asking to retry after `overload_retry_after` is returned
+    max_concurrent_queries: int | None = None
+    max_concurrent_layer_queries: int | None = None
+    admission_timeout: float = 1
+    overload_retry_after: int = 5
+    # Send the digest of each tile (see `content_digest`) as its ETag and answer
+    # requests for unchanged tiles with 304. Identical tiles share an ETag
+    etag: bool = False
+    # Simplify the geometries of layers which do not set `MvtQuery.simplify`
+    # by this tolerance in pixels (see `MvtQuery.simplify`)
+    simplify: float | None = None
+    # Serve layers from the generalised tables of their `zoom_bands`. These only exist
+    # once `build_generalised_tables` has run; until then, layers read their own table
+    generalised: bool = False
 
     def get_layers(self, tile: Tile) -> list[MvtQuery]:
         """
@@ -60,52 +153,415 @@ class TileLayerView(View):
         """
         return self.layers
 
-    def _generate_tile(self, tile: Tile) -> list[bytes]:
-        params = asdict(tile)
+    def get_query_layers(self, tile: Tile) -> Sequence[MvtQuery | MultiMvtQuery]:
+        """
+        The queries to execute for a tile: either one per layer or,
+        with `single_statement`, one for all layers
+        """
+        # Each layer served from the table of its zoom band, see `MvtQuery.zoom_bands`
+        layers = [query_layer.for_zoom(tile.zoom, managed=self.generalised) for query_layer in self.get_layers(tile)]
+        if self.simplify is not None:
+            layers = [simplified_layer(query_layer, self.simplify) for query_layer in layers]
+        if self.single_statement and len(layers) > 1:
+            return [combined_layers(tuple(layers))]
+        return layers
+
+    def get_layer_version(self, layer: str) -> str:
+        data_version = self.layer_versions.get(layer) if self.layer_versions else 0
+        return f"{self.cache_version}.{data_version}"
+
+    def _cache_key(self, query_layer: MvtQuery | MultiMvtQuery, tile: Tile) -> str:
+        layers = query_layer.layers if isinstance(query_layer, MultiMvtQuery) else [query_layer]
+        return tile_cache_key(
+            self.cache_prefix,
+            ((single_layer.layer, self.get_layer_version(single_layer.layer)) for single_layer in layers),
+            tile,
+            query_layer.query_params,
+        )
+
+    def _fresh_timeout(self) -> int:
+        if self.cache_timeout is not None:
+            return self.cache_timeout
+        return getattr(self.tilecache, "default_timeout", 300)
 
+    def _cache_lookup_keys(self, keys: Iterable[str]) -> list[str]:
+        """
+        The cache keys to read for some tiles, including their freshness markers
+        """
+        keys = list(keys)
+        if self.cache_stale_timeout:
+            return keys + [f"{key}:fresh" for key in keys]
+        return keys
+
+    def _cached_content(self, cached: dict[str, Any], key: str | None) -> tuple[bytes | None, bool]:
+        """
+        A tile from the result of `get_many`, and whether it is still fresh
+        """
+        if not key:
+            return None, False
+        return cached.get(key), not self.cache_stale_timeout or f"{key}:fresh" in cached
+
+    def _cache_writes(self, data: dict[str, bytes]) -> list[tuple[dict[str, bytes], Any]]:
+        """
+        The `set_many` calls (entries and timeout) which store some tiles. With
+        `cache_stale_timeout`, a tile is kept past its freshness, which a separate
+        marker key records.
+        """
+        if not self.cache_stale_timeout:
+            return [(data, DEFAULT_TIMEOUT if self.cache_timeout is None else self.cache_timeout)]
+        fresh = self._fresh_timeout()
+        return [(data, fresh + self.cache_stale_timeout), ({f"{key}:fresh": b"1" for key in data}, fresh)]
+
+    def _cache_write(self, data: dict[str, bytes]) -> None:
+        if self.tilecache and data:
+            for entries, timeout in self._cache_writes(data):
+                set_many(self.tilecache, entries, timeout)
+
+    def _cache_read_fresh(self, key: str) -> bytes | None:
+        if not self.tilecache:
+            return None
+        content_bytes, fresh = self._cached_content(get_many(self.tilecache, self._cache_lookup_keys([key])), key)
+        return content_bytes if fresh else None
+
+    def get_session_settings(self, query_layer: MvtQuery | MultiMvtQuery) -> dict[str, Any]:
+        """
+        The PostgreSQL settings to run a layer's query with
+        """
+        session_settings = {**self.session_settings, **query_layer.session_settings}
+        statement_timeout = query_layer.statement_timeout if query_layer.statement_timeout is not None else self.statement_timeout
+        if statement_timeout is not None:
+            session_settings["statement_timeout"] = statement_timeout
+        return session_settings
+
+    def _admission_limits(self, query_layer: MvtQuery | MultiMvtQuery) -> list[tuple[str, int | None]]:
+        # Per layer first, so that a query queued behind its own layer does not hold a global slot
+        return [(query_layer.layer, self.max_concurrent_layer_queries), (ALL_LAYERS, self.max_concurrent_queries)]
+
+    def get_query(self, query_layer: MvtQuery | MultiMvtQuery) -> sql.Composable:
+        """
+        The SQL rendering a layer: its query or, with `server_functions`, a call to its function
+        """
+        if self.server_functions:
+            return call_function(query_layer, self.function_prefix)
+        return query_layer.as_mvt()
+
+    def _layer_sql(self, query_layer: MvtQuery | MultiMvtQuery, context, convert: Callable[[sql.Composable], Any] = adapt_query) -> tuple[str, str]:
+        """
+        The SQL text of a layer's session settings and tile query, composed and
+        rendered (for the driver cursor or connection `context`) once per layer definition,
+        whatever the values of its query parameters
+        """
+        session_settings = self.get_session_settings(query_layer)
+        settings_sql = ""
+        if session_settings:
+            settings_sql = render(("settings", convert, *session_settings.items()), lambda: convert(set_local(session_settings)), context)
+        # Query parameter values are sent separately, except to server functions which bind them
+        query_key = query_layer if self.server_functions else query_layer.sql_definition
+        query_sql = render(("query", convert, query_key, self.server_functions, self.function_prefix), lambda: convert(self.get_query(query_layer)), context)
+        return settings_sql, query_sql
+
+    def _fetch_layer(self, query_layer: MvtQuery | MultiMvtQuery, params: dict[str, Any]) -> bytes | None:
+        """
+        Execute a layer's tile query, returning None if it failed. With psycopg 3
+        and server-side binding the tile is transferred as a binary result; its
+        session settings then need a statement of their own, in a transaction.
+        Inside a transaction already (with `ATOMIC_REQUESTS`, say) the settings
+        are undone by rolling back to a savepoint after the query, which costs
+        one more round trip; the tile query changes nothing else.
+        """
+        query_sql = ""
         with connection.cursor() as cursor:
-            tiles: list[bytes] = []
-            for query_layer in self.get_layers(tile):
-                params.update(query_layer.query_params)
-                query = query_layer.as_mvt()
-                with Timer(name="tile generator", logger=logger.info):
-                    tile_response: Sequence | None = None
-                    key: str | None = None
-
-                    if self.tilecache:
-                        key = hashlib.sha256(f"{query}, {params}".encode()).hexdigest()[:8]
-
-                    if self.tilecache and key:
-                        content_bytes: bytes | None = self.tilecache.get(key)
-                        if content_bytes is not None:
-                            logger.info("Cached tile returning")
-                            tiles.append(content_bytes)
-                            continue
-                        logger.info("No tile cached")
-
-                    try:
-                        cursor.execute(query, params)  # type: ignore
+            try:
+                settings_sql, query_sql = self._layer_sql(query_layer, cursor.cursor)
+                undo = bool(settings_sql) and connection.in_atomic_block
+                if undo:
+                    settings_sql = f"SAVEPOINT {TILE_SAVEPOINT}; {settings_sql}"
+                try:
+                    if binary_results(cursor) and settings_sql:
+                        with nullcontext() if undo else transaction.atomic():
+                            cursor.execute(settings_sql)
+                            cursor.execute(query_sql, params)
+                            tile_response: Sequence | None = cursor.fetchone()
+                    else:
+                        # Sent as one string, all statements run in one implicit transaction
+                        # which `SET LOCAL` lasts for, so the settings cost no extra round trip
+                        cursor.execute(settings_sql + query_sql, params)
+                        last_result(cursor)
                         tile_response = cursor.fetchone()
-                    except Exception as E:
-                        logger.error(f"{E}")
-                        logger.info(query.as_string(cursor.cursor))
-                    if not tile_response:
-                        continue
-                    content: memoryview = tile_response[0]
-                    new_content_bytes: bytes = content.tobytes()
-                    if new_content_bytes:
-                        tiles.append(new_content_bytes)
+                finally:
+                    if undo:
+                        cursor.execute(f"ROLLBACK TO SAVEPOINT {TILE_SAVEPOINT}; RELEASE SAVEPOINT {TILE_SAVEPOINT}")
+            except Exception as E:
+                logger.error(f"{E}")
+                logger.info(query_sql)
+                return None
+        return as_bytes(tile_response[0]) if tile_response else b""
+
+    def _render_layer(self, query_layer: MvtQuery | MultiMvtQuery, tile: Tile, key: str | None, pending: dict[str, bytes]) -> bytes | None:
+        """
+        Fetch a layer and queue it in `pending` to be written to the cache.
+        With `coalesce`, a lock in the cache ensures that only one process
+        renders a given layer at a time; the others wait for its result to
+        appear in the cache, so in that case it is written immediately.
+        Raises `TileOverloaded` when the query is not admitted in time.
+        """
+        lock: CacheLock | None = None
+        if self.coalesce and self.tilecache and key and CacheLock.supported(self.tilecache):
+            lock = CacheLock(self.tilecache, f"{key}:lock", timeout=self.coalesce_timeout)
+            if not lock.acquire():
+                # A stale tile in the cache is what this render replaces: wait for a fresh one
+                content_bytes: bytes | None = lock.wait_for(key, read=lambda: self._cache_read_fresh(key))
+                if content_bytes is not None:
+                    logger.info("Tile rendered by another process")
+                    return content_bytes
+                logger.warning("Timed out waiting for another process to render tile")
+                lock = None
+            else:
+                # Another process may have finished rendering while we acquired the lock
+                content_bytes = self._cache_read_fresh(key)
+                if content_bytes is not None:
+                    lock.release()
+                    return content_bytes
+
+        try:
+            params = {**asdict(tile), **query_layer.query_params}
+            with admit(self._admission_limits(query_layer), self.admission_timeout):
+                new_content_bytes = self._fetch_layer(query_layer, params)
+            if key and new_content_bytes is not None:
+                if lock:
+                    self._cache_write({key: new_content_bytes})
+                else:
+                    pending[key] = new_content_bytes
+            return new_content_bytes
+        finally:
+            if lock:
+                lock.release()
+
+    def _generate_layer(self, query_layer: MvtQuery | MultiMvtQuery, tile: Tile, key: str | None, pending: dict[str, bytes]) -> bytes | None:
+        """
+        Render the MVT bytes of one layer (or of several, for a `MultiMvtQuery`)
+        which was not in the cache, or None if the query failed
+        """
+        with Timer(name="tile generator", logger=logger.info):
+            if self.coalesce and key:
+                # Concurrent requests for this layer in this process share one render
+                return self.singleflight.do(key, lambda: self._render_layer(query_layer, tile, key, pending))
+            return self._render_layer(query_layer, tile, key, pending)
 
-                    if self.tilecache and key:
-                        self.tilecache.set(key, new_content_bytes)
+    def _refresh_layer(self, query_layer: MvtQuery | MultiMvtQuery, tile: Tile, key: str) -> None:
+        """
+        Re-render a stale layer in the background
+        """
+        lock = CacheLock(self.tilecache, f"{key}:refresh", timeout=self.coalesce_timeout) if CacheLock.supported(self.tilecache) else None
+        try:
+            # Only one process refreshes a given tile
+            if lock and not lock.acquire():
+                return
+            pending: dict[str, bytes] = {}
+            self._generate_layer(query_layer, tile, key, pending)
+            self._cache_write(pending)
+        except Exception as E:
+            logger.error(f"Refreshing tile failed: {E}")
+        finally:
+            if lock:
+                lock.release()
+            with _refreshing_lock:
+                _refreshing.discard(key)
+            # This thread's database connection
+            connection.close()
+
+    def _schedule_refresh(self, query_layer: MvtQuery | MultiMvtQuery, tile: Tile, key: str) -> None:
+        with _refreshing_lock:
+            if key in _refreshing:
+                return
+            _refreshing.add(key)
+        self.refresh_executor.submit(self._refresh_layer, query_layer, tile, key)
+
+    def _generate_query_layers(self, query_layers: Sequence[MvtQuery | MultiMvtQuery], tile: Tile, pending: dict[str, bytes], stale: set[str]) -> list[bytes | None]:
+        """
+        The MVT bytes of each query layer, None where a query failed.
+        Cached layers are read with a single `get_many`; the keys of stale
+        layers which were returned are added to `stale`. Raises `TileOverloaded`
+        when a layer without a stale copy could not be admitted.
+        """
+        keys: list[str | None] = [self._cache_key(query_layer, tile) if self.tilecache or self.coalesce else None for query_layer in query_layers]
+        cached = get_many(self.tilecache, self._cache_lookup_keys(key for key in keys if key)) if self.tilecache else {}
+
+        contents: list[bytes | None] = []
+        for query_layer, key in zip(query_layers, keys, strict=True):
+            content, fresh = self._cached_content(cached, key)
+            if content is not None and fresh:
+                logger.info("Cached tile returning")
+            elif content is not None and key and self.cache_stale_while_revalidate:
+                logger.info("Stale tile returning")
+                stale.add(key)
+                self._schedule_refresh(query_layer, tile, key)
+            else:
+                try:
+                    new_content = self._generate_layer(query_layer, tile, key, pending)
+                except TileOverloaded:
+                    if content is None or not key:
+                        raise
+                    new_content = None
+                if new_content is None and content is not None and key:
+                    logger.warning("Tile query failed, returning stale tile")
+                    stale.add(key)
+                else:
+                    content = new_content
+            if content is None and isinstance(query_layer, MultiMvtQuery):
+                # Fall back to one statement per layer so that a single
+                # broken layer does not blank the whole tile
+                contents.extend(self._generate_query_layers(query_layer.layers, tile, pending, stale))
+            else:
+                contents.append(content)
+        return contents
+
+    def _generate_layers(self, tile: Tile) -> tuple[list[bytes], bool]:
+        """
+        The MVT bytes of each layer, and whether every layer was generated fresh.
+        New layers are written to the cache with a single `set_many`.
+        """
+        pending: dict[str, bytes] = {}
+        stale: set[str] = set()
+        try:
+            contents = self._generate_query_layers(self.get_query_layers(tile), tile, pending, stale)
+        finally:
+            # Keep the layers rendered before an overload
+            self._cache_write(pending)
+        return [content for content in contents if content], None not in contents and not stale
+
+    def _generate_tile(self, tile: Tile, strict: bool = False) -> list[bytes]:
+        """
+        The MVT bytes of a tile's layers. Layers which failed are left out, or
+        the whole tile is replaced by a stale copy; with `strict`, for tiles
+        rendered ahead of requests, `TileIncomplete` is raised instead.
+        """
+        key: str | None = None
+        stale_tile: bytes | None = None
+        if self.tilecache and self.cache_whole_tile:
+            key = self._cache_key(MultiMvtQuery(layers=self.get_layers(tile)), tile)
+            content_bytes, fresh = self._cached_content(get_many(self.tilecache, self._cache_lookup_keys([key])), key)
+            if content_bytes is not None and fresh:
+                logger.info("Cached whole tile returning")
+                return [content_bytes] if content_bytes else []
+            stale_tile = content_bytes
+
+        try:
+            tiles, complete = self._generate_layers(tile)
+        except TileOverloaded:
+            if stale_tile is None or strict:
+                raise
+            logger.warning("Database overloaded, returning stale whole tile")
+            return [stale_tile] if stale_tile else []
+
+        if not complete and strict:
+            raise TileIncomplete(f"Tile {tile.zoom}/{tile.x}/{tile.y} has failed or stale layers")
+        if not complete and stale_tile is not None:
+            logger.warning("Tile incomplete, returning stale whole tile")
+            return [stale_tile] if stale_tile else []
+        # Never cache a whole tile with missing or stale layers
+        if key and complete:
+            # Join the layers once; `get` then returns the same buffer without copying
+            tiles = [b"".join(tiles)]
+            self._cache_write({key: tiles[0]})
+        return tiles
+
+    def overloaded(self, error: TileOverloaded) -> HttpResponse:
+        """
+        The response when a tile could not be rendered for lack of database capacity
+        """
+        logger.warning(f"{error}")
+        return HttpResponse(status=503, headers={"Retry-After": str(self.overload_retry_after)})
 
-            return tiles
+    def _cached_file(self, request: HttpRequest, tile: Tile) -> HttpResponseBase | None:
+        """
+        A response sending the file of a fresh cached tile as it is, when `tilecache`
+        keeps tiles in files (see `FileTileCache`) and one cache entry holds the
+        whole tile: with `cache_whole_tile` or a single query layer. Servers with
+        `wsgi.file_wrapper` (gunicorn, uWSGI) send it with `sendfile`. With `etag`,
+        only from caches which know the tile's digest (`ContentAddressedTileCache`).
+        """
+        cached_file = getattr(self.tilecache, "file", None)
+        if not callable(cached_file):
+            return None
+        if self.cache_whole_tile:
+            key = self._cache_key(MultiMvtQuery(layers=self.get_layers(tile)), tile)
+        else:
+            query_layers = self.get_query_layers(tile)
+            if len(query_layers) != 1:
+                return None
+            key = self._cache_key(query_layers[0], tile)
+        if self.cache_stale_timeout and cached_file(f"{key}:fresh") is None:
+            return None
+        etag = None
+        if self.etag:
+            digest = getattr(self.tilecache, "digest", None)
+            if not callable(digest) or not (tile_digest := digest(key)):
+                return None
+            etag = quote_etag(tile_digest)
+            if conditional := get_conditional_response(request, etag=etag):
+                conditional["ETag"] = etag
+                return conditional
+        path = cached_file(key)
+        try:
+            response = FileResponse(open(path, "rb"), content_type="application/binary") if path else None
+        except FileNotFoundError:
+            # Culled since
+            return None
+        if response is not None and etag:
+            response["ETag"] = etag
+        return response
+
+    def tile_response(self, request: HttpRequest, content: bytes) -> HttpResponse:
+        """
+        The response for a tile. With `etag`, the tile's digest is its ETag, and a
+        request whose `If-None-Match` has it gets a 304 response without the tile.
+        """
+        if not self.etag:
+            return HttpResponse(content=content, content_type="application/binary")
+        etag = quote_etag(content_digest(content))
+        if conditional := get_conditional_response(request, etag=etag):
+            conditional["ETag"] = etag
+            return conditional
+        return HttpResponse(content=content, content_type="application/binary", headers={"ETag": etag})
 
     def get(self, request: HttpRequest, *args, **kwargs):
         with Timer(name="tile get", logger=logger.info):
             tile = Tile(**kwargs)  # Expect to receive zoom, x, and y in kwargs
-            tiles = b"".join(self._generate_tile(tile))
-            return HttpResponse(content=tiles, content_type="application/binary")
+            if response := self._cached_file(request, tile):
+                return response
+            try:
+                tiles = b"".join(self._generate_tile(tile))
+            except TileOverloaded as E:
+                return self.overloaded(E)
+            return self.tile_response(request, tiles)
+
+
+class PMTilesView(View):
+    """
+    Serve tiles from a PMTiles archive written by `export_pmtiles`, without database
+    queries, at the same URLs as the tile view it was exported from
+    >>> path("roads/<int:zoom>/<int:x>/<int:y>.pbf", PMTilesView.as_view(archive="roads.pmtiles"), name="roads"),
+    """
+
+    archive: str = ""
+
+    def get(self, request: HttpRequest, *args, **kwargs):
+        tile = Tile(**kwargs)
+        try:
+            data = open_archive(self.archive).get(tile.zoom, tile.x, tile.y)
+        except ValueError as E:
+            raise Http404(f"{E}") from E
+        if not data:
+            # Empty tiles are not stored
+            return HttpResponse(content=b"", content_type="application/binary")
+        # Tiles are stored gzipped: send them as they are to clients which accept it
+        if "gzip" in request.headers.get("Accept-Encoding", ""):
+            response = HttpResponse(content=data, content_type="application/binary", headers={"Content-Encoding": "gzip"})
+        else:
+            response = HttpResponse(content=gzip.decompress(data), content_type="application/binary")
+        patch_vary_headers(response, ["Accept-Encoding"])
+        return response
 
 
 class BuildingPolygon(TileLayerView):
@@ -117,19 +573,19 @@ class BuildingPolygon(TileLayerView):
     metres — useful for extrusion styling in maplibre-gl.
     """
 
+    buildings = MvtQuery(
+        table="osmflex_buildingpolygon",
+        attributes=["name", "osm_id", "osm_subtype"],
+        calculated_attributes={"render_min_height": sql.SQL('COALESCE("height", "levels" * 4, 4)')},
+        layer="buildings",
+        pk="osm_id",
+    )
+
     def get_layers(self, tile: Tile):
         if tile.zoom < 14:
             return []
 
-        return [
-            MvtQuery(
-                table="osmflex_buildingpolygon",
-                attributes=["name", "osm_id", "osm_subtype"],
-                calculated_attributes={"render_min_height": sql.SQL('COALESCE("height", "levels" * 4, 4)')},
-                layer="buildings",
-                pk="osm_id",
-            )
-        ]
+        return [self.buildings]
 
 
 class Roads(TileLayerView):
@@ -141,45 +597,65 @@ class Roads(TileLayerView):
     trunks survive; residential/footway/path only appear at zoom 12+.
     """
 
+    road_osm_types: tuple[tuple[str, int], ...] = (
+        ("trunk", 2),
+        ("steps", 12),
+        ("road", 12),
+        ("footway", 12),
+        ("secondary", 7),
+        ("tertiary", 9),
+        ("secondary_link", 7),
+        ("tertiary_link", 9),
+        ("living_street", 12),
+        ("pedestrian", 12),
+        ("primary", 5),
+        ("residential", 13),
+        ("primary_link", 5),
+        ("track", 12),
+        ("motorway_link", 12),
+        ("motorway", 5),
+        ("service", 12),
+        ("unclassified", 12),
+        ("path", 12),
+    )
+
     def get_layers(self, tile: Tile):
-        road_osm_types = [
-            ("trunk", 2),
-            ("steps", 12),
-            ("road", 12),
-            ("footway", 12),
-            ("secondary", 7),
-            ("tertiary", 9),
-            ("secondary_link", 7),
-            ("tertiary_link", 9),
-            ("living_street", 12),
-            ("pedestrian", 12),
-            ("primary", 5),
-            ("residential", 13),
-            ("primary_link", 5),
-            ("track", 12),
-            ("motorway_link", 12),
-            ("motorway", 5),
-            ("service", 12),
-            ("unclassified", 12),
-            ("path", 12),
-        ]  # type: list[tuple[str, int]]
-
-        # Determine which road types to include in the layer
-
-        type_filter = sql.SQL("""{field} = ANY(ARRAY[{types}]::text[])""").format(
-            field=sql.Identifier("osm_type"), types=sql.SQL(",").join([sql.Literal(rt) for rt, mz in road_osm_types if tile.zoom > mz])
-        )
+        return [road_layer(self.road_osm_types, tile.zoom)]
 
-        roads = MvtQuery(
-            table=RoadLine._meta.db_table,
-            attributes=["name", "osm_type"],
-            filters=[type_filter],
-            layer="transportation",
-            transform=False,
-            pk="osm_id",
-        )
 
-        return [roads]
+# Bounded, as the zoom comes from the URL
+@functools.lru_cache(maxsize=256)
+def road_layer(road_osm_types: tuple[tuple[str, int], ...], zoom: int) -> MvtQuery:
+    """
+    The `Roads` layer at a zoom level, built once per zoom
+    """
+    # Determine which road types to include in the layer
+    type_filter = sql.SQL("""{field} = ANY(ARRAY[{types}]::text[])""").format(
+        field=sql.Identifier("osm_type"), types=sql.SQL(",").join([sql.Literal(rt) for rt, mz in road_osm_types if zoom > mz])
+    )
+
+    return MvtQuery(
+        table=RoadLine._meta.db_table,
+        attributes=["name", "osm_type"],
+        filters=[type_filter],
+        layer="transportation",
+        transform=False,
+        pk="osm_id",
+        # Below zoom 13, road geometries carry far more detail than a pixel shows
+        simplify=1 if zoom < 13 else None,
+        min_length=1 if zoom < 13 else None,
+        zoom_bands=road_zoom_bands(road_osm_types),
+    )
+
+
+@functools.cache
+def road_zoom_bands(road_osm_types: tuple[tuple[str, int], ...]) -> tuple[ZoomBand, ...]:
+    """
+    Generalised tables of the roads shown up to zoom 8, built by `build_generalised_tables`
+    and served with `TileLayerView.generalised`
+    """
+    types = sql.SQL(",").join([sql.Literal(rt) for rt, mz in road_osm_types if mz < 8])
+    return (ZoomBand(maxzoom=8, table="djangostreetmap_roadline_z8", simplify=1, filters=[sql.SQL("osm_type = ANY(ARRAY[{}]::text[])").format(types)]),)
 
 
 class Hospitals(View):
@@ -228,9 +704,21 @@ class Aeroways(View):
 
 
 class LandLayer(TileLayerView):
-    """MVT layer of the simplified land polygons (single static layer at all zooms)."""
+    """MVT layer of the simplified land polygons, from their subdivided pieces (see `subdivide_land`)."""
 
-    layers = [MvtQuery(table=models.SimplifiedLandPolygon._meta.db_table, layer="land")]
+    layers = [
+        MvtQuery(
+            table=models.SubdividedLandPolygon._meta.db_table,
+            layer="land",
+            simplify=1,
+            min_area=1,
+            # Built by `build_generalised_tables`, served with `generalised`
+            zoom_bands=[
+                ZoomBand(maxzoom=5, table="djangostreetmap_land_z5", simplify=1, filters=[sql.SQL("ST_AREA(geom) > {}").format(sql.Literal(Tile.pixel_size_at(5) ** 2))]),
+                ZoomBand(maxzoom=9, table="djangostreetmap_land_z9", simplify=1, filters=[sql.SQL("ST_AREA(geom) > {}").format(sql.Literal(Tile.pixel_size_at(9) ** 2))]),
+            ],
+        )
+    ]
 
 
 class PoiLayer(TileLayerView):